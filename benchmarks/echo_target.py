@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Stand-in target of the benchmarks. It echoes back what each client sends, and crashes with SIGSEGV when a client
+sends the magic payload. Only the standard library is used, so that it runs under fuzzmon as is
+"""
+
+import argparse
+import os
+import signal
+import socket
+import threading
+
+MAGIC = b"CRASH!"
+
+
+def serve_client(client, magic):
+    try:
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            if data.startswith(magic):
+                os.kill(os.getpid(), signal.SIGSEGV)
+            client.sendall(data)
+    except socket.error:
+        pass
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Echo server which crashes on a magic payload")
+    address_parser = parser.add_mutually_exclusive_group(required=True)
+    address_parser.add_argument("-p", "--port", help="TCP port to listen on, on the loopback interface", type=int)
+    address_parser.add_argument("-U", "--uds", help="Unix Domain Socket to listen on")
+    parser.add_argument("-m", "--magic", help="Payload which crashes the server. Default is %s" % MAGIC.decode(),
+                        default=MAGIC.decode())
+    args = parser.parse_args()
+
+    if args.uds is not None:
+        if os.path.exists(args.uds):
+            os.unlink(args.uds)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(args.uds)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", args.port))
+    server.listen(128)
+    while True:
+        client, _ = server.accept()
+        if server.family != socket.AF_UNIX:
+            # Echoes are not delayed waiting for acknowledgements, which would hide the latency of the proxy
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        thread = threading.Thread(target=serve_client, args=(client, args.magic.encode()))
+        thread.daemon = True
+        thread.start()
+
+
+if __name__ == "__main__":
+    main()
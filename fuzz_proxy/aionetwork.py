@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import socket
+
+import fuzz_proxy.recorder as fuzzrec
+from fuzz_proxy.metrics import timer
+from fuzz_proxy.network import POOL_RETRY_DELAY, ProxyHooks, set_no_delay, StreamDirection
+
+
+class AsyncProxyHooks(object):
+    """ Coroutine flavour of ProxyHooks. Every callback runs in the task of the connection it belongs to, so a hook
+    awaiting on a slow operation only delays its own connection
+    """
+
+    def __init__(self):
+        self.is_done = False
+
+    async def pre_downstream_send(self, channel, data):
+        return data
+
+    async def post_downstream_send(self, channel, data):
+        return True
+
+    async def pre_upstream_send(self, channel, data):
+        return data
+
+    async def post_upstream_send(self, channel, data):
+        return True
+
+    def fileno(self):
+        """ A file descriptor which becomes readable when the hook has events for the proxy loop, or None
+        """
+        return None
+
+    def on_wakeup(self):
+        """ Called from the event loop when fileno() is readable. Returns the channels to tear down
+        """
+        return []
+
+    def is_upstream_ready(self):
+        """ Whether the upstream server accepts connections. Until it does, new downstream connections are held
+        """
+        return True
+
+    def select_upstream(self, upstream_address):
+        """ Address to connect to for a new downstream connection
+        """
+        return upstream_address
+
+
+class SyncHooksAdapter(AsyncProxyHooks):
+    """ Runs synchronous ProxyHooks, such as DebuggingHooks, from the asyncio engine
+    """
+
+    def __init__(self, proxy_hook):
+        self.proxy_hook = proxy_hook
+        super(SyncHooksAdapter, self).__init__()
+
+    @property
+    def is_done(self):
+        return self.proxy_hook.is_done
+
+    @is_done.setter
+    def is_done(self, value):
+        self.proxy_hook.is_done = value
+
+    async def pre_downstream_send(self, channel, data):
+        return self.proxy_hook.pre_downstream_send(channel, data)
+
+    async def post_downstream_send(self, channel, data):
+        return self.proxy_hook.post_downstream_send(channel, data)
+
+    async def pre_upstream_send(self, channel, data):
+        return self.proxy_hook.pre_upstream_send(channel, data)
+
+    async def post_upstream_send(self, channel, data):
+        return self.proxy_hook.post_upstream_send(channel, data)
+
+    def fileno(self):
+        return self.proxy_hook.fileno()
+
+    def on_wakeup(self):
+        return self.proxy_hook.on_wakeup()
+
+    def is_upstream_ready(self):
+        return self.proxy_hook.is_upstream_ready()
+
+    def select_upstream(self, upstream_address):
+        return self.proxy_hook.select_upstream(upstream_address)
+
+
+class AsyncDownstream(object):
+    """ asyncio implementation of Downstream. Same constructor and serve() interface, so both engines are
+    interchangeable
+    """
+
+    def __init__(self, server_socket, client_socket, upstream_address, proxy_hook=None, max_pending=1 << 20,
+                 pool_size=0, max_waiting=64, metrics=None, recorder=None):
+        self.downstream_socket = server_socket
+        self.upstream_socket = client_socket
+        self.upstream_address = upstream_address
+        if proxy_hook is None:
+            proxy_hook = AsyncProxyHooks()
+        elif isinstance(proxy_hook, ProxyHooks):
+            proxy_hook = SyncHooksAdapter(proxy_hook)
+        self.proxy_hook = proxy_hook
+        self.max_pending = max_pending
+        # Established upstream connections waiting for a downstream client. The stream readers buffer whatever the
+        # server sends in the meantime
+        self.pool = None
+        self.pool_size = pool_size
+        self.pool_wanted = None
+        # Number of downstream connections held until the upstream server is ready, and event set when it is
+        self.waiting = 0
+        self.max_waiting = max_waiting
+        self.upstream_ready = None
+        # Index from each upstream socket to the tasks relaying its channel
+        self.connections = {}
+        # Same metrics and flight recorder events as Downstream, when given
+        self.metrics = metrics
+        self.recorder = recorder
+        self.loop = None
+        self.server = None
+        self.stopped = None
+        self.is_running = False
+        self.logger = logging.getLogger("AsyncDownstream")
+
+    def serve(self, buffer_size=4096, timeout=None):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._serve(buffer_size, timeout))
+        finally:
+            self.loop.close()
+
+    async def _serve(self, buffer_size, timeout):
+        self.is_running = True
+        self.stopped = asyncio.Event()
+        self.pool = asyncio.Queue()
+        self.pool_wanted = asyncio.Event()
+        self.upstream_ready = asyncio.Event()
+        pool_task = self.loop.create_task(self._fill_pool(buffer_size)) if self.pool_size > 0 else None
+        if isinstance(self.downstream_socket, socket.socket):
+            self.server = await asyncio.start_server(lambda r, w: self._on_accept(r, w, buffer_size),
+                                                     sock=self.downstream_socket, limit=buffer_size)
+        else:
+            # Connections handed over by another process, such as the pool of instances
+            self.loop.add_reader(self.downstream_socket.fileno(), self._on_handover, buffer_size)
+        wakeup_fd = self.proxy_hook.fileno()
+        if wakeup_fd is not None:
+            self.loop.add_reader(wakeup_fd, self._on_wakeup)
+        self.logger.info("Downstream server listening for new connections")
+        while self.is_running and not self.proxy_hook.is_done:
+            try:
+                await asyncio.wait_for(self.stopped.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if wakeup_fd is not None:
+            self.loop.remove_reader(wakeup_fd)
+        if self.server is not None:
+            self.server.close()
+        else:
+            self.loop.remove_reader(self.downstream_socket.fileno())
+        if pool_task is not None:
+            pool_task.cancel()
+        while not self.pool.empty():
+            self.pool.get_nowait()[2].close()
+        for tasks in list(self.connections.values()):
+            for task in tasks:
+                task.cancel()
+        if self.connections:
+            await asyncio.gather(*[t for tasks in self.connections.values() for t in tasks], return_exceptions=True)
+        self.is_running = False
+
+    def stop(self):
+        self.is_running = False
+        if self.loop is not None and self.stopped is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        try:
+            self.downstream_socket.close()
+        except socket.error:
+            pass
+        self.logger.warn("Stopped downstream server")
+
+    def _on_wakeup(self):
+        start = timer()
+        channels = self.proxy_hook.on_wakeup()
+        if self.metrics is not None:
+            self.metrics.observe("hook.on_wakeup", timer() - start)
+        for channel in channels:
+            tasks = self.connections.get(channel.get(StreamDirection.UPSTREAM), ())
+            if tasks:
+                self.logger.warn("Upstream server appears to be dead: %s" % channel.get(StreamDirection.UPSTREAM))
+            for task in tasks:
+                task.cancel()
+        if self.proxy_hook.is_upstream_ready():
+            self.upstream_ready.set()
+        if self.proxy_hook.is_done:
+            self.stopped.set()
+
+    def _on_handover(self, buffer_size):
+        try:
+            downstream_client_socket, _ = self.downstream_socket.accept()
+        except socket.error as se:
+            self.logger.debug("Failed to accept downstream connection: %s" % se)
+            return
+        downstream_client_socket.setblocking(False)
+        self.loop.create_task(self._on_handed_over(downstream_client_socket, buffer_size))
+
+    async def _on_handed_over(self, downstream_client_socket, buffer_size):
+        downstream_reader, downstream_writer = await asyncio.open_connection(sock=downstream_client_socket,
+                                                                             limit=buffer_size)
+        await self._on_accept(downstream_reader, downstream_writer, buffer_size)
+
+    async def _on_accept(self, downstream_reader, downstream_writer, buffer_size):
+        downstream_client_socket = downstream_writer.get_extra_info("socket")
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.ACCEPT, downstream_client_socket.fileno())
+        if self.metrics is not None:
+            self.metrics.inc("proxy.connections")
+        upstream = None
+        while upstream is None:
+            if not await self._wait_for_upstream(downstream_client_socket):
+                self.logger.error("Too many connections waiting for upstream server. Closing downstream: %s" %
+                                  downstream_client_socket)
+                if self.metrics is not None:
+                    self.metrics.inc("proxy.dropped")
+                downstream_writer.close()
+                return
+            upstream = self._get_pooled_upstream()
+            if upstream is None:
+                upstream = await self._connect_upstream(buffer_size)
+            # The upstream server went down in the meantime, and the connection is retried once it is back
+            if upstream is not None or self.proxy_hook.is_upstream_ready():
+                break
+        if upstream is None:
+            self.logger.error("Failed to connect to upstream server. Closing downstream: %s" %
+                              downstream_client_socket)
+            downstream_writer.close()
+            return
+        upstream_client_socket, upstream_reader, upstream_writer = upstream
+        for writer in (downstream_writer, upstream_writer):
+            writer.transport.set_write_buffer_limits(high=self.max_pending)
+        channel = {StreamDirection.DOWNSTREAM: downstream_client_socket,
+                   StreamDirection.UPSTREAM: upstream_client_socket}
+        for socket_ in channel.values():
+            set_no_delay(socket_)
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.CONNECT, downstream_client_socket.fileno(), upstream_client_socket.fileno())
+        tasks = (self.loop.create_task(self._relay(channel, downstream_reader, upstream_writer,
+                                                   StreamDirection.UPSTREAM, buffer_size)),
+                 self.loop.create_task(self._relay(channel, upstream_reader, downstream_writer,
+                                                   StreamDirection.DOWNSTREAM, buffer_size)))
+        self.connections[upstream_client_socket] = tasks
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+        finally:
+            self.connections.pop(upstream_client_socket, None)
+            if self.recorder is not None:
+                for socket_ in (downstream_client_socket, upstream_client_socket):
+                    self.recorder.record(fuzzrec.CLOSE, socket_.fileno())
+            for writer in (downstream_writer, upstream_writer):
+                writer.close()
+
+    async def _wait_for_upstream(self, downstream_client_socket=None):
+        """ Holds the connection until the upstream server is ready. Returns False when too many are held already
+        """
+        if self.proxy_hook.is_upstream_ready():
+            return True
+        if self.waiting >= self.max_waiting:
+            return False
+        self.waiting += 1
+        if downstream_client_socket is not None:
+            if self.metrics is not None:
+                self.metrics.inc("proxy.held")
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.HOLD, downstream_client_socket.fileno(), self.waiting)
+        try:
+            while not self.proxy_hook.is_upstream_ready():
+                self.upstream_ready.clear()
+                await self.upstream_ready.wait()
+        finally:
+            self.waiting -= 1
+        return True
+
+    async def _connect_upstream(self, buffer_size):
+        upstream_client_socket = socket.socket(self.upstream_socket.family, self.upstream_socket.type,
+                                               self.upstream_socket.proto)
+        upstream_client_socket.setblocking(False)
+        upstream_address = self.proxy_hook.select_upstream(self.upstream_address)
+        try:
+            await asyncio.wait_for(self.loop.sock_connect(upstream_client_socket, upstream_address),
+                                   self.upstream_socket.gettimeout())
+            upstream_reader, upstream_writer = await asyncio.open_connection(sock=upstream_client_socket,
+                                                                             limit=buffer_size)
+        except (socket.error, asyncio.TimeoutError) as e:
+            self.logger.error("Failed to connect to upstream server %s: %s" % (upstream_address, e))
+            upstream_client_socket.close()
+            return None
+        return upstream_client_socket, upstream_reader, upstream_writer
+
+    def _get_pooled_upstream(self):
+        while not self.pool.empty():
+            upstream = self.pool.get_nowait()
+            self.pool_wanted.set()
+            if not upstream[1].at_eof() and not upstream[2].is_closing():
+                return upstream
+            self.logger.debug("Pooled upstream connection closed by server: %s" % upstream[0])
+            upstream[2].close()
+        return None
+
+    async def _fill_pool(self, buffer_size):
+        while True:
+            while self.pool.qsize() < self.pool_size:
+                await self._wait_for_upstream()
+                upstream = await self._connect_upstream(buffer_size)
+                if upstream is None:
+                    await asyncio.sleep(POOL_RETRY_DELAY)
+                else:
+                    self.pool.put_nowait(upstream)
+            self.pool_wanted.clear()
+            await self.pool_wanted.wait()
+
+    async def _relay(self, channel, reader, writer, direction, buffer_size):
+        """ Forwards data from reader to writer until the end of stream, which is then relayed as a half close
+        """
+        pre_send, post_send = "pre_%s_send" % direction, "post_%s_send" % direction
+        source = channel[StreamDirection.DOWNSTREAM if direction == StreamDirection.UPSTREAM else
+                         StreamDirection.UPSTREAM]
+        while True:
+            try:
+                data = await reader.read(buffer_size)
+            except socket.error:
+                data = b""
+            if len(data) == 0:
+                break
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.READ, source.fileno(), len(data))
+            # Time from the end of the read to the end of the send, hooks included
+            start = timer()
+            size = len(data)
+            data = await self._call_hook(pre_send, channel, data)
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.SEND, channel[direction].fileno(), len(data))
+            try:
+                writer.write(data)
+                # Stops reading from this side while the other one is not keeping up
+                await writer.drain()
+            except socket.error:
+                self.logger.warning("%s socket appears to be dead: %s" % (direction.capitalize(),
+                                                                          channel[direction]))
+            is_alive = await self._call_hook(post_send, channel, data)
+            if self.metrics is not None:
+                self.metrics.observe("proxy.forward", timer() - start)
+                self.metrics.inc("proxy.%s.packets" % direction)
+                self.metrics.inc("proxy.%s.bytes" % direction, size)
+            if not is_alive:
+                self.logger.warn("Upstream server appears to be dead: %s" % channel[StreamDirection.UPSTREAM])
+                raise asyncio.CancelledError()
+        if writer.can_write_eof() and not writer.is_closing():
+            try:
+                writer.write_eof()
+            except socket.error:
+                pass
+
+    async def _call_hook(self, name, channel, data):
+        hook = getattr(self.proxy_hook, name)
+        if self.metrics is None:
+            return await hook(channel, data)
+        start = timer()
+        result = await hook(channel, data)
+        self.metrics.observe("hook." + name, timer() - start)
+        return result
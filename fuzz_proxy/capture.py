@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import os
+import re
+import struct
+import threading
+import time
+
+from fuzz_proxy.network import StreamDirection
+
+# Size after which a capture file is rotated
+MAX_FILE_SIZE = 64 << 20
+# Bytes of packets waiting for the writer, beyond which packets are dropped instead of slowing the proxy down
+MAX_PENDING = 16 << 20
+# How often the writer wakes up to write what the proxy captured
+FLUSH_INTERVAL = 0.1
+
+
+class PcapFormat(object):
+    """ Packets as IPv4 frames of a raw pcap capture, with made up TCP or UDP headers, so that Wireshark and tcpdump
+    can follow each channel. The client of channel n has address 10.x.y.z, where x.y.z are the lower 24 bits of n,
+    and the server is 172.16.0.1 on the upstream port. TCP sequence numbers count the bytes of each direction
+    """
+
+    EXTENSION = ".pcap"
+    # Microsecond timestamps, version 2.4, no snap length limit, LINKTYPE_RAW
+    HEADER = struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101)
+    RECORD = struct.Struct("<IIII")
+    IP_HEADER = struct.Struct("!BBHHHBBH4s4s")
+    TCP_HEADER = struct.Struct("!HHIIBBHHH")
+    UDP_HEADER = struct.Struct("!HHHH")
+    SERVER_ADDRESS = b"\xac\x10\x00\x01"
+    CLIENT_PORT = 49152
+    # Sequence numbers kept for this many channels, least recently used ones first forgotten
+    MAX_CHANNELS = 4096
+
+    def __init__(self, protocol="tcp", port=0):
+        self.protocol = protocol
+        self.port = port
+        self.header_size = self.IP_HEADER.size + (self.TCP_HEADER.size if protocol == "tcp" else self.UDP_HEADER.size)
+        self.max_payload = 65535 - self.header_size
+        # Next sequence number of each direction, per channel
+        self.sequences = collections.OrderedDict()
+
+    def pack(self, timestamp, channel_id, direction, data):
+        client_address = struct.pack("!I", (10 << 24) | (channel_id & 0xffffff))
+        if direction == StreamDirection.UPSTREAM:
+            addresses = client_address, self.SERVER_ADDRESS
+            ports = self.CLIENT_PORT, self.port
+        else:
+            addresses = self.SERVER_ADDRESS, client_address
+            ports = self.port, self.CLIENT_PORT
+        seconds = int(timestamp)
+        microseconds = int((timestamp - seconds) * 1000000)
+        frames = []
+        # Packets bigger than an IPv4 frame are split over several frames
+        for offset in range(0, max(len(data), 1), self.max_payload):
+            payload = data[offset:offset + self.max_payload]
+            length = self.header_size + len(payload)
+            frames.append(self.RECORD.pack(seconds, microseconds, length, length))
+            frames.append(self._ip_header(length, addresses))
+            if self.protocol == "tcp":
+                frames.append(self._tcp_header(channel_id, direction, ports, len(payload)))
+            else:
+                frames.append(self.UDP_HEADER.pack(ports[0], ports[1], self.UDP_HEADER.size + len(payload), 0))
+            frames.append(payload)
+        return b"".join(frames)
+
+    def _ip_header(self, length, addresses):
+        protocol = 6 if self.protocol == "tcp" else 17
+        header = self.IP_HEADER.pack(0x45, 0, length, 0, 0x4000, 64, protocol, 0, addresses[0], addresses[1])
+        return header[:10] + struct.pack("!H", checksum(header)) + header[12:]
+
+    def _tcp_header(self, channel_id, direction, ports, length):
+        sequences = self.sequences.pop(channel_id, None)
+        if sequences is None:
+            sequences = {StreamDirection.UPSTREAM: 1, StreamDirection.DOWNSTREAM: 1}
+            if len(self.sequences) >= self.MAX_CHANNELS:
+                self.sequences.popitem(last=False)
+        self.sequences[channel_id] = sequences
+        peer = StreamDirection.DOWNSTREAM if direction == StreamDirection.UPSTREAM else StreamDirection.UPSTREAM
+        sequence = sequences[direction]
+        sequences[direction] = (sequence + length) & 0xffffffff
+        # PSH and ACK flags, without checksum
+        return self.TCP_HEADER.pack(ports[0], ports[1], sequence, sequences[peer], 5 << 4, 0x18, 65535, 0, 0)
+
+
+class SegmentFormat(object):
+    """ Compact capture: a magic, then each packet as its timestamp, channel id, direction and length, followed by
+    its data. read_segment() reads it back
+    """
+
+    EXTENSION = ".cap"
+    HEADER = b"FZCAP\x01"
+    RECORD = struct.Struct("!dIBI")
+    DIRECTIONS = (StreamDirection.UPSTREAM, StreamDirection.DOWNSTREAM)
+
+    def __init__(self, protocol="tcp", port=0):
+        pass
+
+    def pack(self, timestamp, channel_id, direction, data):
+        return self.RECORD.pack(timestamp, channel_id & 0xffffffff, self.DIRECTIONS.index(direction),
+                                len(data)) + data
+
+
+CAPTURE_FORMATS = {"pcap": PcapFormat, "segment": SegmentFormat}
+
+
+def checksum(header):
+    """ Internet checksum of an IPv4 header
+    """
+    total = sum(struct.unpack("!%dH" % (len(header) // 2), header))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def read_segment(path):
+    """ Yields the (timestamp, channel id, direction, data) of the packets of a segment capture file. A packet torn by
+    a crash of fuzzmon ends the file
+    """
+    with open(path, "rb") as f:
+        if f.read(len(SegmentFormat.HEADER)) != SegmentFormat.HEADER:
+            raise ValueError("Not a segment capture file: %s" % path)
+        while True:
+            header = f.read(SegmentFormat.RECORD.size)
+            if len(header) < SegmentFormat.RECORD.size:
+                return
+            timestamp, channel_id, direction, length = SegmentFormat.RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, channel_id, SegmentFormat.DIRECTIONS[direction], data
+
+
+class TrafficCapture(object):
+    """ Streams every packet forwarded by the proxy to capture files in folder, rotated once they reach
+    max_file_size. record() only copies the packet to a list: a writer thread takes the list every flush_interval
+    seconds and writes it as one buffer. When more than max_pending bytes wait for a slow disk, packets are dropped
+    and counted, so that the proxy is never blocked
+    """
+
+    def __init__(self, folder, capture_format="pcap", max_file_size=MAX_FILE_SIZE, max_pending=MAX_PENDING,
+                 flush_interval=FLUSH_INTERVAL, protocol="tcp", port=0):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.format = CAPTURE_FORMATS[capture_format](protocol, port)
+        self.max_file_size = max_file_size
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.captured = 0
+        self.file = None
+        self.file_size = 0
+        # Files of previous sessions in the same folder are kept
+        pattern = re.compile(r"^capture-(\d+)%s$" % re.escape(self.format.EXTENSION))
+        numbers = [int(m.group(1)) for m in (pattern.match(name) for name in os.listdir(folder)) if m]
+        self.file_number = max(numbers) + 1 if numbers else 0
+        self.is_running = False
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger("TrafficCapture")
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, channel_id, direction, data):
+        """ Called from the proxy loop. data may be a buffer reused by the proxy, so it is copied
+        """
+        if self.pending_bytes + len(data) > self.max_pending:
+            self.dropped += 1
+            return
+        packet = (time.time(), channel_id, direction, bytes(data))
+        with self.lock:
+            self.pending.append(packet)
+            self.pending_bytes += len(packet[3])
+
+    def close(self):
+        """ Writes what is pending and closes the current file
+        """
+        self.is_running = False
+        if self.thread is not None:
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _write(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            with self.lock:
+                packets = self.pending
+                self.pending = []
+                self.pending_bytes = 0
+            try:
+                self._write_packets(packets)
+            except (IOError, OSError) as e:
+                self.logger.error("Failed to write capture to %s: %s" % (self.folder, e))
+            if self.dropped != self.reported_dropped:
+                self.logger.warn("Dropped %d packets so far: the disk does not keep up with the proxy" % self.dropped)
+                self.reported_dropped = self.dropped
+            if not self.is_running:
+                break
+
+    def _write_packets(self, packets):
+        buffer_ = bytearray()
+        for packet in packets:
+            if self.file is None or self.file_size + len(buffer_) >= self.max_file_size:
+                self._rotate(buffer_)
+                buffer_ = bytearray()
+            buffer_ += self.format.pack(*packet)
+            self.captured += 1
+        if buffer_:
+            self.file.write(buffer_)
+            self.file_size += len(buffer_)
+        if self.file is not None:
+            self.file.flush()
+
+    def _rotate(self, buffer_):
+        """ Writes buffer_ to the current file, if any, and starts the next one
+        """
+        if self.file is not None:
+            self.file.write(buffer_)
+            self.file.close()
+        path = os.path.join(self.folder, "capture-%05d%s" % (self.file_number, self.format.EXTENSION))
+        self.file_number += 1
+        self.file = open(path, "wb")
+        self.file.write(self.format.HEADER)
+        self.file_size = len(self.format.HEADER)
+        self.logger.info("Capturing traffic to %s" % path)
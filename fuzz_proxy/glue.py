@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-import binascii
+import errno
+import fcntl
 import logging
 import os
 try:
@@ -13,104 +14,255 @@ import threading
 import ptrace.error as perror
 
 import fuzz_proxy.helpers as fuzzhelp
+import fuzz_proxy.history as fuzzhist
 import fuzz_proxy.monitor as fuzzmon
 import fuzz_proxy.network as fuzznet
+import fuzz_proxy.recorder as fuzzrec
+import fuzz_proxy.store as fuzzstore
+
+# Delay between two checks of whether the upstream server is ready, doubled after each failure
+PROBE_DELAY = 0.01
+MAX_PROBE_DELAY = 0.5
+# First delay before restarting a process which died before ever being ready
+MIN_RESTART_DELAY = 0.1
 
 
 class DebuggingHooks(fuzznet.ProxyHooks):
     def __init__(self, debugger, sessid, crash_folder="metadata", restart_delay=0, max_streams=10,
-                 max_pkts_per_stream=10, crash_timeout=0.01):
+                 max_pkts_per_stream=10, memory_budget=None, spill_threshold=None, max_pkt_size=None,
+                 max_reports_per_bucket=5, max_frames=5, upstream_socket=None, upstream_address=None, mutator=None,
+                 crash_store=False, metrics=None, capture=None, recorder=None):
+        super(DebuggingHooks, self).__init__()
         self.debugger = debugger
         self.sessid = sessid
-        # First stream will get id 0
-        self.stream_counter = -1
         self.restart_delay = restart_delay
         if not os.path.isdir(crash_folder):
             os.makedirs(os.path.join(os.path.abspath(os.path.curdir), crash_folder))
         self.crash_folder = crash_folder
+        # Reports are appended to a store in the crash folder, instead of being written to a file each
+        store = fuzzstore.CrashStore(os.path.join(crash_folder, fuzzstore.CrashStore.FOLDER)) if crash_store else None
+        self.buckets = fuzzmon.CrashBuckets(crash_folder, max_reports_per_bucket, max_frames, store=store)
         self.crash_events = queue.Queue()
-        self.streams = fuzzhelp.Dequeue(maxlen=max_streams)
-        self.max_pkts_per_stream = max_pkts_per_stream
-        self.crash_timeout = crash_timeout
+        # Reports waiting to be formatted and written by the crash worker. None stops the worker
+        self.crash_reports = queue.Queue()
+        # Self-pipe through which the debugger thread wakes up the proxy loop when a crash is detected
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        for fd in (self.wakeup_read_fd, self.wakeup_write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.streams = fuzzhist.StreamHistory(max_streams, max_pkts_per_stream, memory_budget=memory_budget,
+                                              spill_threshold=spill_threshold, max_pkt_size=max_pkt_size)
+        # Rewrites upstream packets before they are recorded, so that crash reports hold what the target received
+        self.mutator = mutator
+        # Counts crashes and restarts, and times crash reports and restarts, when given
+        self.metrics = metrics
+        self.down_time = None
+        # Streams every packet to capture files, when given. It is closed along with the hooks
+        self.capture = capture
+        # The last events of the proxy and the debugger, attached to crash reports, when given
+        self.recorder = recorder
         self.logger = logging.getLogger("DebuggingHooks")
+        # The target is ready once it listens on the upstream address. Each crash or restart starts a new generation
+        # of probes, which ends the previous one
+        self.upstream_socket = upstream_socket
+        self.upstream_address = upstream_address
+        self.upstream_ready = False
+        self.was_ready = False
+        self.probe_generation = 0
+        self.probe_lock = threading.Lock()
+        self.restart_backoff = 0
+        self._start_probe()
+        self.crash_worker = threading.Thread(target=self._write_crash_reports)
+        self.crash_worker.daemon = True
+        self.crash_worker.start()
         threading.Thread(target=self.debugger.watch,
                          args=(self.on_signal, self.on_event, self.on_exit)
                          ).start()
-        super(DebuggingHooks, self).__init__()
-
-    def _get_stream(self, channel):
-        for stream in self.streams:
-            if channel in stream.keys():
-                return stream
-        return None
 
-    def _get_stream_history(self):
+    def _get_stream_history(self, crashed_stream=None):
         history = []
         for stream in self.streams:
-            history.append([(pkt[0], binascii.hexlify(pkt[1])) for pkt in stream.values()[0]])
-        # Remove the stream causing the crash from history
-        history.pop()
+            # Skip the stream causing the crash
+            if stream is not crashed_stream:
+                history.append(self._dump_stream(stream))
         return history
 
+    def _dump_stream(self, stream):
+        # Raw copy of the packets, hex encoded later by the crash worker
+        return list(stream)
+
+    def _get_crashed_stream(self, crash_time):
+        """ The crashed stream is the one which most recently sent data upstream before the crash
+        """
+        crashed_stream = None
+        for stream in self.streams:
+            pkt_time = stream.last_upstream_time
+            if pkt_time is not None and pkt_time <= crash_time and \
+                    (crashed_stream is None or pkt_time > crashed_stream.last_upstream_time):
+                crashed_stream = stream
+        return crashed_stream
+
     def pre_upstream_send(self, channel, data):
         return self._pre_send(channel, data, fuzznet.StreamDirection.UPSTREAM)
 
-    def post_upstream_send(self, channel, data):
-        self.logger.debug("Entering post upstream send callback: %s" % channel)
-        immutable_channel = frozenset(channel.items())
-        try:
-            crash_report = self.crash_events.get(timeout=self.crash_timeout)
+    def fileno(self):
+        return self.wakeup_read_fd
+
+    def on_wakeup(self):
+        self._drain_wakeup()
+        dead_channels = []
+        while True:
+            try:
+                crash_report = self.crash_events.get_nowait()
+            except queue.Empty:
+                break
             self.logger.warn("Upstream server crashed!")
-            # Stream which caused the crash
-            crash_report.stream = [(pkt[0], binascii.hexlify(pkt[1])) for pkt in
-                                   self._get_stream(immutable_channel).values()[0]]
+            stream = self._get_crashed_stream(crash_report.time)
+            if stream is not None:
+                # Stream which caused the crash
+                crash_report.stream = self._dump_stream(stream)
+                dead_channels.append(dict(stream.channel))
             # Populate history
-            crash_report.history = self._get_stream_history()
-            crash_file_name = os.path.join(self.crash_folder, "%s.json" % crash_report.pid)
-            self.logger.info("Dumping crash information to: %s" % crash_file_name)
-            with open(crash_file_name, "w") as f:
-                crash_report.to_json(f)
+            crash_report.history = self._get_stream_history(stream)
+            self.crash_reports.put(crash_report)
+        return dead_channels
+
+    def _write_crash_reports(self):
+        """ Crash worker. Formats the raw state captured by the debugger thread and writes the reports
+        """
+        crash_report = False
+        while crash_report is not None:
+            try:
+                crash_report = self.crash_reports.get(timeout=self.buckets.flush_interval)
+            except queue.Empty:
+                crash_report = False
+            try:
+                if crash_report:
+                    crash_report.enrich()
+                    self.buckets.add(crash_report)
+                    if self.metrics is not None:
+                        # From the signal to the report on disk, or in the batch of the crash store
+                        self.metrics.observe("crash.report", time.time() - crash_report.time)
+                else:
+                    # Counters of full buckets are written once crashes calm down, and when stopping
+                    self.buckets.flush()
+            except (IOError, OSError) as e:
+                self.logger.error("Failed to write crash information to %s: %s" % (self.crash_folder, e))
+
+    def close(self):
+        """ Waits for the crash worker to write the pending reports and the bucket index, and for the capture to be
+        written. Must be called once the proxy loop is stopped
+        """
+        if self.crash_worker.is_alive():
+            self.crash_reports.put(None)
+            self.crash_worker.join()
+        self.streams.close()
+        try:
+            self.buckets.close()
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to write crash information to %s: %s" % (self.crash_folder, e))
+        if self.capture is not None:
+            self.capture.close()
+
+    def is_upstream_ready(self):
+        return self.upstream_ready
+
+    def _start_probe(self, delay=0):
+        """ Probes the upstream server from a background thread after delay seconds, until it listens
+        """
+        with self.probe_lock:
+            self.probe_generation += 1
+            self.upstream_ready = False
+            generation = self.probe_generation
+        if self.upstream_address is None:
+            self._set_upstream_ready(generation)
+            return
+        thread = threading.Thread(target=self._probe_upstream, args=(generation, delay))
+        thread.daemon = True
+        thread.start()
+
+    def _stop_probe(self):
+        with self.probe_lock:
+            self.probe_generation += 1
+            self.upstream_ready = False
+
+    def _probe_upstream(self, generation, delay):
+        time.sleep(delay)
+        delay = PROBE_DELAY
+        while generation == self.probe_generation and not self.is_done:
+            if self._is_upstream_listening():
+                self._set_upstream_ready(generation)
+                return
+            time.sleep(delay)
+            delay = min(2 * delay, MAX_PROBE_DELAY)
+
+    def _is_upstream_listening(self):
+        # Considered ready when it cannot be checked
+        if fuzzhelp.is_listening(self.upstream_socket.family, self.upstream_socket.type,
+                                 self.upstream_address) is False:
             return False
-        except queue.Empty:
-            self.logger.debug("No upstream crash detected")
-            return True
+        # Instances of a fork server share the listening socket with its stopped snapshot and standby, which keep it
+        # listening once the instance is dead. Instances start by running the ready syscall, so they are ready for as
+        # long as they run
+        if getattr(self.debugger, "ready_syscall", None) is not None:
+            return fuzzmon.is_running(self.debugger.root_pid)
+        return True
+
+    def _set_upstream_ready(self, generation):
+        with self.probe_lock:
+            if generation != self.probe_generation:
+                return
+            self.upstream_ready = self.was_ready = True
+        self.logger.info("Upstream server is ready")
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.READY)
+        if self.metrics is not None and self.down_time is not None:
+            # From the death of the target to its restarted instance listening again
+            self.metrics.observe("restart.downtime", time.time() - self.down_time)
+            self.down_time = None
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_write_fd, b"\0")
+        except OSError as oe:
+            # A full pipe already guarantees a pending wakeup
+            if oe.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_read_fd, 4096):
+                pass
+        except OSError as oe:
+            if oe.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
 
     def pre_downstream_send(self, channel, data):
         return self._pre_send(channel, data, fuzznet.StreamDirection.DOWNSTREAM)
 
     def _pre_send(self, channel, data, direction):
-        self.logger.debug("Entering pre %s send callback: %s" % (direction, channel))
         immutable_channel = frozenset(channel.items())
-        stream = self._get_stream(immutable_channel)
-        if stream is None:
-            stream = fuzzhelp.Dequeue([(direction, data)], maxlen=self.max_pkts_per_stream)
-            self.streams.append({immutable_channel: stream})
-            self.stream_counter += 1
-            self.logger.debug("Creating new %s stream %d: %s" % (direction, self.stream_counter, stream))
-        else:
-            self.streams.remove(stream)
-            stream[immutable_channel].append((direction, data))
-            self.streams.append(stream)
-            self.logger.debug("Appending data to existing %s stream: %s" % (direction, stream))
+        if self.mutator is not None and direction == fuzznet.StreamDirection.UPSTREAM:
+            data = self.mutator.mutate(immutable_channel, data)
+        stream_counter = self.streams.stream_counter
+        stream = self.streams.record(immutable_channel, direction, data)
+        if self.recorder is not None and self.streams.stream_counter != stream_counter:
+            self.recorder.record(fuzzrec.STREAM, stream.stream_id,
+                                 channel[fuzznet.StreamDirection.UPSTREAM].fileno())
+        if direction == fuzznet.StreamDirection.UPSTREAM:
+            stream.last_upstream_time = time.time()
+        if self.capture is not None:
+            self.capture.record(stream.stream_id, direction, data)
         return data
 
     def on_signal(self, signal_):
         process = signal_.process
         signum = signal_.signum
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.SIGNAL, process.pid, signum)
         if signum in fuzzmon.crash_signals:
             self.logger.warn("Received signal %d from process: %d. Gathering crash information" % (signum, process.pid))
-            crash_report = fuzzmon.CrashReport(self.sessid, process.pid, signum, self.stream_counter)
-            # Populate registers, maps, backtrace, disassembly if available
-            self._ignore_ptrace_errors(process.dumpRegs, crash_report.dump_regs)
-            self._ignore_ptrace_errors(process.dumpMaps, crash_report.dump_maps)
-            self._ignore_ptrace_errors(process.dumpStack, crash_report.dump_stack)
-            frames = self._ignore_ptrace_errors(process.getBacktrace)
-            instrs = self._ignore_ptrace_errors(process.disassemble)
-            for frame in frames:
-                crash_report.dump_backtrace(frame)
-            for instr in instrs:
-                crash_report.dump_code(instr)
-            self.crash_events.put(crash_report)
+            self._report_crash(process.pid, signum, process)
         self.logger.warn("Propagating signal %d to child process: %d" % (signum, process.pid))
         try:
             process.cont(signum)
@@ -118,18 +270,57 @@ class DebuggingHooks(fuzznet.ProxyHooks):
             self.logger.critical("Failed to propagate signal to traced process: %s" % pe)
             self._shutdown()
 
+    def _report_crash(self, pid, signum, process=None):
+        crash_report = fuzzmon.CrashReport(self.sessid, pid, signum, self.streams.stream_counter)
+        if self.recorder is not None:
+            # Raw copy, described by the crash worker
+            crash_report.events = self.recorder.snapshot()
+        if process is not None:
+            # Only raw state is copied here, so that the process gets its signal as soon as possible
+            self._ignore_ptrace_errors(crash_report.capture, process)
+        if self.metrics is not None:
+            self.metrics.inc("crashes")
+            # Time for which the target is held stopped
+            self.metrics.observe("crash.capture", time.time() - crash_report.time)
+        self.crash_events.put(crash_report)
+        # Connections are held until the process is restarted, or is found to have survived the signal
+        self._start_probe(MAX_PROBE_DELAY)
+        self._wakeup()
+
     def on_event(self, event):
         self.logger.critical("Currently unhandled event: %s" % event)
         self.logger.critical("A bug report at https://github.com/alexmgr/fuzzmon would be greatly appreciated")
         raise NotImplementedError("Currently unhandled event: %s")
 
     def on_exit(self, event):
+        self.down_time = time.time()
+        if self.recorder is not None:
+            pid = event.pid if isinstance(event, fuzzmon.ExitStatus) else event.process.pid
+            status = event.exitcode if event.exitcode is not None else -(event.signum or 0)
+            self.recorder.record(fuzzrec.EXIT, pid, status)
+        # Without ptrace, crashes are only seen once the process is dead
+        if isinstance(event, fuzzmon.ExitStatus) and event.signum in fuzzmon.crash_signals:
+            self.logger.warn("Process %d was killed by signal %d" % (event.pid, event.signum))
+            self._report_crash(event.pid, event.signum)
         if self.restart_delay >= 0:
-            self.logger.warn("Waiting %d seconds before restarting process" % self.restart_delay)
-            time.sleep(self.restart_delay)
+            self._stop_probe()
+            # Processes which die before ever being ready are restarted less and less often, up to restart_delay
+            if self.was_ready:
+                self.restart_backoff = 0
+            else:
+                self.restart_backoff = min(max(2 * self.restart_backoff, MIN_RESTART_DELAY), self.restart_delay)
+            if self.restart_backoff > 0:
+                self.logger.warn("Waiting %.1f seconds before restarting process" % self.restart_backoff)
+                time.sleep(self.restart_backoff)
             try:
                 process = self.debugger.spawn_traced_process()
                 self.logger.warn("Spawned new target process: %d" % process.pid)
+                if self.recorder is not None:
+                    self.recorder.record(fuzzrec.RESTART, process.pid)
+                if self.metrics is not None:
+                    self.metrics.inc("restarts")
+                self.was_ready = False
+                self._start_probe()
             except IOError as ioe:
                 self.logger.fatal(ioe)
                 self._shutdown()
@@ -137,8 +328,10 @@ class DebuggingHooks(fuzznet.ProxyHooks):
             self._shutdown()
 
     def _shutdown(self):
+        # The proxy loop may still record and dump streams until it sees is_done: they are closed by close()
         self.debugger.stop()
         self.is_done = True
+        self._wakeup()
         self.logger.warn("Stopped debugger. Exiting now")
 
     def _ignore_ptrace_errors(self, func, *args, **kwargs):
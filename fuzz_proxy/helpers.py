@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import binascii
 import socket
 
 
 proto_table = dict(tcp=socket.SOCK_STREAM, udp=socket.SOCK_DGRAM)
+# Tables of bound sockets per family and type. IPv4 servers may also listen through a dual stack IPv6 socket
+proc_net_table = {(socket.AF_INET, socket.SOCK_STREAM): ("/proc/net/tcp", "/proc/net/tcp6"),
+                  (socket.AF_INET, socket.SOCK_DGRAM): ("/proc/net/udp", "/proc/net/udp6"),
+                  (socket.AF_INET6, socket.SOCK_STREAM): ("/proc/net/tcp6",),
+                  (socket.AF_INET6, socket.SOCK_DGRAM): ("/proc/net/udp6",),
+                  (socket.AF_UNIX, socket.SOCK_STREAM): ("/proc/net/unix",),
+                  (socket.AF_UNIX, socket.SOCK_DGRAM): ("/proc/net/unix",)}
+TCP_LISTEN = "0A"
+UNIX_ACCEPTCON = 0x10000
 to_host = lambda x: x[0] if len(x) == 1 else x
+to_hex = lambda x: binascii.hexlify(x).decode("ascii")
 
 
 def socket_type(str_):
@@ -26,6 +37,35 @@ def socket_type(str_):
     return family, proto, info
 
 
+def is_listening(family, type_, address):
+    """ Whether a local socket is bound to address, and listening for stream sockets. It reads /proc/net, so that
+    the server does not see probe connections. Unix Domain Sockets addresses are a path, or a tuple of it as given
+    by socket_type. Returns None when this is not supported
+    """
+    if family == socket.AF_UNIX and not isinstance(address, tuple):
+        address = (address,)
+    try:
+        tables = proc_net_table[(family, type_)]
+    except KeyError:
+        return None
+    for table in tables:
+        try:
+            with open(table, "r") as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            return None
+        for line in lines:
+            fields = line.split()
+            if family == socket.AF_UNIX:
+                if len(fields) == 8 and fields[7] == address[0] and \
+                        (type_ != socket.SOCK_STREAM or int(fields[3], 16) & UNIX_ACCEPTCON):
+                    return True
+            elif int(fields[1].rsplit(":", 1)[1], 16) == address[1] and \
+                    (type_ != socket.SOCK_STREAM or fields[3] == TCP_LISTEN):
+                return True
+    return False
+
+
 class Dequeue(object):
     """ Python collections.deque only supports Hashable entries
     Quick version backed by a list which supports any type of object
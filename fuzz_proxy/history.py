@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import tempfile
+
+
+class Packet(object):
+    __slots__ = ("direction", "offset", "length", "original_length", "is_spilled")
+
+    def __init__(self):
+        self.direction = None
+        self.offset = 0
+        self.length = 0
+        self.original_length = 0
+        self.is_spilled = False
+
+
+class SpillFile(object):
+    """ Append-only file holding the packets too big for the in-memory arenas. It is only read back, through mmap,
+    when a crash report is built
+    """
+
+    def __init__(self, max_size=256 << 20):
+        self.file_ = tempfile.TemporaryFile()
+        self.max_size = max_size
+        self.size = 0
+        # Bytes still referenced when the file was last compacted
+        self.live_size = 0
+        self.mmap = None
+
+    def append(self, data):
+        offset = self.size
+        self.file_.write(data)
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        if self.mmap is None or len(self.mmap) < offset + length:
+            self.file_.flush()
+            if self.mmap is not None:
+                self.mmap.close()
+            self.mmap = mmap.mmap(self.file_.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.mmap[offset:offset + length]
+
+    def needs_compaction(self):
+        # At least half of the file was appended since the last compaction, so that live packets are not copied
+        # again on every append once they exceed max_size
+        return self.size > max(self.max_size, 2 * self.live_size)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file_.close()
+
+
+class Stream(object):
+    """ A stream slot. Packets are copied into a byte arena used as a ring buffer, and described by a fixed ring of
+    Packet records, so that recording a packet allocates nothing once the slot is warm
+    """
+
+    __slots__ = ("channel", "stream_id", "last_upstream_time", "arena", "packets", "first", "count", "head",
+                 "can_grow", "spill", "spill_threshold", "max_pkt_size", "prev", "next")
+
+    def __init__(self, arena_size, max_pkts, can_grow=True, spill=None, spill_threshold=None, max_pkt_size=None):
+        self.channel = None
+        self.stream_id = -1
+        self.last_upstream_time = None
+        self.arena = bytearray(arena_size)
+        self.packets = [Packet() for _ in range(max_pkts)]
+        self.first = 0
+        self.count = 0
+        self.head = 0
+        # Packets bigger than spill_threshold go to the spill file, and packets bigger than max_pkt_size are
+        # truncated. Without growth, packets bigger than the arena are truncated to its size
+        self.can_grow = can_grow
+        self.spill = spill
+        self.spill_threshold = spill_threshold
+        self.max_pkt_size = max_pkt_size
+        # Links in the recency list of StreamHistory
+        self.prev = None
+        self.next = None
+
+    def reset(self, channel, stream_id):
+        self.channel = channel
+        self.stream_id = stream_id
+        self.last_upstream_time = None
+        self.first = 0
+        self.count = 0
+        self.head = 0
+
+    def append(self, direction, data):
+        original_length = len(data)
+        if self.max_pkt_size is not None and original_length > self.max_pkt_size:
+            data = data[:self.max_pkt_size]
+        if self.count == len(self.packets):
+            self._evict()
+        if self.spill is not None and len(data) > self.spill_threshold:
+            packet = self._next_packet(direction, data, original_length)
+            packet.offset = self.spill.append(data)
+            packet.is_spilled = True
+            return
+        if len(data) > len(self.arena):
+            if self.can_grow:
+                self._grow(len(data))
+            else:
+                data = data[:len(self.arena)]
+        size = len(data)
+        offset = self.head
+        # Arena bytes used up from the head: the end of the arena is skipped when the packet does not fit there
+        used = size
+        if offset + size > len(self.arena):
+            offset = 0
+            used += len(self.arena) - self.head
+        # Packets are written in arena order, so that the overwritten ones are the oldest, and are dropped from the
+        # front of the ring. Packets without arena bytes, spilled or empty, are dropped along with the next one
+        skipped = 0
+        while skipped < self.count:
+            packet = self.packets[(self.first + skipped) % len(self.packets)]
+            if packet.is_spilled or packet.length == 0:
+                skipped += 1
+            elif (packet.offset - self.head) % len(self.arena) < used:
+                for _ in range(skipped + 1):
+                    self._evict()
+                skipped = 0
+            else:
+                break
+        if self.count == 0:
+            offset = 0
+        self.arena[offset:offset + size] = data
+        packet = self._next_packet(direction, data, original_length)
+        packet.offset = offset
+        self.head = offset + size
+
+    def __iter__(self):
+        """ Yields (direction, data) for each packet, followed by the original length for truncated packets
+        """
+        for packet in self._live_packets():
+            if packet.is_spilled:
+                data = self.spill.read(packet.offset, packet.length)
+            else:
+                data = bytes(self.arena[packet.offset:packet.offset + packet.length])
+            if packet.original_length != packet.length:
+                yield packet.direction, data, packet.original_length
+            else:
+                yield packet.direction, data
+
+    def _next_packet(self, direction, data, original_length):
+        packet = self.packets[(self.first + self.count) % len(self.packets)]
+        packet.direction = direction
+        packet.length = len(data)
+        packet.original_length = original_length
+        packet.is_spilled = False
+        self.count += 1
+        return packet
+
+    def _live_packets(self):
+        for i in range(self.count):
+            yield self.packets[(self.first + i) % len(self.packets)]
+
+    def __len__(self):
+        return self.count
+
+    def _evict(self):
+        self.first = (self.first + 1) % len(self.packets)
+        self.count -= 1
+
+    def _grow(self, size):
+        """ Only happens for packets bigger than the whole arena. Live packets are compacted at the start of the new
+        arena
+        """
+        arena = bytearray(max(2 * len(self.arena), 2 * size))
+        offset = 0
+        for packet in self._live_packets():
+            if packet.is_spilled:
+                continue
+            arena[offset:offset + packet.length] = self.arena[packet.offset:packet.offset + packet.length]
+            packet.offset = offset
+            offset += packet.length
+        self.arena = arena
+        self.head = offset
+
+
+class StreamHistory(object):
+    """ Last max_streams streams seen by the proxy, indexed by channel. Stream slots are allocated once and recycled
+    in least recently used order.
+    With a memory_budget, the arenas of all streams share that many bytes and never grow. Packets bigger than
+    spill_threshold are moved to a SpillFile, and packets bigger than max_pkt_size are truncated
+    """
+
+    def __init__(self, max_streams=10, max_pkts_per_stream=10, arena_size=64 * 1024, memory_budget=None,
+                 spill_threshold=None, max_pkt_size=None):
+        if max_streams <= 0 or max_pkts_per_stream <= 0:
+            raise ValueError("max_streams and max_pkts_per_stream must be positive")
+        if memory_budget is not None:
+            arena_size = memory_budget // max_streams
+            if arena_size <= 0:
+                raise ValueError("memory_budget is too small for %d streams" % max_streams)
+        self.streams = {}
+        self.spill = SpillFile() if spill_threshold is not None else None
+        # Circular doubly linked list of slots, from least to most recently used. Unused slots come first
+        self.sentinel = Stream(0, 1)
+        self.sentinel.prev = self.sentinel.next = self.sentinel
+        for _ in range(max_streams):
+            self._link_last(Stream(arena_size, max_pkts_per_stream, memory_budget is None, self.spill,
+                                   spill_threshold, max_pkt_size))
+        # First stream will get id 0
+        self.stream_counter = -1
+
+    def get(self, channel):
+        return self.streams.get(channel)
+
+    def record(self, channel, direction, data):
+        stream = self.streams.get(channel)
+        if stream is None:
+            stream = self.sentinel.next
+            if stream.channel is not None:
+                del self.streams[stream.channel]
+            self.stream_counter += 1
+            stream.reset(channel, self.stream_counter)
+            self.streams[channel] = stream
+        self._unlink(stream)
+        self._link_last(stream)
+        stream.append(direction, data)
+        if self.spill is not None and self.spill.needs_compaction():
+            self._compact_spill()
+        return stream
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+    def __iter__(self):
+        """ Live streams, from least to most recently used
+        """
+        stream = self.sentinel.next
+        while stream is not self.sentinel:
+            if stream.channel is not None:
+                yield stream
+            stream = stream.next
+
+    def __len__(self):
+        return len(self.streams)
+
+    def _compact_spill(self):
+        """ Copies the spilled packets still referenced by a stream to a new spill file, and drops the old one
+        """
+        spill = SpillFile(self.spill.max_size)
+        for stream in self:
+            for packet in stream._live_packets():
+                if packet.is_spilled:
+                    packet.offset = spill.append(self.spill.read(packet.offset, packet.length))
+        spill.live_size = spill.size
+        self.spill.close()
+        self.spill = spill
+        stream = self.sentinel.next
+        while stream is not self.sentinel:
+            stream.spill = spill
+            stream = stream.next
+
+    def _unlink(self, stream):
+        stream.prev.next = stream.next
+        stream.next.prev = stream.prev
+
+    def _link_last(self, stream):
+        stream.prev = self.sentinel.prev
+        stream.next = self.sentinel
+        self.sentinel.prev.next = stream
+        self.sentinel.prev = stream
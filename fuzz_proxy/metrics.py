@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import threading
+import time
+
+import fuzz_proxy.helpers as fuzzhelp
+
+# Upper bounds of latency buckets, in seconds: powers of 2 from 1 microsecond to about 17 seconds
+LATENCY_BOUNDS = tuple(1e-6 * 2 ** i for i in range(25))
+# How often the snapshot file is written
+SNAPSHOT_INTERVAL = 5
+# How long a stats client is given to send its request
+REQUEST_TIMEOUT = 0.2
+# Clock of latencies
+timer = getattr(time, "perf_counter", time.time)
+
+
+class Histogram(object):
+    """ Counts of values per fixed bucket. A value goes to the first bucket whose upper bound it does not exceed, or
+    to the overflow bucket
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile, or the largest value for the overflow bucket
+        """
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0.0
+
+    def to_dict(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                # Only buckets which hold values, by upper bound
+                "buckets": dict(("%g" % (self.bounds[i] if i < len(self.bounds) else float("inf")), count)
+                                for i, count in enumerate(self.counts) if count)}
+
+
+class Metrics(object):
+    """ Counters and latency histograms of a session. They are updated without locks: each of them is mostly
+    updated by a single thread, and a rare lost update is the price of keeping the forwarding path cheap
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def snapshot(self, previous=None):
+        """ Counters and histograms as a dict, along with the rate of each counter since the previous snapshot, or
+        since the start of the session
+        """
+        now = time.time()
+        counters = dict(self.counters)
+        previous_time = self.start_time if previous is None else previous["time"]
+        previous_counters = {} if previous is None else previous["counters"]
+        elapsed = max(now - previous_time, 1e-6)
+        return {"time": now,
+                "uptime": now - self.start_time,
+                "counters": counters,
+                "rates": dict((name, (value - previous_counters.get(name, 0)) / elapsed)
+                              for name, value in counters.items()),
+                "histograms": dict((name, histogram.to_dict()) for name, histogram in list(self.histograms.items()))}
+
+
+class MetricsReporter(object):
+    """ Exposes the metrics from a background thread: as JSON on a local stats socket, to which plain clients and
+    HTTP clients can connect, and as a JSON snapshot file written every interval seconds. Rates are computed since
+    the previous snapshot file, or the start of the session
+    """
+
+    def __init__(self, metrics, address=None, path=None, interval=SNAPSHOT_INTERVAL):
+        self.metrics = metrics
+        # (family, type, address) of the stats socket
+        self.address = address
+        self.path = path
+        self.interval = interval
+        self.server_socket = None
+        self.last_snapshot = None
+        self.is_running = False
+        self.thread = None
+        self.logger = logging.getLogger("MetricsReporter")
+
+    def start(self):
+        if self.address is not None:
+            family, _, address = self.address
+            self.server_socket = socket.socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_UNIX:
+                self._remove_stale_socket(address[0])
+            else:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind(fuzzhelp.to_host(address))
+            self.server_socket.listen(8)
+        self.is_running = True
+        self.thread = threading.Thread(target=self._report)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.thread is not None:
+            self.thread.join()
+        if self.server_socket is not None:
+            self.server_socket.close()
+            if self.address[0] == socket.AF_UNIX:
+                self._remove_stale_socket(self.address[2][0])
+        # The file ends up with the figures of the whole session
+        self._write_snapshot()
+
+    def _report(self):
+        next_write = time.time() + self.interval
+        while self.is_running:
+            # Woken up regularly so that stop() does not wait for a full interval
+            timeout = max(0, min(next_write - time.time(), 0.5))
+            if self.server_socket is not None:
+                readable = select.select([self.server_socket], [], [], timeout)[0]
+                if readable:
+                    self._serve_client()
+            else:
+                time.sleep(timeout)
+            if time.time() >= next_write:
+                self._write_snapshot()
+                next_write = time.time() + self.interval
+
+    def _serve_client(self):
+        try:
+            client, _ = self.server_socket.accept()
+        except socket.error as se:
+            self.logger.debug("Failed to accept stats client: %s" % se)
+            return
+        try:
+            client.settimeout(REQUEST_TIMEOUT)
+            try:
+                request = client.recv(4096)
+            except socket.timeout:
+                request = b""
+            body = json.dumps(self.metrics.snapshot(self.last_snapshot), indent=4, sort_keys=True).encode("utf-8")
+            if request.startswith(b"GET "):
+                header = "HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body)
+                body = header.encode("ascii") + body
+            client.sendall(body)
+        except socket.error as se:
+            self.logger.debug("Failed to send metrics to stats client: %s" % se)
+        finally:
+            client.close()
+
+    def _write_snapshot(self):
+        if self.path is None:
+            return
+        self.last_snapshot = self.metrics.snapshot(self.last_snapshot)
+        # Written aside and renamed, so that readers never see a partial snapshot
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.last_snapshot, f, indent=4, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to write metrics to %s: %s" % (self.path, e))
+
+    def _remove_stale_socket(self, path):
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
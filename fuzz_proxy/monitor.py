@@ -1,25 +1,106 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import hashlib
 import json
 import logging
 import os
-import re
+import select
 import signal
+import struct
 import subprocess
+import threading
 import time
 
+from ptrace.binding import ptrace_cont, ptrace_detach
+from ptrace.cpu_info import CPU_WORD_SIZE, CPU_X86_64
+from ptrace.ctypes_tools import formatAddress, formatWordHex
 import ptrace.debugger as pdbg
+import ptrace.disasm as pdisasm
+from ptrace.disasm import HAS_DISASSEMBLER
 import ptrace.error as perror
 import ptrace.signames
+from ptrace.syscall import SYSCALL_NAMES
+
+import fuzz_proxy.helpers as fuzzhelp
+from fuzz_proxy.metrics import timer
+from fuzz_proxy.recorder import FlightRecorder
+import fuzz_proxy.symbols as fuzzsym
 
 crash_signals = (signal.SIGILL, signal.SIGABRT, signal.SIGFPE, signal.SIGBUS, signal.SIGSEGV, signal.SIGSYS)
 
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+WORD_FORMAT = "<Q" if CPU_WORD_SIZE == 8 else "<I"
+CPU_MAX_UINT = (1 << (8 * CPU_WORD_SIZE)) - 1
+
+SYSCALL_NUMBERS = dict((name, number) for number, name in SYSCALL_NAMES.items())
+CLONE_PTRACE = 0x00002000
+CLONE_PARENT = 0x00008000
+# Size of the syscall instruction, executed again to restart a syscall
+SYSCALL_INSTR_SIZE = 2
+# pidfd_open() only exists on Linux >= 5.3 with Python >= 3.9
+HAS_PIDFD = hasattr(os, "pidfd_open")
+
+
+def scan_processes():
+    """ Parent pid and name of every process, from a single pass over /proc
+    """
+    table = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry, "r") as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The name is between parentheses, and may itself hold spaces and parentheses
+        end = stat.rindex(")")
+        table[int(entry)] = (int(stat[end + 2:].split()[1]), stat[stat.index("(") + 1:end])
+    return table
+
 
-def get_pids(name):
-    pgrep = ("pgrep", name)
-    pid = subprocess.Popen(pgrep, stdout=subprocess.PIPE).communicate()[0]
-    return list(map(int, pid.split()))
+def is_running(pid):
+    """ Whether process pid exists, and is not a zombie waiting to be reaped
+    """
+    if pid is None:
+        return False
+    try:
+        with open("/proc/%s/stat" % pid, "r") as f:
+            stat = f.read()
+    except IOError:
+        return False
+    return stat[stat.rindex(")") + 2] not in "ZXx"
+
+
+def get_pids(name, table=None):
+    if table is None:
+        table = scan_processes()
+    # The kernel truncates names to 15 characters
+    return sorted(pid for pid, (_, comm) in table.items() if comm == name[:15])
+
+
+def get_root_pids(name, table=None):
+    """ Processes named name whose parent has another name, such as the master process of a prefork server
+    """
+    if table is None:
+        table = scan_processes()
+    pids = set(get_pids(name, table))
+    return sorted(pid for pid in pids if table[pid][0] not in pids)
+
+
+def get_process_tree(pid, table=None):
+    """ pid and all its descendants, parents first
+    """
+    if table is None:
+        table = scan_processes()
+    children = collections.defaultdict(list)
+    for child_pid, (ppid, _) in table.items():
+        children[ppid].append(child_pid)
+    tree = [pid]
+    for parent_pid in tree:
+        tree.extend(sorted(children[parent_pid]))
+    return tree
 
 
 def get_pid_command(pid):
@@ -32,43 +113,228 @@ def get_pid_command(pid):
     return cmdline
 
 
+class ForkServer(object):
+    """ Runs the target once up to a ready point, the entry of its first ready_syscall, such as listen() or accept(),
+    and keeps it stopped there as a snapshot. Instances are cloned from the snapshot by injecting a clone() syscall
+    in it, and start by running the ready syscall again. With a standby, the next instance is cloned ahead of time
+    and kept stopped until the running one dies. Only supported on x86_64
+    """
+
+    def __init__(self, debugger, snapshot, ready_syscall, standby=False):
+        if not CPU_X86_64:
+            raise NotImplementedError("Fork server is only supported on x86_64")
+        if ready_syscall not in SYSCALL_NUMBERS:
+            raise ValueError("Unknown syscall: %s" % ready_syscall)
+        self.debugger = debugger
+        self.snapshot = snapshot
+        self.ready_syscall = ready_syscall
+        self.use_standby = standby
+        self.standby = None
+        self.logger = logging.getLogger("ForkServer")
+        self.regs = self._run_to_ready_point()
+        self.logger.info("Process %d reached %s(), using it as snapshot" % (snapshot.pid, ready_syscall))
+
+    def spawn(self):
+        """ Returns a new running instance
+        """
+        process, self.standby = self.standby, None
+        if process is None:
+            process = self._clone()
+        process.cont()
+        if self.use_standby:
+            self.standby = self._clone()
+        return process
+
+    def close(self):
+        # Stopped tracees resume when their tracer exits, so they are killed rather than detached. Unlike ptrace
+        # requests, kill() works from any thread
+        for process in (self.standby, self.snapshot):
+            if process is not None:
+                try:
+                    os.kill(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self.standby = None
+
+    def _run_to_ready_point(self):
+        number = SYSCALL_NUMBERS[self.ready_syscall]
+        is_entry = True
+        while True:
+            self._wait_syscall()
+            regs = self.snapshot.getregs()
+            if is_entry and regs.orig_rax == number:
+                return regs
+            is_entry = not is_entry
+
+    def _wait_syscall(self):
+        """ Resumes the snapshot up to its next syscall stop. Signals received on the way are discarded, since the
+        snapshot must not change state
+        """
+        self.snapshot.syscall()
+        while True:
+            try:
+                return self.debugger.waitSyscall(self.snapshot)
+            except pdbg.ProcessSignal as ps:
+                self.logger.debug("Discarding signal %d received by snapshot" % ps.signum)
+                self.snapshot.syscall()
+            except pdbg.NewProcessEvent:
+                # Only happens when forks are traced, in which case the clone is already registered
+                self.snapshot.syscall()
+
+    def _clone(self):
+        regs = self._copy_regs()
+        regs.orig_rax = SYSCALL_NUMBERS["clone"]
+        # The instance is traced from its first instruction, and is a child of fuzzmon which can then reap it
+        regs.rdi = signal.SIGCHLD | CLONE_PTRACE | CLONE_PARENT
+        regs.rsi = regs.rdx = regs.r10 = regs.r8 = 0
+        self.snapshot.setregs(regs)
+        self._wait_syscall()
+        pid = self.snapshot.getregs().rax
+        # Back to the entry of the ready syscall
+        self.snapshot.setregs(self._restart_regs())
+        self._wait_syscall()
+        if pid > CPU_MAX_UINT >> 1:
+            raise IOError("Failed to clone snapshot: %s" % os.strerror(CPU_MAX_UINT + 1 - pid))
+        process = self.debugger.dict.get(pid)
+        if process is None:
+            process = self.debugger.addProcess(pid, is_attached=True)
+        process.setregs(self._restart_regs())
+        self.logger.info("Cloned process %d from snapshot" % pid)
+        return process
+
+    def _copy_regs(self):
+        return type(self.regs).from_buffer_copy(self.regs)
+
+    def _restart_regs(self):
+        regs = self._copy_regs()
+        regs.rip -= SYSCALL_INSTR_SIZE
+        regs.rax = regs.orig_rax
+        return regs
+
+
 class PtraceDbg(pdbg.Application):
+    """ Runs the program, or attaches to a running process tree, and traces it. Processes are indexed by pid. Only
+    the root process is restarted when it dies: children, when forks are traced, are just forgotten
+    """
 
     def __init__(self, options):
         self.options = options
         self.program = self.options.program
-        self.processes = []
+        self.processes = {}
+        self.root_pid = None
         self.processOptions()
         self.debugger = pdbg.debugger.PtraceDebugger()
         self.setupDebugger()
         self.is_running = False
+        self.thread = None
+        # Pid or name of the running process to attach to, instead of running the program
+        self.attach_pid = getattr(options, "pid", None)
+        self.attach_name = getattr(options, "attach", None)
+        self.is_attach_mode = self.attach_pid is not None or self.attach_name is not None
+        # Syscall at which the target is snapshotted, when restarting it through a fork server
+        self.ready_syscall = getattr(options, "fork_server", None)
+        self.standby = getattr(options, "standby", False)
+        self.fork_server = None
+        # Counts events and times their callbacks, when set
+        self.metrics = None
         self.logger = logging.getLogger("PtraceDbg")
         super(PtraceDbg, self).__init__()
 
     def spawn_traced_process(self):
+        if self.is_attach_mode:
+            if self.root_pid is not None:
+                raise IOError("Attached process %d died, and cannot be restarted" % self.root_pid)
+            process = self._attach_tree()
+        elif self.ready_syscall is None:
+            process = self._create_traced_process()
+            process.cont()
+        else:
+            try:
+                if self.fork_server is None:
+                    self.fork_server = ForkServer(self.debugger, self._create_traced_process(), self.ready_syscall,
+                                                  self.standby)
+                process = self.fork_server.spawn()
+            except (pdbg.ProcessEvent, perror.PtraceError) as e:
+                raise IOError("Failed to spawn process from snapshot: %s" % e)
+        self.logger.info("Moving process to running state: %d" % process.pid)
+        self.root_pid = process.pid
+        self.processes[process.pid] = process
+        return process
+
+    def _create_traced_process(self):
         try:
             process = self.createProcess()
         except pdbg.child.ChildError as ce:
             raise IOError("Failed to create traced process: %s => %s" % (" ".join(self.program), ce))
+        if process is None:
+            raise IOError("Failed to trace process: %s" % " ".join(self.program))
         self.logger.info("Successfully attached to process: %d" % process.pid)
-        process.cont()
-        self.logger.info("Moving process to running state: %d" % process.pid)
-        self.processes.append(process)
         return process
 
+    def _attach_tree(self):
+        """ Attaches to the process to monitor, and to all its descendants when forks are traced, from a single scan
+        of /proc. Returns the running root process
+        """
+        table = scan_processes()
+        pid = self.attach_pid
+        if pid is None:
+            roots = get_root_pids(self.attach_name, table)
+            if len(roots) != 1:
+                raise IOError("Expected a single process tree named %s, found %d" % (self.attach_name, len(roots)))
+            pid = roots[0]
+        pids = get_process_tree(pid, table) if self.options.fork else [pid]
+        attached = []
+        for child_pid in pids:
+            try:
+                attached.append(self.debugger.addProcess(child_pid, is_attached=False))
+            except (pdbg.ProcessEvent, perror.PtraceError) as e:
+                if child_pid == pid:
+                    raise IOError("Failed to attach to process %d: %s" % (pid, e))
+                # Children may exit while the tree is attached
+                self.logger.warn("Failed to attach to child process %d: %s" % (child_pid, e))
+        for process in attached:
+            self.processes[process.pid] = process
+            process.cont()
+        self.logger.info("Attached to %d processes of tree %d" % (len(attached), pid))
+        return attached[0]
+
     def stop(self):
-        for process in self.processes:
+        """ Kills spawned processes, or detaches from attached ones. Ptrace requests only work from the debugger
+        thread, so when called from another one, the debugger thread is woken up with a signal and cleans up
+        """
+        self.is_running = False
+        if self.fork_server is not None:
+            self.fork_server.close()
+        if threading.current_thread() is self.thread:
+            return
+        for pid in list(self.processes):
             try:
-                process.detach()
-                self.processes.remove(process)
-                self.logger.warn("Detached from process: %d" % process.pid)
-                process.terminate()
-                self.logger.warn("Terminated process: %d" % process.pid)
-            except perror.PtraceError:
+                if not self.is_attach_mode:
+                    os.kill(pid, signal.SIGKILL)
+                elif pid == self.root_pid:
+                    os.kill(pid, signal.SIGSTOP)
+            except OSError:
                 pass
-        self.is_running = False
+
+    def _release(self):
+        for pid, process in list(self.processes.items()):
+            try:
+                if self.is_attach_mode:
+                    if not process.is_stopped:
+                        process.kill(signal.SIGSTOP)
+                        process.waitSignals(signal.SIGSTOP)
+                    ptrace_detach(pid)
+                    self.debugger.deleteProcess(process)
+                    self.logger.warn("Detached from process: %d" % pid)
+                else:
+                    process.terminate()
+                    self.logger.warn("Terminated process: %d" % pid)
+            except (pdbg.ProcessEvent, perror.PtraceError, OSError):
+                pass
+        self.processes.clear()
 
     def watch(self, on_signal, on_event, on_exit):
+        self.thread = threading.current_thread()
         # Spawning of tracee MUST be done in same thread as event waitProcessEvent() on Linux
         try:
             self.spawn_traced_process()
@@ -80,16 +346,40 @@ class PtraceDbg(pdbg.Application):
             return
         self.is_running = True
         self.logger.info("Debugger entered event monitoring loop")
-        while self.is_running and self.processes != []:
+        while self.is_running and self.processes:
             try:
-                event = self.debugger.waitProcessEvent()
+                event = self._wait_event()
             except OSError as oe:
                 self.logger.fatal("Debugger event loop failed: %s" % oe)
-                self.stop()
-                return
+                break
+            if not self.is_running:
+                # Woken up by stop()
+                break
             process = event.process
+            if self.metrics is not None:
+                self.metrics.inc("debugger.events")
+            if event.__class__ == pdbg.ProcessSignal and event.signum not in crash_signals:
+                # Fast path for the signals of the normal life of the target, such as SIGALRM or SIGCHLD
+                try:
+                    process.cont(event.signum)
+                    continue
+                except perror.PtraceError:
+                    pass
+            elif event.__class__ == pdbg.NewProcessEvent:
+                # Both the parent and its new child are stopped
+                self.processes[process.pid] = process
+                self._ignore_ptrace_errors(process.parent.cont)
+                self._ignore_ptrace_errors(process.cont)
+                continue
+            elif event.__class__ == pdbg.ProcessExecution:
+                self._ignore_ptrace_errors(process.cont)
+                continue
             self.logger.info("Caught event on process: %d => \"%s\". Dispatching to callback" % (process.pid, event))
-            if event.__class__ == pdbg.ProcessSignal:
+            start = timer()
+            if event.__class__ == pdbg.ProcessExit and process.pid != self.root_pid:
+                self.processes.pop(process.pid, None)
+                self.logger.info("Child process exited: %d" % process.pid)
+            elif event.__class__ == pdbg.ProcessSignal:
                 on_signal(event)
             elif event.__class__ == pdbg.ProcessEvent:
                 on_event(event)
@@ -97,24 +387,147 @@ class PtraceDbg(pdbg.Application):
                 on_exit(event)
             else:
                 raise RuntimeError("Unexpected process event: %s" % event)
-            if not process.is_attached:
-                try:
-                    self.processes.remove(process)
-                    self.logger.info("Detected process as dead: %d" % process.pid)
-                except ValueError:
-                    pass
+            if self.metrics is not None:
+                self.metrics.observe("debugger.callback", timer() - start)
+            if not process.is_attached and self.processes.pop(process.pid, None) is not None:
+                self.logger.info("Detected process as dead: %d" % process.pid)
         self.logger.info("Debugger exiting event monitoring loop")
+        self._release()
+        self.is_running = False
+
+    def _wait_event(self):
+        # python-ptrace polls each process in turn when it traces several of them, which adds up to half a second of
+        # latency. Children of forking servers, and the snapshot and standby of the fork server, are all waited for
+        # at once instead
+        if len(self.debugger.dict) <= 1:
+            return self.debugger.waitProcessEvent()
+        while True:
+            pid, status = os.waitpid(-1, 0)
+            process = self.debugger.dict.get(pid)
+            if process is not None:
+                return process.processStatus(status)
+            if os.WIFSTOPPED(status):
+                # A new child may report its first stop before its parent reports the fork. python-ptrace waits for
+                # that stop when handling the fork event, so it is raised again
+                ptrace_cont(pid, os.WSTOPSIG(status))
+
+    def _ignore_ptrace_errors(self, func, *args):
+        try:
+            func(*args)
+        except perror.PtraceError as pe:
+            self.logger.warn("Failed to resume process: %s" % pe)
+
+
+class ExitStatus(object):
+    """ End of a process monitored by ExitMonitor. signum is the signal which killed it, or None
+    """
+
+    def __init__(self, pid, returncode):
+        self.pid = pid
+        self.exitcode = returncode if returncode >= 0 else None
+        self.signum = -returncode if returncode < 0 else None
+
+    def __str__(self):
+        if self.signum is not None:
+            return "Process %d killed by signal %s" % (self.pid, ptrace.signames.signalName(self.signum))
+        return "Process %d exited with code %d" % (self.pid, self.exitcode)
+
+
+class ExitMonitor(object):
+    """ Crash-only alternative to PtraceDbg. The target runs untraced, at full speed, and crashes are detected from
+    its exit status. on_exit() gets an ExitStatus, and on_signal() and on_event() are never called. Crash reports then
+    only hold the signal, since the process is gone before anything can be read from it
+    """
+
+    # How often a wait on a pidfd checks whether the monitor was stopped
+    WAIT_TIMEOUT = 0.5
+
+    def __init__(self, options):
+        self.program = options.program
+        self.no_stdout = getattr(options, "no_stdout", False)
+        self.processes = []
+        self.is_running = False
+        self.logger = logging.getLogger("ExitMonitor")
+
+    def spawn_traced_process(self):
+        output = None
+        if self.no_stdout:
+            output = open(os.devnull, "wb")
+        try:
+            process = subprocess.Popen(self.program, stdout=output, stderr=output)
+        except OSError as oe:
+            raise IOError("Failed to create process: %s => %s" % (" ".join(self.program), oe))
+        finally:
+            if output is not None:
+                output.close()
+        self.logger.info("Started process: %d" % process.pid)
+        self.processes.append(process)
+        return process
+
+    def stop(self):
+        self.is_running = False
+        for process in self.processes:
+            try:
+                process.terminate()
+                self.logger.warn("Terminated process: %d" % process.pid)
+            except OSError:
+                pass
+
+    def watch(self, on_signal, on_event, on_exit):
+        try:
+            self.spawn_traced_process()
+        except IOError as ioe:
+            self.logger.fatal(ioe)
+            os.kill(os.getpid(), signal.SIGINT)
+            return
+        self.is_running = True
+        self.logger.info("Monitor entered exit monitoring loop")
+        while self.is_running and self.processes != []:
+            process = self.processes[0]
+            returncode = self._wait(process)
+            # Processes terminated by stop() are not restarted
+            if returncode is None or not self.is_running:
+                break
+            self.processes.remove(process)
+            event = ExitStatus(process.pid, returncode)
+            self.logger.info("Caught event on process: %d => \"%s\". Dispatching to callback" % (process.pid, event))
+            on_exit(event)
+        self.logger.info("Monitor exiting exit monitoring loop")
         self.is_running = False
 
+    def _wait(self, process):
+        """ Exit status of process, or None if the monitor is stopped first
+        """
+        if HAS_PIDFD:
+            try:
+                pidfd = os.pidfd_open(process.pid)
+            except OSError:
+                # Kernel without pidfd support
+                pidfd = None
+            if pidfd is not None:
+                try:
+                    while not select.select([pidfd], [], [], ExitMonitor.WAIT_TIMEOUT)[0]:
+                        if not self.is_running:
+                            return None
+                finally:
+                    os.close(pidfd)
+        return process.wait()
+
 
 class CrashReport(object):
+    """ Crash information is gathered in two stages. capture() runs on the debugger thread while the target is
+    stopped, and only copies raw state: registers, code bytes at the instruction pointer, a window of the stack and
+    the /proc/pid/maps text. enrich() formats all of it later, away from the debugger thread
+    """
 
-    # Matches
-    # 'MAPS: 0x00007fb7b25ae000-0x00007fb7b2730000 => /lib/x86_64-linux-gnu/libc-2.13.so (r-xp)'
-    # 'MAPS: 0x0000000000df5000-0x0000000000e16000 => [heap] (rwxp)'
-    # 'MAPS: 0x00007fb7b2b56000-0x00007fb7b2b59000 (rwxp)'
-    # Into start/stop address, binary, permissions
-    MAPS_REGEXP = "MAPS:\s(0x[0-9a-fA-F]+)-(0x[0-9a-fA-F]+)\s(?:=>\s)?(.*?)\s?\((.+)\)"
+    # Words logged around the stack pointer, and bytes of stack kept to walk the frame pointers
+    STACK_WORDS = 5
+    STACK_SIZE = 16 * 1024
+    # Enough code for DISASSEMBLY_INSTRS of the longest x86 instructions
+    DISASSEMBLY_INSTRS = 10
+    CODE_SIZE = DISASSEMBLY_INSTRS * 16
+    BACKTRACE_DEPTH = 20
+    BACKTRACE_ARGS = 6
 
     def __init__(self, sessid, pid, signum, stream_id):
         self.pid = pid
@@ -129,47 +542,255 @@ class CrashReport(object):
         self.maps = []
         self.stream = []
         self.history = []
-        self.regexp = re.compile(CrashReport.MAPS_REGEXP)
+        # Raw state, filled by capture()
+        self.raw_registers = []
+        self.ip = None
+        self.sp = None
+        self.fp = None
+        self.code = b""
+        self.stack_address = None
+        self.stack_bytes = b""
+        self.raw_maps = ""
+        # Packets as recorded, kept by enrich() for crash stores, which do not hex encode them
+        self.raw_stream = []
+        self.raw_history = []
+        # Snapshot of the flight recorder at the time of the crash, described by enrich()
+        self.events = []
+        # Filled by enrich(): the parsed maps, and the return address of each frame
+        self.layout = None
+        self.symbols = None
+        self.frames = []
 
-    def to_json(self, f):
-        json.dump({"session_id": self.sessid,
-                   "stream_count": self.stream_id,
-                   "pid": self.pid,
-                   "signal": self.signal,
-                   "time": self.time,
-                   "registers": self.registers,
-                   "backtrace": self.backtrace,
-                   "disassembly": self.disassembly,
-                   "maps": self.maps,
-                   "stack": self.stack,
-                   "stream": self.stream,
-                   "history": self.history},
-                  f,
-                  indent=4)
-
-    def dump_regs(self, str_):
+    def capture(self, process):
+        """ Copies the raw state of the stopped process. Must run on the debugger thread, and is kept to a few reads
+        """
+        regs = process.getregs()
+        self.raw_registers = [(name, getattr(regs, name)) for name, _ in regs._fields_]
+        self.ip = process.getInstrPointer()
+        self.sp = process.getStackPointer()
+        self.fp = process.getFramePointer()
+        self.code = self._read_clipped(process, self.ip, CrashReport.CODE_SIZE)
+        self.stack_address = self.sp - CrashReport.STACK_WORDS * CPU_WORD_SIZE
+        self.stack_bytes = self._read_clipped(process, self.stack_address, CrashReport.STACK_SIZE)
+        if not self.stack_bytes:
+            self.stack_address = self.sp
+            self.stack_bytes = self._read_clipped(process, self.sp, CrashReport.STACK_SIZE)
         try:
-            reg, val = list(map(lambda x: x.strip(), str_.split("=")))
-            self.registers[reg] = val
-        except ValueError:
+            with open("/proc/%d/maps" % self.pid, "r") as f:
+                self.raw_maps = f.read()
+        except IOError:
             pass
 
-    def dump_maps(self, str_):
+    def enrich(self, symbols=fuzzsym.default_cache):
+        """ Turns the raw state into the registers, maps, stack, backtrace and disassembly of the report. Symbols come
+        from a cache shared by the reports of the session
+        """
+        self.symbols = symbols
+        for name, value in self.raw_registers:
+            self.registers[name] = formatWordHex(value)
+        self.layout = fuzzsym.MapsLayout(self.raw_maps)
+        self.maps = self.layout.maps
+        if self.layout.stack is not None:
+            self.stack["STACK"] = self.layout.stack
+        self.events = FlightRecorder.describe(self.events)
+        self.raw_stream, self.raw_history = self.stream, self.history
+        self.stream = self._to_hex(self.stream)
+        self.history = [self._to_hex(stream) for stream in self.history]
+        if self.sp is None:
+            return
+        self._parse_stack()
+        self._parse_backtrace()
+        if HAS_DISASSEMBLER:
+            try:
+                for i, instr in enumerate(pdisasm.disassemble(self.code, self.ip)):
+                    if i >= CrashReport.DISASSEMBLY_INSTRS:
+                        break
+                    self.disassembly[hex(instr.address)] = instr.text
+            except (ValueError, perror.PtraceError):
+                # The code bytes may end in the middle of an instruction
+                pass
+
+    def relative_address(self, address):
+        """ Address as binary+offset, which does not change with ASLR. Anonymous mappings keep their absolute address
+        """
+        return self.layout.relative_address(address)
+
+    def signature(self, max_frames=5):
+        """ Stable identifier of the bug: signal, faulting pc and the next max_frames - 1 frames, relative to their
+        mapping. Crashes without a pc, as seen by ExitMonitor, are told apart by a digest of the last packet sent to
+        the target, which most likely triggered them. Must be called after enrich()
+        """
+        if self.ip is None:
+            packets = [pkt[1] for pkt in self.raw_stream if pkt[0] == "upstream"]
+            if not packets:
+                return "%s|unknown" % self.signal
+            return "%s|unknown|%s" % (self.signal, hashlib.sha1(packets[-1]).hexdigest()[:16])
+        addresses = [self.ip] + self.frames[1:max_frames]
+        return "|".join([self.signal] + [self.relative_address(a) for a in addresses])
+
+    def to_dict(self):
+        return collections.OrderedDict([("session_id", self.sessid),
+                                        ("stream_count", self.stream_id),
+                                        ("pid", self.pid),
+                                        ("signal", self.signal),
+                                        ("time", self.time),
+                                        ("registers", self.registers),
+                                        ("backtrace", self.backtrace),
+                                        ("disassembly", self.disassembly),
+                                        ("maps", self.maps),
+                                        ("stack", self.stack),
+                                        ("events", self.events),
+                                        ("stream", self.stream),
+                                        ("history", self.history)])
+
+    def to_json(self, f):
+        json.dump(self.to_dict(), f, indent=4)
+
+    def _to_hex(self, stream):
+        # Truncated packets carry their original length as a third element
+        return [(pkt[0], fuzzhelp.to_hex(pkt[1])) + tuple(pkt[2:]) for pkt in stream]
+
+    def _read_clipped(self, process, address, size):
+        """ Reads size bytes at address, or up to the end of the page if the next one is not mapped
+        """
         try:
-            start_addr, stop_addr, binary, perms = self.regexp.match(str_).groups()
-            self.maps.append(((start_addr, stop_addr), binary, perms))
-        except ValueError:
+            return process.readBytes(address, size)
+        except perror.PtraceError:
             pass
+        size = PAGE_SIZE - address % PAGE_SIZE
+        try:
+            return process.readBytes(address, size)
+        except perror.PtraceError:
+            return b""
+
+    def _read_word(self, address):
+        offset = address - self.stack_address
+        if offset < 0 or offset + CPU_WORD_SIZE > len(self.stack_bytes):
+            return None
+        return struct.unpack_from(WORD_FORMAT, self.stack_bytes, offset)[0]
+
+    def _parse_stack(self):
+        for index in range(-CrashReport.STACK_WORDS, CrashReport.STACK_WORDS + 1):
+            delta = index * CPU_WORD_SIZE
+            value = self._read_word(self.sp + delta)
+            if value is not None:
+                self.stack["STACK%+ 3i" % delta] = formatWordHex(value)
+
+    def _parse_backtrace(self):
+        """ Frame pointer walk over the captured stack. It stops at the end of the captured window
+        """
+        ip, fp = self.ip, self.fp
+        for _ in range(CrashReport.BACKTRACE_DEPTH):
+            nextfp = self._read_word(fp)
+            nargs = 0
+            if fp and nextfp:
+                nargs = min((nextfp - fp) // CPU_WORD_SIZE - 2, CrashReport.BACKTRACE_ARGS)
+            arguments = []
+            for index in range(nargs):
+                word = self._read_word(fp + (index + 2) * CPU_WORD_SIZE)
+                if word is None:
+                    break
+                arguments.append(word)
+            # Function name, or binary and offset, which do not change with ASLR
+            self.backtrace[hex(ip)] = (self.symbols.resolve(self.layout, ip), arguments)
+            self.frames.append(ip)
+            if not nextfp:
+                break
+            ip = self._read_word(fp + CPU_WORD_SIZE)
+            if ip is None or ip == CPU_MAX_UINT:
+                break
+            fp = nextfp
+
 
-    def dump_stack(self, str_):
+class CrashBuckets(object):
+    """ Groups crash reports by signature. Full reports are only written for the first max_reports crashes of a
+    bucket, in a folder named after it. Further crashes only update the counters of the bucket index, which is
+    flushed to buckets.json when a bucket or report is added, or after flush_interval seconds otherwise.
+
+    With a CrashStore, reports are appended to the store instead, under the name of the file they are exported to,
+    and the index is only flushed with the store, every flush_interval seconds
+    """
+
+    INDEX_FILE = "buckets.json"
+
+    def __init__(self, folder, max_reports=5, max_frames=5, flush_interval=10, store=None):
+        self.folder = folder
+        self.store = store
+        self.max_reports = max_reports
+        self.max_frames = max_frames
+        self.flush_interval = flush_interval
+        self.index_file = os.path.join(folder, CrashBuckets.INDEX_FILE)
+        self.buckets = {}
+        # Buckets of a previous run on the same folder keep counting
         try:
-            addr, val = list(map(lambda x: x.strip(), str_.split(":")))
-            self.stack[addr] = val
-        except ValueError:
+            with open(self.index_file, "r") as f:
+                self.buckets = json.load(f)
+        except (IOError, ValueError):
             pass
+        self.is_dirty = False
+        self.last_flush = time.time()
+        self.logger = logging.getLogger("CrashBuckets")
+
+    def add(self, crash_report):
+        """ Returns the bucket identifier, and the file holding the report, or to which it is exported from a store.
+        The file is None if the bucket is already full
+        """
+        signature = crash_report.signature(self.max_frames)
+        bucket_id = hashlib.sha1(signature.encode("utf-8")).hexdigest()[:16]
+        bucket = self.buckets.get(bucket_id)
+        is_new = bucket is None
+        if is_new:
+            bucket = {"signature": signature,
+                      "signal": crash_report.signal,
+                      "count": 0,
+                      "first_time": crash_report.time,
+                      "last_time": crash_report.time,
+                      "reports": []}
+            self.buckets[bucket_id] = bucket
+            self.logger.warn("New crash bucket %s: %s" % (bucket_id, signature))
+        bucket["count"] += 1
+        bucket["last_time"] = crash_report.time
+        crash_file_name = None
+        if len(bucket["reports"]) < self.max_reports:
+            # The count keeps reports of reused pids apart
+            name = os.path.join(bucket_id, "%d-%d.json" % (crash_report.pid, bucket["count"]))
+            crash_file_name = os.path.join(self.folder, name)
+            if self.store is not None:
+                self.logger.info("Appending crash information to store as: %s" % name)
+                self.store.add(crash_report, name)
+            else:
+                if not os.path.isdir(os.path.dirname(crash_file_name)):
+                    os.makedirs(os.path.dirname(crash_file_name))
+                self.logger.info("Dumping crash information to: %s" % crash_file_name)
+                with open(crash_file_name, "w") as f:
+                    crash_report.to_json(f)
+            bucket["reports"].append(name)
+        else:
+            self.logger.info("Crash %d of bucket %s not dumped" % (bucket["count"], bucket_id))
+        self.is_dirty = True
+        has_news = self.store is None and (is_new or crash_file_name is not None)
+        if has_news or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return bucket_id, crash_file_name
+
+    def flush(self):
+        # Reports are on disk before the index lists them
+        if self.store is not None:
+            self.store.flush()
+        if not self.is_dirty:
+            return
+        # Written aside and renamed, so that the index is never seen half written
+        tmp_file_name = self.index_file + ".tmp"
+        with open(tmp_file_name, "w") as f:
+            json.dump(self.buckets, f, indent=4, sort_keys=True)
+        os.rename(tmp_file_name, self.index_file)
+        self.is_dirty = False
+        self.last_flush = time.time()
 
-    def dump_backtrace(self, frame):
-        self.backtrace[hex(frame.ip)] = (frame.name, frame.arguments)
+    def close(self):
+        self.flush()
+        if self.store is not None:
+            self.store.close()
 
-    def dump_code(self, str_):
-        self.disassembly[hex(str_.address)] = str_.text
+    def __len__(self):
+        return len(self.buckets)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import binascii
+import collections
+import json
+import logging
+import os
+import random
+import struct
+import threading
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+from fuzz_proxy.network import StreamDirection
+
+BIT_FLIP, RANDOM_BYTE, INTERESTING_VALUE = range(3)
+# Values which often hit boundary conditions, stored with both byte orders
+INTERESTING_8 = (-128, -1, 0, 1, 16, 32, 64, 100, 127)
+INTERESTING_16 = (-32768, -129, 128, 255, 256, 512, 1000, 1024, 4096, 32767)
+INTERESTING_32 = (-2147483648, -100663046, -32769, 32768, 65535, 65536, 100663045, 2147483647)
+INTERESTING = {1: [struct.pack("b", v) for v in INTERESTING_8],
+               2: [struct.pack(e + "h", v) for v in INTERESTING_16 for e in "<>"],
+               4: [struct.pack(e + "i", v) for v in INTERESTING_32 for e in "<>"]}
+# Share of mutated packets which get the tail of a corpus entry spliced in
+SPLICE_RATIO = 0.1
+INT_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+LengthField = collections.namedtuple("LengthField", ["offset", "size", "byteorder", "delta"])
+
+
+def length_field(str_):
+    """ Parses offset:size[:big|little[:delta]] into a LengthField. The field holds the number of bytes which follow
+    it, plus delta
+    """
+    try:
+        fields = str_.split(":")
+        offset, size = int(fields[0], 0), int(fields[1], 0)
+        byteorder = {"big": ">", "little": "<"}[fields[2] if len(fields) > 2 else "big"]
+        delta = int(fields[3], 0) if len(fields) > 3 else 0
+        if size not in INT_FORMATS or offset < 0 or len(fields) > 4:
+            raise ValueError()
+    except (ValueError, KeyError, IndexError):
+        raise argparse.ArgumentTypeError("Invalid length field. Expecting offset:size[:big|little[:delta]], with a "
+                                         "size of 1, 2, 4 or 8")
+    return LengthField(offset, size, byteorder, delta)
+
+
+def load_stream(path):
+    """ Upstream packets of the stream of a crash report or test case
+    """
+    with open(path, "r") as f:
+        stream = json.load(f)["stream"]
+    return [binascii.unhexlify(pkt[1]) for pkt in stream if pkt[0] == StreamDirection.UPSTREAM]
+
+
+def load_corpus(path):
+    """ Packets of every file of a folder, or of a single file. Crash reports and test cases give their upstream
+    packets, other files their whole content
+    """
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    corpus = []
+    for file_path in paths:
+        if not os.path.isfile(file_path):
+            continue
+        try:
+            corpus.extend(load_stream(file_path))
+        except (ValueError, KeyError, TypeError, IndexError, UnicodeDecodeError):
+            with open(file_path, "rb") as f:
+                corpus.append(f.read())
+    return [packet for packet in corpus if packet]
+
+
+class Mutator(object):
+    """ Turns a seed stream into mutated streams, one per connection. The k-th upstream packet of a connection is
+    replaced by the k-th packet of its mutated stream, so that a client which sends the seed again and again gets a
+    new test case each time. When no seed is given, the first connection goes through untouched and becomes the seed.
+
+    Streams are generated ahead of time, in batches, by a background thread, into a queue of ready streams: the proxy
+    only pops one per new connection. Byte level mutations of a batch are vectorized with numpy when it is installed
+    """
+
+    def __init__(self, seed=None, corpus=(), length_fields=(), mutations=4, batch_size=256, max_ready=4096,
+                 max_channels=1024, random_seed=None):
+        self.seed = None
+        self.corpus = [bytes(packet) for packet in corpus]
+        self.length_fields = list(length_fields)
+        self.mutations = mutations
+        self.batch_size = batch_size
+        self.max_ready = max_ready
+        self.ready = collections.deque()
+        self.random = random.Random(random_seed)
+        self.rng = numpy.random.default_rng(random_seed) if HAS_NUMPY else None
+        # Generation happens on the background thread, or inline when the queue runs dry
+        self.generate_lock = threading.Lock()
+        self.condition = threading.Condition()
+        # Mutated stream of each connection, and the index of its next packet, oldest connection first
+        self.streams = collections.OrderedDict()
+        self.max_channels = max_channels
+        self.capture_channel = None
+        self.captured = []
+        self.generated = 0
+        self.is_running = False
+        self.thread = None
+        self.logger = logging.getLogger("Mutator")
+        if seed:
+            self._set_seed(seed)
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self._generate_ahead)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def mutate(self, channel, data):
+        """ Called with each upstream packet. Returns the packet to send instead
+        """
+        state = self.streams.get(channel)
+        if state is None:
+            if self.seed is None and self._capture(channel, data):
+                return data
+            state = self.streams[channel] = [self._next_stream(), 0]
+            if len(self.streams) > self.max_channels:
+                self.streams.popitem(last=False)
+        packets, index = state
+        state[1] = index + 1
+        # Packets past the end of the seed go through untouched
+        if index >= len(packets):
+            return data
+        return packets[index]
+
+    def generate(self, count):
+        """ count mutated streams
+        """
+        with self.generate_lock:
+            mutated = [self._mutate_packets(packet, count) for packet in self.seed]
+            self.generated += count
+        return [list(stream) for stream in zip(*mutated)]
+
+    def _capture(self, channel, data):
+        if self.capture_channel is None:
+            self.capture_channel = channel
+        if channel == self.capture_channel:
+            self.captured.append(bytes(data))
+            return True
+        self.logger.info("Captured seed stream of %d packets" % len(self.captured))
+        self._set_seed(self.captured)
+        return False
+
+    def _set_seed(self, seed):
+        self.seed = [bytes(packet) for packet in seed]
+        # Packets of the seed are spliced with each other too
+        self.corpus.extend(packet for packet in self.seed if packet)
+        with self.condition:
+            self.condition.notify()
+
+    def _next_stream(self):
+        try:
+            stream = self.ready.popleft()
+        except IndexError:
+            self.ready.extend(self.generate(self.batch_size))
+            stream = self.ready.popleft()
+        if len(self.ready) < self.max_ready // 2:
+            with self.condition:
+                self.condition.notify()
+        return stream
+
+    def _generate_ahead(self):
+        while True:
+            with self.condition:
+                while self.is_running and (self.seed is None or len(self.ready) >= self.max_ready // 2):
+                    self.condition.wait()
+                if not self.is_running:
+                    return
+            while self.is_running and len(self.ready) < self.max_ready:
+                self.ready.extend(self.generate(self.batch_size))
+
+    def _mutate_packets(self, packet, count):
+        if not packet:
+            return [packet] * count
+        if HAS_NUMPY:
+            buffers = self._numpy_mutations(packet, count)
+        else:
+            buffers = [self._python_mutations(packet) for _ in range(count)]
+        mutated = []
+        for buffer_ in buffers:
+            if self.corpus and self.random.random() < SPLICE_RATIO:
+                buffer_ = self._splice(buffer_)
+            self._fix_lengths(buffer_)
+            mutated.append(bytes(buffer_))
+        return mutated
+
+    def _python_mutations(self, packet):
+        buffer_ = bytearray(packet)
+        for _ in range(self.mutations):
+            position = self.random.randrange(len(buffer_))
+            kind = self.random.randrange(3)
+            if kind == BIT_FLIP:
+                buffer_[position] ^= 1 << self.random.randrange(8)
+            elif kind == RANDOM_BYTE:
+                buffer_[position] = self.random.randrange(256)
+            else:
+                value = self.random.choice(INTERESTING[self.random.choice((1, 2, 4))])
+                value = value[:len(buffer_) - position]
+                buffer_[position:position + len(value)] = value
+        return buffer_
+
+    def _numpy_mutations(self, packet, count):
+        """ Mutates count copies of packet at once. Each copy is a row of a matrix, and each kind of mutation is
+        applied to all its rows and columns in a single indexing operation
+        """
+        size = len(packet)
+        buffers = numpy.tile(numpy.frombuffer(packet, dtype=numpy.uint8), (count, 1))
+        rows = numpy.repeat(numpy.arange(count), self.mutations)
+        columns = self.rng.integers(0, size, rows.size)
+        kinds = self.rng.integers(0, 3, rows.size)
+        flips = kinds == BIT_FLIP
+        bits = numpy.left_shift(1, self.rng.integers(0, 8, int(flips.sum()))).astype(numpy.uint8)
+        buffers[rows[flips], columns[flips]] ^= bits
+        randoms = kinds == RANDOM_BYTE
+        buffers[rows[randoms], columns[randoms]] = self.rng.integers(0, 256, int(randoms.sum()), dtype=numpy.uint8)
+        widths = self.rng.choice((1, 2, 4), rows.size)
+        for width, values in INTERESTING.items():
+            selected = (kinds == INTERESTING_VALUE) & (widths == width)
+            table = numpy.frombuffer(b"".join(values), dtype=numpy.uint8).reshape(len(values), width)
+            choices = self.rng.integers(0, len(values), int(selected.sum()))
+            for byte in range(width):
+                # Values are cut at the end of the packet
+                byte_columns = columns[selected] + byte
+                inside = byte_columns < size
+                buffers[rows[selected][inside], byte_columns[inside]] = table[choices[inside], byte]
+        return [bytearray(row.tobytes()) for row in buffers]
+
+    def _splice(self, buffer_):
+        other = self.random.choice(self.corpus)
+        cut = self.random.randrange(len(buffer_) + 1)
+        return buffer_[:cut] + other[self.random.randrange(len(other)):]
+
+    def _fix_lengths(self, buffer_):
+        for field in self.length_fields:
+            end = field.offset + field.size
+            if len(buffer_) >= end:
+                value = (len(buffer_) - end + field.delta) & ((1 << (8 * field.size)) - 1)
+                struct.pack_into(field.byteorder + INT_FORMATS[field.size], buffer_, field.offset, value)
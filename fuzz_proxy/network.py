@@ -1,8 +1,36 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import errno
 import logging
-import select
+import os
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
 import socket
+import time
+
+import fuzz_proxy.recorder as fuzzrec
+from fuzz_proxy.metrics import timer
+
+# splice() only exists on Linux with Python >= 3.10
+HAS_SPLICE = hasattr(os, "splice")
+SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if HAS_SPLICE else 0
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+# Delay before trying to refill the upstream connection pool after a failed connection
+POOL_RETRY_DELAY = 0.5
+# Biggest UDP payload, and most datagrams read from a socket in a row before going back to the event loop
+MAX_DATAGRAM_SIZE = 65535
+DATAGRAM_BATCH = 64
+
+
+def set_no_delay(socket_):
+    """ Disables Nagle's algorithm on TCP sockets. The proxy forwards each read right away, and a small write held
+    until the previous one is acknowledged delays it by the delayed ACK timeout of the peer
+    """
+    if socket_.family in (socket.AF_INET, socket.AF_INET6) and socket_.type == socket.SOCK_STREAM:
+        socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 
 class StreamDirection(object):
@@ -11,10 +39,26 @@ class StreamDirection(object):
 
 
 class ProxyHooks(object):
+    """ Callbacks invoked by the proxy around each forwarded packet. The data passed to the pre_* callbacks may be a
+    memoryview over a buffer reused by the proxy: copy it to keep it past the callback
+    """
+
+    DATA_CALLBACKS = ("pre_downstream_send", "post_downstream_send", "pre_upstream_send", "post_upstream_send")
 
     def __init__(self):
         self.is_done = False
 
+    def observes_data(self):
+        """ Whether any of the send callbacks is overridden. When none is, the proxy is free to forward data
+        without ever copying it to userspace
+        """
+        for name in ProxyHooks.DATA_CALLBACKS:
+            method = getattr(type(self), name)
+            if getattr(method, "__func__", method) is not getattr(ProxyHooks.__dict__[name], "__func__",
+                                                                   ProxyHooks.__dict__[name]):
+                return True
+        return False
+
     def pre_downstream_send(self, channel, data):
         return data
 
@@ -27,6 +71,28 @@ class ProxyHooks(object):
     def post_upstream_send(self, channel, data):
         return True
 
+    def fileno(self):
+        """ A file descriptor which becomes readable when the hook has events for the proxy loop, or None
+        """
+        return None
+
+    def on_wakeup(self):
+        """ Called from the proxy loop when fileno() is readable. Returns the channels to tear down
+        """
+        return []
+
+    def is_upstream_ready(self):
+        """ Whether the upstream server accepts connections. Until it does, new downstream connections are held by
+        the proxy. Hooks signal that it became ready through fileno()
+        """
+        return True
+
+    def select_upstream(self, upstream_address):
+        """ Address to connect to for a new downstream connection, which lets a hook spread connections over
+        several servers
+        """
+        return upstream_address
+
 
 class Upstream(object):
 
@@ -44,86 +110,360 @@ class Upstream(object):
             self.logger.error("Failed to connect to upstream server %s: %s" % (connect_data, self.socket_))
             return None
 
+    def start_connect(self, connect_data):
+        """ Non-blocking version of connect(). The connection is complete once the socket becomes writable
+        """
+        self.socket_.setblocking(False)
+        error = self.socket_.connect_ex(connect_data)
+        if error in (0, errno.EINPROGRESS):
+            return self.socket_
+        self.logger.error("Failed to connect to upstream server %s: %s" % (connect_data, os.strerror(error)))
+        self.socket_.close()
+        return None
+
 
 class Downstream(object):
 
-    def __init__(self, server_socket, client_socket, upstream_address, proxy_hook=None):
+    def __init__(self, server_socket, client_socket, upstream_address, proxy_hook=None, max_pending=1 << 20,
+                 pool_size=0, max_waiting=64, metrics=None, recorder=None):
         self.downstream_socket = server_socket
         self.upstream_socket = client_socket
         self.upstream_address = upstream_address
         self.proxy_hook = proxy_hook
-        self.inputs = [self.downstream_socket]
-        self.channels = []
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.downstream_socket, selectors.EVENT_READ)
+        if self.proxy_hook is not None and self.proxy_hook.fileno() is not None:
+            self.selector.register(self.proxy_hook, selectors.EVENT_READ)
+        # Indexes from each socket to its channel, its peer and its direction. These keep every lookup on the
+        # forwarding path O(1), whatever the number of concurrent connections
+        self.channels = {}
+        self.peers = {}
+        self.directions = {}
+        # Data accepted from one peer but not yet accepted by the kernel of the other one. Reading from a peer is
+        # paused while the outbound queue of the other one holds more than max_pending bytes
+        self.outbound = {}
+        self.outbound_sizes = {}
+        self.max_pending = max_pending
+        self.paused = set()
+        self.events = {}
+        # Sockets which hit the end of stream, and sockets to shut down for writing as soon as their outbound queue
+        # is flushed, because their peer hung up
+        self.eof = set()
+        self.closing = set()
+        # When no hook looks at the data, it is moved between sockets through a pipe with splice(), and never
+        # copied to userspace
+        self.use_splice = HAS_SPLICE and (self.proxy_hook is None or not self.proxy_hook.observes_data())
+        self.pipes = {}
+        # Upstream connections in progress, mapped to the downstream socket waiting for them, or to None when they
+        # are meant for the pool
+        self.connecting = {}
+        self.connect_deadlines = {}
+        self.connect_timeout = client_socket.gettimeout()
+        # Established upstream connections waiting for a downstream client, with the data the server sent so far
+        self.pool = collections.OrderedDict()
+        self.pool_size = pool_size
+        self.pool_connecting = 0
+        self.pool_retry_time = 0
+        # Downstream connections held while the upstream server is not ready, oldest first
+        self.waiting = collections.deque()
+        self.max_waiting = max_waiting
+        self.buffer_size = 0
+        self.buffer = None
+        self.view = None
+        # Counts connections, packets and bytes, and times forwarding and hooks, when given
+        self.metrics = metrics
+        # Keeps the last connection and packet events for crash reports, instead of logging each of them
+        self.recorder = recorder
         self.is_running = False
         self.logger = logging.getLogger("Downstream")
 
     def serve(self, buffer_size=4096, timeout=None):
+        # Single receive buffer reused for every read
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
         self.is_running = True
         self.logger.info("Downstream server listening for new connections")
-        while self.is_running and not self.proxy_hook.is_done:
-            if timeout is None:
-                read_ready, _, _ = select.select(self.inputs, [], [])
-            else:
-                read_ready, _, _ = select.select(self.inputs, [], [], timeout)
-            for socket_ in read_ready:
-                if socket_ == self.downstream_socket:
+        while self.is_running and not self._is_hook_done():
+            if self._is_upstream_ready():
+                self._flush_waiting()
+                self._fill_pool()
+            for key, mask in self.selector.select(self._select_timeout(timeout)):
+                socket_ = key.fileobj
+                if socket_ is self.downstream_socket:
                     self._on_accept()
-                else:
-                    try:
-                        data = socket_.recv(buffer_size)
-                    except socket.error:
-                        self._on_close(socket_)
-                    if len(data) == 0:
-                        self._on_close(socket_)
-                    else:
-                        self._on_read(socket_, data)
+                elif socket_ is self.proxy_hook:
+                    self._on_wakeup()
+                elif socket_ in self.connecting:
+                    self._on_connect(socket_)
+                elif socket_ in self.pool:
+                    self._on_pool_read(socket_)
+                elif socket_ in self.peers:
+                    # Sockets closed while handling an earlier event of the same batch are no longer indexed
+                    if mask & selectors.EVENT_WRITE:
+                        self._on_write(socket_)
+                    if mask & selectors.EVENT_READ and socket_ in self.peers:
+                        self._on_readable(socket_)
+            self._expire_connects()
         self.is_running = False
 
     def stop(self):
         self.is_running = False
-        for socket_ in self.inputs:
+        sockets = set(self.peers)
+        sockets.update(s for s in self.connecting.values() if s is not None)
+        sockets.update(self.waiting)
+        self.waiting.clear()
+        for key in list(self.selector.get_map().values()):
+            try:
+                self.selector.unregister(key.fileobj)
+            except (KeyError, ValueError):
+                pass
+            if key.fileobj is not self.proxy_hook:
+                sockets.add(key.fileobj)
+        for socket_ in sockets:
             try:
                 socket_.close()
-            except socket.error as se:
+            except socket.error:
                 self.logger.debug("Failed to gracefully close socket: %s" % socket_)
+        for pipe in self.pipes.values():
+            self._close_pipe(pipe)
+        for index in (self.channels, self.peers, self.directions, self.outbound, self.outbound_sizes, self.events,
+                      self.pipes, self.connecting, self.connect_deadlines, self.pool):
+            index.clear()
+        self.paused.clear()
+        self.eof.clear()
+        self.closing.clear()
+        self.pool_connecting = 0
         self.logger.warn("Stopped downstream server")
 
+    def _is_hook_done(self):
+        return self.proxy_hook is not None and self.proxy_hook.is_done
+
+    def _is_upstream_ready(self):
+        return self.proxy_hook is None or self.proxy_hook.is_upstream_ready()
+
+    def _select_timeout(self, timeout):
+        if not self.connect_deadlines:
+            return timeout
+        remaining = max(0, min(self.connect_deadlines.values()) - time.time())
+        return remaining if timeout is None else min(timeout, remaining)
+
     def _on_accept(self):
-        downstream_client_socket, client_addr = self.downstream_socket.accept()
-        self.logger.debug("New downstream connection from %s: %s" % (client_addr, downstream_client_socket))
-        upstream_client_socket = Upstream(self.upstream_socket).connect(self.upstream_address)
-        if upstream_client_socket is not None:
-            channel = {StreamDirection.DOWNSTREAM: downstream_client_socket,
-                       StreamDirection.UPSTREAM: upstream_client_socket}
-            self.channels.append(channel)
-            self.inputs.append(downstream_client_socket)
-            self.inputs.append(upstream_client_socket)
-            self.logger.debug("Created new socket pair for stream: %s" % channel)
+        try:
+            downstream_client_socket, client_addr = self.downstream_socket.accept()
+        except socket.error as se:
+            self.logger.debug("Failed to accept downstream connection: %s" % se)
+            return
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.ACCEPT, downstream_client_socket.fileno())
+        if self.metrics is not None:
+            self.metrics.inc("proxy.connections")
+        # Connections keep their arrival order while some are held
+        if self.waiting or not self._is_upstream_ready():
+            self._hold(downstream_client_socket)
+        else:
+            self._forward(downstream_client_socket)
+
+    def _forward(self, downstream_client_socket):
+        if self.pool:
+            upstream_client_socket, early_data = self.pool.popitem(last=False)
+            self.selector.unregister(upstream_client_socket)
+            self._pair(downstream_client_socket, upstream_client_socket, early_data)
+        else:
+            self._connect_upstream(downstream_client_socket)
+
+    def _connect_upstream(self, downstream_client_socket):
+        """ Starts a non-blocking upstream connection, completed in the event loop. A downstream socket of None
+        means that the connection goes to the pool
+        """
+        upstream_address = self.upstream_address
+        if self.proxy_hook is not None:
+            upstream_address = self.proxy_hook.select_upstream(upstream_address)
+        upstream_client_socket = Upstream(self.upstream_socket).start_connect(upstream_address)
+        if upstream_client_socket is None:
+            self._on_connect_failed(downstream_client_socket)
+            return False
+        self.connecting[upstream_client_socket] = downstream_client_socket
+        if downstream_client_socket is None:
+            self.pool_connecting += 1
+        if self.connect_timeout is not None:
+            self.connect_deadlines[upstream_client_socket] = time.time() + self.connect_timeout
+        self.selector.register(upstream_client_socket, selectors.EVENT_WRITE)
+        return True
+
+    def _on_connect(self, upstream_client_socket):
+        downstream_client_socket = self._end_connect(upstream_client_socket)
+        error = upstream_client_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            self.logger.error("Failed to connect to upstream server %s: %s" % (self.upstream_address,
+                                                                               os.strerror(error)))
+            upstream_client_socket.close()
+            self._on_connect_failed(downstream_client_socket)
+        elif downstream_client_socket is None:
+            self.pool[upstream_client_socket] = []
+            self.selector.register(upstream_client_socket, selectors.EVENT_READ)
+        else:
+            self._pair(downstream_client_socket, upstream_client_socket, [])
+
+    def _end_connect(self, upstream_client_socket):
+        downstream_client_socket = self.connecting.pop(upstream_client_socket)
+        self.connect_deadlines.pop(upstream_client_socket, None)
+        if downstream_client_socket is None:
+            self.pool_connecting -= 1
+        self.selector.unregister(upstream_client_socket)
+        return downstream_client_socket
+
+    def _hold(self, downstream_client_socket, is_retry=False):
+        """ Keeps a downstream connection until the upstream server is ready. Its data waits in the kernel buffers
+        """
+        if len(self.waiting) >= self.max_waiting:
+            self.logger.error("Too many connections waiting for upstream server. Closing downstream: %s" %
+                              downstream_client_socket)
+            downstream_client_socket.close()
+            if self.metrics is not None:
+                self.metrics.inc("proxy.dropped")
+        else:
+            if is_retry:
+                self.waiting.appendleft(downstream_client_socket)
+            else:
+                self.waiting.append(downstream_client_socket)
+                if self.metrics is not None:
+                    self.metrics.inc("proxy.held")
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.HOLD, downstream_client_socket.fileno(), len(self.waiting))
+
+    def _flush_waiting(self):
+        while self.waiting and self._is_upstream_ready():
+            self._forward(self.waiting.popleft())
+
+    def _on_connect_failed(self, downstream_client_socket):
+        if downstream_client_socket is None:
+            self.pool_retry_time = time.time() + POOL_RETRY_DELAY
+        elif not self._is_upstream_ready():
+            # The upstream server went down in the meantime, and the connection is retried once it is back
+            self._hold(downstream_client_socket, True)
         else:
             self.logger.error("Failed to connect to upstream server. Closing downstream: %s" % downstream_client_socket)
             downstream_client_socket.close()
 
+    def _expire_connects(self):
+        now = time.time()
+        for upstream_client_socket, deadline in list(self.connect_deadlines.items()):
+            if deadline <= now:
+                self.logger.error("Timed out connecting to upstream server %s" % (self.upstream_address,))
+                downstream_client_socket = self._end_connect(upstream_client_socket)
+                upstream_client_socket.close()
+                self._on_connect_failed(downstream_client_socket)
+
+    def _fill_pool(self):
+        if len(self.pool) + self.pool_connecting >= self.pool_size or time.time() < self.pool_retry_time:
+            return
+        while len(self.pool) + self.pool_connecting < self.pool_size:
+            if not self._connect_upstream(None):
+                break
+
+    def _on_pool_read(self, upstream_client_socket):
+        """ Keeps what the server sends on an idle pooled connection, such as a banner, until it gets a client
+        """
+        try:
+            data = upstream_client_socket.recv(self.buffer_size)
+        except socket.error as se:
+            if se.errno in WOULD_BLOCK:
+                return
+            data = b""
+        if len(data) == 0:
+            self.logger.debug("Pooled upstream connection closed by server: %s" % upstream_client_socket)
+            self.selector.unregister(upstream_client_socket)
+            del self.pool[upstream_client_socket]
+            upstream_client_socket.close()
+            self.pool_retry_time = time.time() + POOL_RETRY_DELAY
+        else:
+            self.pool[upstream_client_socket].append(data)
+
+    def _pair(self, downstream_client_socket, upstream_client_socket, early_data):
+        channel = {StreamDirection.DOWNSTREAM: downstream_client_socket,
+                   StreamDirection.UPSTREAM: upstream_client_socket}
+        self._add_channel(channel)
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.CONNECT, downstream_client_socket.fileno(), upstream_client_socket.fileno())
+        for data in early_data:
+            if upstream_client_socket not in self.peers:
+                break
+            self._on_read(upstream_client_socket, data)
+
+    def _on_wakeup(self):
+        start = timer()
+        channels = self.proxy_hook.on_wakeup()
+        if self.metrics is not None:
+            self.metrics.observe("hook.on_wakeup", timer() - start)
+        for channel in channels:
+            upstream_client_socket = channel.get(StreamDirection.UPSTREAM)
+            if upstream_client_socket in self.channels:
+                self.logger.warn("Upstream server appears to be dead: %s" % upstream_client_socket)
+                self._on_close(upstream_client_socket)
+
+    def _add_channel(self, channel):
+        downstream_client_socket = channel[StreamDirection.DOWNSTREAM]
+        upstream_client_socket = channel[StreamDirection.UPSTREAM]
+        for socket_, other_socket, direction in ((downstream_client_socket, upstream_client_socket,
+                                                  StreamDirection.DOWNSTREAM),
+                                                 (upstream_client_socket, downstream_client_socket,
+                                                  StreamDirection.UPSTREAM)):
+            socket_.setblocking(False)
+            set_no_delay(socket_)
+            self.channels[socket_] = channel
+            self.peers[socket_] = other_socket
+            self.directions[socket_] = direction
+            self.outbound[socket_] = collections.deque()
+            self.outbound_sizes[socket_] = 0
+            if self.use_splice:
+                self.pipes[socket_] = os.pipe()
+            self._update_events(socket_)
+
+    def _on_readable(self, socket_):
+        if self.use_splice:
+            self._splice_in(socket_)
+            return
+        try:
+            size = socket_.recv_into(self.buffer)
+        except socket.error as se:
+            if se.errno not in WOULD_BLOCK:
+                self._on_close(socket_)
+            return
+        if size == 0:
+            self._on_eof(socket_)
+        elif self.metrics is None:
+            self._on_read(socket_, self.view[:size])
+        else:
+            # Time from the end of the read to the end of the send, hooks included
+            start = timer()
+            direction = self.directions[self.peers[socket_]]
+            self._on_read(socket_, self.view[:size])
+            self.metrics.observe("proxy.forward", timer() - start)
+            self._count(direction, size)
+
     def _on_read(self, socket_, data):
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.READ, socket_.fileno(), len(data))
         other_socket = self._other(socket_)
         if other_socket is not None:
             if self.proxy_hook is not None:
                 channel = self._get_channel(socket_)
-                if self._direction(other_socket) == StreamDirection.UPSTREAM:
-                    self.logger.debug("Received data downstream: %s. Forwarding to: %s" % (socket_, other_socket))
-                    data = self.proxy_hook.pre_upstream_send(channel, data)
+                direction = self._direction(other_socket)
+                if direction == StreamDirection.UPSTREAM:
+                    data = self._call_hook("pre_upstream_send", channel, data)
                     try:
-                        other_socket.send(data)
+                        self._send(other_socket, data)
                     except socket.error as se:
                         self.logger.warning("Upstream socket appears to be dead: %s" % other_socket)
-                    is_alive = self.proxy_hook.post_upstream_send(channel, data)
-                elif self._direction(other_socket) == StreamDirection.DOWNSTREAM:
-                    self.logger.debug("Received data upstream: %s. Forwarding to: %s" % (socket_, other_socket))
-                    data = self.proxy_hook.pre_downstream_send(channel, data)
+                    is_alive = self._call_hook("post_upstream_send", channel, data)
+                elif direction == StreamDirection.DOWNSTREAM:
+                    data = self._call_hook("pre_downstream_send", channel, data)
                     try:
-                        other_socket.send(data)
+                        self._send(other_socket, data)
                     except socket.error as se:
                         self.logger.warning("Downstream socket appears to be dead: %s" % other_socket)
-                    is_alive = self.proxy_hook.post_downstream_send(channel, data)
+                    is_alive = self._call_hook("post_downstream_send", channel, data)
                 else:
                     self.logger.error("Unknown proxy state for current connection")
                     raise RuntimeWarning("Unknown proxy state for current connection")
@@ -131,47 +471,462 @@ class Downstream(object):
                     self.logger.warn("Upstream server appears to be dead: %s" % socket_)
                     self._on_close(socket_)
             else:
-                other_socket.send(data)
+                try:
+                    self._send(other_socket, data)
+                except socket.error:
+                    self._on_close(socket_)
         else:
             self.logger.warn("No socket pair found for socket: %s" % socket_)
             self._on_close(socket_)
 
-    def _on_close(self, socket_):
-        self.logger.debug("Removing sockets from select() loop")
-        other_socket = self._other(socket_)
-        if self._get_channel(socket_) in self.channels:
-            self.channels.remove(self._get_channel(socket_))
-        if socket_ in self.inputs:
-            self.inputs.remove(socket_)
-        if other_socket in self.inputs:
-            self.inputs.remove(other_socket)
+    def _call_hook(self, name, channel, data):
+        hook = getattr(self.proxy_hook, name)
+        if self.metrics is None:
+            return hook(channel, data)
+        start = timer()
+        result = hook(channel, data)
+        self.metrics.observe("hook." + name, timer() - start)
+        return result
+
+    def _count(self, direction, size):
+        """ Counts a packet of size bytes sent in direction
+        """
+        self.metrics.inc("proxy.%s.packets" % direction)
+        self.metrics.inc("proxy.%s.bytes" % direction, size)
+
+    def _send(self, socket_, data):
+        """ Sends as much as the kernel accepts right away, and queues the remainder until socket_ is writable
+        """
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.SEND, socket_.fileno(), len(data))
+        if not self.outbound[socket_]:
+            try:
+                sent = socket_.send(data)
+            except socket.error as se:
+                if se.errno not in WOULD_BLOCK:
+                    raise
+                sent = 0
+            if sent == len(data):
+                return
+            data = data[sent:]
+        # The receive buffer is reused, so the unsent tail has to be copied once
+        self.outbound[socket_].append(memoryview(bytes(data)))
+        self.outbound_sizes[socket_] += len(data)
+        self._update_events(socket_)
+        self._apply_backpressure(socket_)
+
+    def _on_write(self, socket_):
+        if self.use_splice:
+            self._splice_out(socket_)
+            return
+        queue = self.outbound[socket_]
         try:
-            socket_.close()
-            self.logger.debug("Closing socket: %s" % socket_)
-        except socket.error:
-            pass
+            while queue:
+                data = queue[0]
+                sent = socket_.send(data)
+                self.outbound_sizes[socket_] -= sent
+                if sent < len(data):
+                    queue[0] = data[sent:]
+                    break
+                queue.popleft()
+        except socket.error as se:
+            if se.errno not in WOULD_BLOCK:
+                self._on_close(socket_)
+                return
+        self._on_drained(socket_)
+
+    def _splice_in(self, socket_):
+        other_socket = self.peers[socket_]
+        pipe_write = self.pipes[socket_][1]
         try:
-            other_socket.close()
-            self.logger.debug("Closing socket: %s" % other_socket)
-        except (socket.error, AttributeError):
-            pass
+            size = os.splice(socket_.fileno(), pipe_write, self.buffer_size, flags=SPLICE_FLAGS)
+        except OSError as oe:
+            if oe.errno not in WOULD_BLOCK:
+                self._on_close(socket_)
+            elif self.outbound_sizes[other_socket] > 0:
+                # The pipe is full: wait for the other side to drain it
+                self.paused.add(socket_)
+                self._update_events(socket_)
+            return
+        if size == 0:
+            self._on_eof(socket_)
+            return
+        self.outbound_sizes[other_socket] += size
+        if self.metrics is not None:
+            self._count(self.directions[other_socket], size)
+        self._splice_out(other_socket)
+        if socket_ in self.peers:
+            self._apply_backpressure(other_socket)
+
+    def _splice_out(self, socket_):
+        pipe_read = self.pipes[self.peers[socket_]][0]
+        try:
+            while self.outbound_sizes[socket_] > 0:
+                sent = os.splice(pipe_read, socket_.fileno(), self.outbound_sizes[socket_], flags=SPLICE_FLAGS)
+                self.outbound_sizes[socket_] -= sent
+        except OSError as oe:
+            if oe.errno not in WOULD_BLOCK:
+                self._on_close(socket_)
+                return
+        self._on_drained(socket_)
+
+    def _apply_backpressure(self, socket_):
+        """ Stops reading from the peer of socket_ while too much data is waiting to be sent to socket_
+        """
+        other_socket = self.peers[socket_]
+        if self.outbound_sizes[socket_] > self.max_pending and other_socket not in self.paused:
+            self.paused.add(other_socket)
+            self._update_events(other_socket)
+
+    def _on_drained(self, socket_):
+        self._update_events(socket_)
+        if self.outbound_sizes[socket_] == 0 and socket_ in self.closing:
+            self._shutdown_write(socket_)
+            return
+        other_socket = self.peers[socket_]
+        if other_socket in self.paused and other_socket not in self.eof \
+                and self.outbound_sizes[socket_] <= self.max_pending:
+            self.paused.discard(other_socket)
+            self._update_events(other_socket)
+
+    def _on_eof(self, socket_):
+        other_socket = self.peers[socket_]
+        self.eof.add(socket_)
+        if other_socket in self.eof:
+            self._on_close(socket_)
+            return
+        # Half close: forward the end of stream once everything left for the other side is flushed, and keep
+        # relaying data in the opposite direction
+        self.paused.add(socket_)
+        self._update_events(socket_)
+        self.closing.add(other_socket)
+        if self.outbound_sizes[other_socket] == 0:
+            self._shutdown_write(other_socket)
+
+    def _shutdown_write(self, socket_):
+        self.closing.discard(socket_)
+        try:
+            socket_.shutdown(socket.SHUT_WR)
+        except socket.error:
+            self._on_close(socket_)
+
+    def _update_events(self, socket_):
+        events = 0
+        if socket_ not in self.paused:
+            events |= selectors.EVENT_READ
+        if self.outbound_sizes[socket_] > 0:
+            events |= selectors.EVENT_WRITE
+        registered_events = self.events.get(socket_, 0)
+        if events == registered_events:
+            return
+        if registered_events == 0:
+            self.selector.register(socket_, events)
+        elif events == 0:
+            self.selector.unregister(socket_)
+        else:
+            self.selector.modify(socket_, events)
+        self.events[socket_] = events
+
+    def _on_close(self, socket_):
+        other_socket = self.peers.pop(socket_, None)
+        for s in (socket_, other_socket):
+            if s is None:
+                continue
+            for index in (self.channels, self.peers, self.directions, self.outbound, self.outbound_sizes):
+                index.pop(s, None)
+            self.paused.discard(s)
+            self.eof.discard(s)
+            self.closing.discard(s)
+            if self.events.pop(s, 0) != 0:
+                try:
+                    self.selector.unregister(s)
+                except (KeyError, ValueError):
+                    pass
+            pipe = self.pipes.pop(s, None)
+            if pipe is not None:
+                self._close_pipe(pipe)
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.CLOSE, s.fileno())
+            try:
+                s.close()
+            except socket.error:
+                pass
+
+    def _close_pipe(self, pipe):
+        for fd in pipe:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
 
     def _get_channel(self, socket_):
-        for channel in self.channels:
-            if socket_ in channel.values():
-                return channel
-        return {}
+        return self.channels.get(socket_, {})
 
     def _other(self, socket_):
-        channel = self._get_channel(socket_)
-        for v in channel.values():
-            if v != socket_:
-                return v
-        return None
+        return self.peers.get(socket_)
 
     def _direction(self, socket_):
-        channel = self._get_channel(socket_)
-        for k, v in channel.items():
-            if v == socket_:
-                return k
-        return None
+        return self.directions.get(socket_)
+
+
+class DatagramDownstream(object):
+    """ Proxy for datagram sockets, such as UDP. Each downstream client address gets its own upstream socket,
+    connected to the server, so that the server sees one peer per client and the hooks one stream per client. The
+    channel of a client maps DOWNSTREAM to its address and UPSTREAM to its upstream socket. Upstream sockets unused
+    for idle_timeout seconds are closed
+    """
+
+    def __init__(self, server_socket, client_socket, upstream_address, proxy_hook=None, max_waiting=64,
+                 idle_timeout=60, metrics=None, recorder=None):
+        self.downstream_socket = server_socket
+        self.downstream_socket.setblocking(False)
+        self.upstream_socket = client_socket
+        self.upstream_address = upstream_address
+        self.proxy_hook = proxy_hook
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.downstream_socket, selectors.EVENT_READ)
+        if self.proxy_hook is not None and self.proxy_hook.fileno() is not None:
+            self.selector.register(self.proxy_hook, selectors.EVENT_READ)
+        # Upstream socket of each client address, least recently used first, and the reverse indexes
+        self.upstreams = collections.OrderedDict()
+        self.clients = {}
+        self.channels = {}
+        self.last_used = {}
+        self.idle_timeout = idle_timeout
+        # Datagrams received while the upstream server is not ready, oldest first. Further ones are dropped
+        self.waiting = collections.deque()
+        self.max_waiting = max_waiting
+        self.buffer = None
+        self.view = None
+        # Counts clients, datagrams and bytes, and times forwarding and hooks, when given
+        self.metrics = metrics
+        # Keeps the last client and datagram events for crash reports, when given
+        self.recorder = recorder
+        self.is_running = False
+        self.logger = logging.getLogger("DatagramDownstream")
+
+    def serve(self, buffer_size=MAX_DATAGRAM_SIZE, timeout=None):
+        # Single receive buffer reused for every datagram. Bigger datagrams are truncated
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.is_running = True
+        self.logger.info("Downstream server waiting for datagrams")
+        while self.is_running and not self._is_hook_done():
+            if self._is_upstream_ready():
+                self._flush_waiting()
+            for key, mask in self.selector.select(self._select_timeout(timeout)):
+                socket_ = key.fileobj
+                if socket_ is self.downstream_socket:
+                    self._on_downstream_readable()
+                elif socket_ is self.proxy_hook:
+                    self._on_wakeup()
+                elif socket_ in self.clients:
+                    self._on_upstream_readable(socket_)
+            self._expire_idle()
+        self.is_running = False
+
+    def stop(self):
+        self.is_running = False
+        for upstream_client_socket in list(self.clients):
+            self._close_upstream(upstream_client_socket)
+        self.waiting.clear()
+        for key in list(self.selector.get_map().values()):
+            try:
+                self.selector.unregister(key.fileobj)
+            except (KeyError, ValueError):
+                pass
+        try:
+            self.downstream_socket.close()
+        except socket.error:
+            self.logger.debug("Failed to gracefully close socket: %s" % self.downstream_socket)
+        self.logger.warn("Stopped downstream server")
+
+    def _is_hook_done(self):
+        return self.proxy_hook is not None and self.proxy_hook.is_done
+
+    def _is_upstream_ready(self):
+        return self.proxy_hook is None or self.proxy_hook.is_upstream_ready()
+
+    def _select_timeout(self, timeout):
+        if not self.upstreams:
+            return timeout
+        oldest = self.last_used[next(iter(self.upstreams.values()))]
+        remaining = max(0, oldest + self.idle_timeout - time.time())
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def _on_downstream_readable(self):
+        # Draining several datagrams per event saves a select() call per datagram under load
+        for _ in range(DATAGRAM_BATCH):
+            try:
+                size, client_address = self.downstream_socket.recvfrom_into(self.buffer)
+            except socket.error as se:
+                if se.errno not in WOULD_BLOCK:
+                    self.logger.debug("Failed to receive downstream datagram: %s" % se)
+                return
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.READ, self.downstream_socket.fileno(), size)
+            if self.waiting or not self._is_upstream_ready():
+                self._hold(client_address, bytes(self.view[:size]))
+            else:
+                self._forward(client_address, self.view[:size])
+
+    def _forward(self, client_address, data):
+        if self.metrics is None:
+            self._send_upstream(client_address, data)
+        else:
+            # Time from the end of the read to the end of the send, hooks included
+            start = timer()
+            self._send_upstream(client_address, data)
+            self.metrics.observe("proxy.forward", timer() - start)
+
+    def _send_upstream(self, client_address, data):
+        upstream_client_socket = self.upstreams.get(client_address)
+        if upstream_client_socket is None:
+            upstream_client_socket = self._open_upstream(client_address)
+            if upstream_client_socket is None:
+                return
+        else:
+            self._touch(client_address, upstream_client_socket)
+        channel = self.channels[upstream_client_socket]
+        if self.proxy_hook is not None:
+            data = self._call_hook("pre_upstream_send", channel, data)
+        self._send(upstream_client_socket, StreamDirection.UPSTREAM, data)
+        if self.proxy_hook is not None and not self._call_hook("post_upstream_send", channel, data):
+            self.logger.warn("Upstream server appears to be dead: %s" % upstream_client_socket)
+            self._close_upstream(upstream_client_socket)
+
+    def _on_upstream_readable(self, upstream_client_socket):
+        client_address = self.clients[upstream_client_socket]
+        channel = self.channels[upstream_client_socket]
+        self._touch(client_address, upstream_client_socket)
+        for _ in range(DATAGRAM_BATCH):
+            try:
+                size = upstream_client_socket.recv_into(self.buffer)
+            except socket.error as se:
+                # A server which is down makes the kernel refuse datagrams
+                if se.errno not in WOULD_BLOCK:
+                    self.logger.debug("Failed to receive upstream datagram: %s" % se)
+                return
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.READ, upstream_client_socket.fileno(), size)
+            start = timer() if self.metrics is not None else None
+            data = self.view[:size]
+            if self.proxy_hook is not None:
+                data = self._call_hook("pre_downstream_send", channel, data)
+            self._send(self.downstream_socket, StreamDirection.DOWNSTREAM, data, client_address)
+            if start is not None:
+                self.metrics.observe("proxy.forward", timer() - start)
+            if self.proxy_hook is not None and not self._call_hook("post_downstream_send", channel, data):
+                self.logger.warn("Upstream server appears to be dead: %s" % upstream_client_socket)
+                self._close_upstream(upstream_client_socket)
+                return
+
+    def _send(self, socket_, direction, data, address=None):
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.SEND, socket_.fileno(), len(data))
+        try:
+            if address is None:
+                socket_.send(data)
+            else:
+                socket_.sendto(data, address)
+        except socket.error as se:
+            # Datagrams are dropped rather than queued, as the network would do
+            self.logger.debug("Failed to send datagram %s: %s" % (direction, se))
+            return
+        if self.metrics is not None:
+            self.metrics.inc("proxy.%s.packets" % direction)
+            self.metrics.inc("proxy.%s.bytes" % direction, len(data))
+
+    def _call_hook(self, name, channel, data):
+        hook = getattr(self.proxy_hook, name)
+        if self.metrics is None:
+            return hook(channel, data)
+        start = timer()
+        result = hook(channel, data)
+        self.metrics.observe("hook." + name, timer() - start)
+        return result
+
+    def _open_upstream(self, client_address):
+        upstream_address = self.upstream_address
+        if self.proxy_hook is not None:
+            upstream_address = self.proxy_hook.select_upstream(upstream_address)
+        upstream_client_socket = socket.socket(self.upstream_socket.family, self.upstream_socket.type,
+                                               self.upstream_socket.proto)
+        try:
+            if upstream_client_socket.family == socket.AF_UNIX:
+                # Unix datagram sockets need an address of their own to get replies: let the kernel pick one
+                upstream_client_socket.bind("")
+            upstream_client_socket.connect(upstream_address)
+        except socket.error as se:
+            self.logger.error("Failed to connect to upstream server %s: %s" % (upstream_address, se))
+            upstream_client_socket.close()
+            return None
+        upstream_client_socket.setblocking(False)
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.ACCEPT, self.downstream_socket.fileno())
+            self.recorder.record(fuzzrec.CONNECT, self.downstream_socket.fileno(), upstream_client_socket.fileno())
+        if self.metrics is not None:
+            self.metrics.inc("proxy.connections")
+        self.upstreams[client_address] = upstream_client_socket
+        self.clients[upstream_client_socket] = client_address
+        self.channels[upstream_client_socket] = {StreamDirection.DOWNSTREAM: client_address,
+                                                 StreamDirection.UPSTREAM: upstream_client_socket}
+        self.last_used[upstream_client_socket] = time.time()
+        self.selector.register(upstream_client_socket, selectors.EVENT_READ)
+        return upstream_client_socket
+
+    def _touch(self, client_address, upstream_client_socket):
+        # Most recently used last, so that idle sockets are found at the front
+        del self.upstreams[client_address]
+        self.upstreams[client_address] = upstream_client_socket
+        self.last_used[upstream_client_socket] = time.time()
+
+    def _expire_idle(self):
+        deadline = time.time() - self.idle_timeout
+        while self.upstreams:
+            upstream_client_socket = next(iter(self.upstreams.values()))
+            if self.last_used[upstream_client_socket] > deadline:
+                break
+            self.logger.debug("Closing idle upstream socket: %s" % upstream_client_socket)
+            self._close_upstream(upstream_client_socket)
+
+    def _close_upstream(self, upstream_client_socket):
+        client_address = self.clients.pop(upstream_client_socket)
+        del self.upstreams[client_address]
+        del self.channels[upstream_client_socket]
+        del self.last_used[upstream_client_socket]
+        try:
+            self.selector.unregister(upstream_client_socket)
+        except (KeyError, ValueError):
+            pass
+        if self.recorder is not None:
+            self.recorder.record(fuzzrec.CLOSE, upstream_client_socket.fileno())
+        upstream_client_socket.close()
+
+    def _hold(self, client_address, data):
+        if len(self.waiting) >= self.max_waiting:
+            self.logger.debug("Too many datagrams waiting for upstream server. Dropping datagram from %s" %
+                              (client_address,))
+            if self.metrics is not None:
+                self.metrics.inc("proxy.dropped")
+        else:
+            self.waiting.append((client_address, data))
+            if self.metrics is not None:
+                self.metrics.inc("proxy.held")
+            if self.recorder is not None:
+                self.recorder.record(fuzzrec.HOLD, self.downstream_socket.fileno(), len(self.waiting))
+
+    def _flush_waiting(self):
+        while self.waiting and self._is_upstream_ready():
+            self._forward(*self.waiting.popleft())
+
+    def _on_wakeup(self):
+        start = timer()
+        channels = self.proxy_hook.on_wakeup()
+        if self.metrics is not None:
+            self.metrics.observe("hook.on_wakeup", timer() - start)
+        for channel in channels:
+            upstream_client_socket = channel.get(StreamDirection.UPSTREAM)
+            if upstream_client_socket in self.channels:
+                self.logger.warn("Upstream server appears to be dead: %s" % upstream_client_socket)
+                self._close_upstream(upstream_client_socket)
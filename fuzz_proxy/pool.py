@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import fcntl
+import logging
+import multiprocessing
+import os
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+import signal
+import socket
+import struct
+import threading
+import time
+
+import fuzz_proxy.network as fuzznet
+
+# How often an instance reports the readiness of its target
+STATUS_INTERVAL = 0.01
+STATUS_DOWN, STATUS_READY, STATUS_DONE = range(3)
+STATUS_FORMAT = "!HB"
+# How long an instance is given to stop its target and write its reports, before being killed
+STOP_TIMEOUT = 10
+# Size of a file descriptor in SCM_RIGHTS messages
+FD_SIZE = struct.calcsize("i")
+# Instances inherit live sockets, and run functions of the fuzzmon script, which cannot be imported by name
+process_context = multiprocessing.get_context("fork")
+
+
+def instance_address(family, address, index):
+    """ Upstream address of instance index: the base port plus index, or the base path suffixed with index
+    """
+    if family == socket.AF_UNIX:
+        return ("%s.%d" % (address[0], index),)
+    return (address[0], address[1] + index) + tuple(address[2:])
+
+
+def instance_program(program, family, address, index):
+    """ Command line of instance index. {port}, {path} and {instance} are replaced by the values of the instance
+    """
+    values = {"{instance}": str(index)}
+    if family == socket.AF_UNIX:
+        values["{path}"] = address[0]
+    else:
+        values["{port}"] = str(address[1])
+    program = list(program)
+    for i, arg in enumerate(program):
+        for placeholder, value in values.items():
+            arg = arg.replace(placeholder, value)
+        program[i] = arg
+    return program
+
+
+class StatusReporter(object):
+    """ Runs in an instance process, and reports the readiness of its target to the pool through a pipe shared by
+    all instances
+    """
+
+    def __init__(self, index, status_fd, proxy_hook):
+        self.index = index
+        self.status_fd = status_fd
+        self.proxy_hook = proxy_hook
+        self.thread = threading.Thread(target=self._report)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _report(self):
+        status = None
+        while status != STATUS_DONE:
+            if self.proxy_hook.is_done:
+                new_status = STATUS_DONE
+            elif self.proxy_hook.is_upstream_ready():
+                new_status = STATUS_READY
+            else:
+                new_status = STATUS_DOWN
+            if new_status != status:
+                status = new_status
+                # Writes of a few bytes to a pipe are atomic, so messages of instances never interleave
+                os.write(self.status_fd, struct.pack(STATUS_FORMAT, self.index, status))
+            time.sleep(STATUS_INTERVAL)
+
+
+class ConnectionReceiver(object):
+    """ Stands for the listening socket of the proxy of an instance: accept() returns the next downstream connection
+    accepted by the pool in the parent process, and handed over as a file descriptor through channel
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        # Only stream connections are handed over
+        self.type = socket.SOCK_STREAM
+        self.logger = logging.getLogger("ConnectionReceiver")
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def accept(self):
+        data, ancillary_data, _, _ = self.channel.recvmsg(1, socket.CMSG_SPACE(FD_SIZE))
+        if not data:
+            # The pool is gone without stopping the instance. This relies on the fuzzmon sigint handler to exit
+            self.logger.fatal("Lost the channel to the pool")
+            os.kill(os.getpid(), signal.SIGINT)
+            raise socket.error("Lost the channel to the pool")
+        for level, type_, fd_data in ancillary_data:
+            if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                socket_ = socket.socket(fileno=struct.unpack("i", fd_data[:FD_SIZE])[0])
+                try:
+                    address = socket_.getpeername()
+                except socket.error:
+                    address = None
+                return socket_, address
+        raise socket.error("No connection in message from the pool")
+
+    def close(self):
+        self.channel.close()
+
+
+class InstancePool(object):
+    """ Runs instances of the target, each in its own process with its own debugger, history and proxy, and
+    spreads downstream connections over the instances which are ready, in turn. The pool only accepts connections
+    and hands their file descriptors over to the instances, through a Unix socket pair each, so that data never goes
+    through the parent process. Connections are held while no instance is ready
+    """
+
+    def __init__(self, size, max_waiting=64):
+        self.size = size
+        # Parent and instance ends of the channel of each instance
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM) for _ in range(size)]
+        for channel, _ in self.channels:
+            channel.setblocking(False)
+        self.processes = []
+        self.status = [STATUS_DOWN] * size
+        self.next_instance = 0
+        self.status_read_fd, self.status_write_fd = os.pipe()
+        flags = fcntl.fcntl(self.status_read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.status_read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.pending_status = b""
+        # Downstream connections accepted while no instance is ready, oldest first
+        self.waiting = collections.deque()
+        self.max_waiting = max_waiting
+        self.selector = None
+        self.is_done = False
+        self.is_running = False
+        self.logger = logging.getLogger("InstancePool")
+
+    def start(self, server_socket, target, *args):
+        """ Calls target(index, channel, status_fd, *args) in a new process for each instance, where channel is the
+        instance end of its socket pair. Only the pool accepts on server_socket, which instances close
+        """
+        for index in range(self.size):
+            process = process_context.Process(target=self._run_instance, args=(index, server_socket, target) + args)
+            process.start()
+            self.logger.info("Started instance %d: %d" % (index, process.pid))
+            self.processes.append(process)
+        for _, instance_channel in self.channels:
+            instance_channel.close()
+
+    def serve(self, server_socket, timeout=None):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(server_socket, selectors.EVENT_READ)
+        self.selector.register(self.status_read_fd, selectors.EVENT_READ)
+        self.is_running = True
+        while self.is_running and not self.is_done:
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is server_socket:
+                    self._on_accept(server_socket)
+                else:
+                    self.on_status()
+        self.is_running = False
+
+    def stop(self):
+        self.is_running = False
+        if self.selector is not None:
+            for key in list(self.selector.get_map().values()):
+                if key.fileobj is not self.status_read_fd:
+                    key.fileobj.close()
+            self.selector.close()
+            self.selector = None
+        while self.waiting:
+            self.waiting.popleft().close()
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in self.processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                self.logger.warn("Killing instance which failed to stop: %d" % process.pid)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        self.processes = []
+        for channel, _ in self.channels:
+            channel.close()
+
+    def on_status(self):
+        """ Reads the status messages of the instances, and hands held connections over to the ready ones
+        """
+        try:
+            while True:
+                data = os.read(self.status_read_fd, 4096)
+                if not data:
+                    break
+                self.pending_status += data
+        except OSError as oe:
+            if oe.errno not in fuzznet.WOULD_BLOCK:
+                raise
+        size = struct.calcsize(STATUS_FORMAT)
+        while len(self.pending_status) >= size:
+            index, status = struct.unpack(STATUS_FORMAT, self.pending_status[:size])
+            self.pending_status = self.pending_status[size:]
+            self.logger.info("Instance %d is %s" % (index, ("down", "ready", "done")[status]))
+            self.status[index] = status
+        if all(status == STATUS_DONE for status in self.status):
+            self.logger.warn("All instances are done")
+            self.is_done = True
+        self._flush_waiting()
+
+    def is_ready(self):
+        return STATUS_READY in self.status
+
+    def select_instance(self):
+        """ Index of the next ready instance, in turn, or None
+        """
+        for i in range(self.size):
+            index = (self.next_instance + i) % self.size
+            if self.status[index] == STATUS_READY:
+                self.next_instance = index + 1
+                return index
+        return None
+
+    def dispatch(self, downstream_client_socket):
+        """ Hands a downstream connection over to the next ready instance, or holds it until one is ready
+        """
+        if self.waiting or not self._hand_over(downstream_client_socket):
+            self._hold(downstream_client_socket)
+
+    def _on_accept(self, server_socket):
+        try:
+            downstream_client_socket, _ = server_socket.accept()
+        except socket.error as se:
+            self.logger.debug("Failed to accept downstream connection: %s" % se)
+            return
+        self.dispatch(downstream_client_socket)
+
+    def _hand_over(self, downstream_client_socket):
+        """ Sends the connection to a ready instance, and closes it here. Returns False when no instance takes it
+        """
+        for _ in range(self.size):
+            index = self.select_instance()
+            if index is None:
+                return False
+            try:
+                self.channels[index][0].sendmsg([b"\0"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                                            struct.pack("i", downstream_client_socket.fileno()))])
+            except socket.error as se:
+                # The instance is not keeping up, or is gone
+                self.logger.debug("Failed to hand connection over to instance %d: %s" % (index, se))
+                continue
+            downstream_client_socket.close()
+            return True
+        return False
+
+    def _hold(self, downstream_client_socket):
+        if len(self.waiting) >= self.max_waiting:
+            self.logger.error("Too many connections waiting for an instance. Closing downstream: %s" %
+                              downstream_client_socket)
+            downstream_client_socket.close()
+        else:
+            self.waiting.append(downstream_client_socket)
+
+    def _flush_waiting(self):
+        while self.waiting and self._hand_over(self.waiting[0]):
+            self.waiting.popleft()
+
+    def _run_instance(self, index, server_socket, target, *args):
+        # Only the instance end of its own channel is kept
+        server_socket.close()
+        for i, (channel, instance_channel) in enumerate(self.channels):
+            channel.close()
+            if i != index:
+                instance_channel.close()
+        target(index, self.channels[index][1], self.status_write_fd, *args)
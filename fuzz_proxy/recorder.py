@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import array
+import itertools
+import time
+
+# Events, and the names of their two integer arguments. Sockets are given by file descriptor
+ACCEPT, CONNECT, HOLD, READ, SEND, CLOSE, STREAM, SIGNAL, EXIT, RESTART, READY = range(11)
+EVENTS = {ACCEPT: ("accept", ("downstream_fd", None)),
+          CONNECT: ("connect", ("downstream_fd", "upstream_fd")),
+          HOLD: ("hold", ("downstream_fd", "held")),
+          READ: ("read", ("fd", "size")),
+          # Bytes handed to the socket, sent right away or queued
+          SEND: ("send", ("fd", "size")),
+          CLOSE: ("close", ("fd", None)),
+          STREAM: ("stream", ("stream_id", "upstream_fd")),
+          SIGNAL: ("signal", ("pid", "signum")),
+          EXIT: ("exit", ("pid", "status")),
+          RESTART: ("restart", ("pid", None)),
+          READY: ("ready", (None, None))}
+# Events kept by default
+RECORDER_SIZE = 256
+
+
+class FlightRecorder(object):
+    """ Ring buffer of the last size events of the proxy and the debugger. Each event is a fixed size record of its
+    time, type and two integers, stored in preallocated arrays, so that recording costs a few stores and no
+    formatting. Events are only turned into dicts by describe(), when a crash is reported
+    """
+
+    def __init__(self, size=RECORDER_SIZE):
+        if size <= 0:
+            raise ValueError("size must be positive")
+        self.size = size
+        self.times = array.array("d", [0.0]) * size
+        self.events = array.array("b", [0]) * size
+        self.first_args = array.array("l", [0]) * size
+        self.second_args = array.array("l", [0]) * size
+        # next() of a count is atomic, so that the proxy and the debugger threads never get the same slot
+        self.counter = itertools.count()
+        self.recorded = 0
+
+    def record(self, event, first_arg=0, second_arg=0):
+        number = next(self.counter)
+        slot = number % self.size
+        self.times[slot] = time.time()
+        self.events[slot] = event
+        self.first_args[slot] = first_arg
+        self.second_args[slot] = second_arg
+        self.recorded = number + 1
+
+    def snapshot(self):
+        """ Raw copy of the recorded events, to be described later. Slots written while copying may hold events
+        newer than the others, so events are ordered by time
+        """
+        recorded = self.recorded
+        slots = range(recorded) if recorded <= self.size else \
+            [(recorded + i) % self.size for i in range(self.size)]
+        return sorted((self.times[slot], self.events[slot], self.first_args[slot], self.second_args[slot])
+                      for slot in slots)
+
+    @staticmethod
+    def describe(snapshot):
+        """ Events of a snapshot as dicts of their time, name and named arguments
+        """
+        events = []
+        for event_time, event, first_arg, second_arg in snapshot:
+            name, arg_names = EVENTS[event]
+            description = {"time": event_time, "event": name}
+            for arg_name, arg in zip(arg_names, (first_arg, second_arg)):
+                if arg_name is not None:
+                    description[arg_name] = arg
+            events.append(description)
+        return events
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import binascii
+import codecs
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import ptrace.error as perror
+import ptrace.signames
+
+import fuzz_proxy.helpers as fuzzhelp
+from fuzz_proxy.monitor import crash_signals, CrashBuckets, PtraceDbg
+from fuzz_proxy.mutator import INT_FORMATS
+from fuzz_proxy.network import StreamDirection
+from fuzz_proxy.pool import instance_address, instance_program, process_context, STOP_TIMEOUT
+
+VERDICT_CRASHED, VERDICT_SURVIVED, VERDICT_FAILED = "crashed", "survived", "failed"
+# How long a restarted target is given to listen again, and how often it is checked
+READY_TIMEOUT = 10
+READY_INTERVAL = 0.01
+
+logger = logging.getLogger("Replay")
+
+
+def delimiter(str_):
+    """ Parses a response delimiter, in which Python escape sequences such as \\r\\n or \\x00 are decoded
+    """
+    try:
+        value = codecs.escape_decode(str_.encode("utf-8"))[0]
+    except ValueError as ve:
+        raise argparse.ArgumentTypeError("Invalid delimiter: %s" % ve)
+    if not value:
+        raise argparse.ArgumentTypeError("Delimiter cannot be empty")
+    return value
+
+
+class RecordedLength(object):
+    """ A response is complete once it is as long as the recorded one
+    """
+
+    def is_complete(self, response, expected_length):
+        return len(response) >= expected_length
+
+
+class Delimiter(object):
+    """ A response is complete once it holds the delimiter
+    """
+
+    def __init__(self, delimiter):
+        self.delimiter = delimiter
+
+    def is_complete(self, response, expected_length):
+        return self.delimiter in response
+
+
+class LengthPrefix(object):
+    """ A response is complete once it holds as many bytes as its length field says. field is a LengthField, which
+    holds the number of bytes which follow it, plus delta
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.format = field.byteorder + INT_FORMATS[field.size]
+
+    def is_complete(self, response, expected_length):
+        end = self.field.offset + self.field.size
+        if len(response) < end:
+            return False
+        length = struct.unpack_from(self.format, response, self.field.offset)[0] - self.field.delta
+        return len(response) >= end + length
+
+
+class ReadAll(object):
+    """ A response is only complete when the peer closes the connection, or stays silent for the timeout
+    """
+
+    def is_complete(self, response, expected_length):
+        return False
+
+
+def replay_stream(socket_info, stream, timeout=1.0, size=4096, framing=None):
+    """ Sends the upstream packets of the stream, and reads a response for each of its downstream packets. A response
+    ends when framing finds it complete, by default once it is as long as the recorded one, so that the timeout only
+    applies to silent peers
+    """
+    if framing is None:
+        framing = RecordedLength()
+    client = None
+    succeeded = True
+    try:
+        client = socket.socket(socket_info[0], socket_info[1])
+        client.settimeout(timeout)
+        client.connect(fuzzhelp.to_host(socket_info[2]))
+        for pkt in stream:
+            logger.info("Attempting to replay packet: %s" % pkt)
+            try:
+                if pkt[0] == StreamDirection.UPSTREAM:
+                    logger.info("Got %s packet. Attempting to send" % pkt[0])
+                    client.sendall(binascii.unhexlify(pkt[1]))
+                    logger.debug("Successfully sent data upstream: %s" % pkt[1])
+                elif pkt[0] == StreamDirection.DOWNSTREAM:
+                    logger.info("Got %s packet. Entering receiving mode" % pkt[0])
+                    # Truncated packets carry their original length as a third element
+                    expected_length = pkt[2] if len(pkt) > 2 else len(pkt[1]) // 2
+                    response = bytearray()
+                    while not framing.is_complete(response, expected_length):
+                        try:
+                            data = client.recv(size)
+                            if not data:
+                                break
+                            response.extend(data)
+                        except socket.timeout:
+                            break
+                    logger.debug("Dumping received data from remote: %s" % binascii.hexlify(bytes(response)))
+                    logger.debug("Was expecting: %s" % pkt[1])
+                else:
+                    logger.warn("Invalid packet direction received: %s. Not able to replay packet" % pkt[0])
+                    raise RuntimeWarning()
+            except IndexError:
+                logger.warn("Invalid stream format: %s. Not able to replay packet" % pkt)
+                raise ValueError()
+    except socket.error as se:
+        succeeded = False
+        logger.warn("Stream replay failed: %s" % se)
+    finally:
+        if client is not None:
+            try:
+                client.close()
+            except socket.error:
+                pass
+    return succeeded
+
+
+def is_alive(socket_info, timeout=1.0):
+    return replay_stream(socket_info, [], timeout)
+
+
+def load_streams(path, replay_all=False):
+    """ Streams to replay from a crash report or test case: its last stream, preceded by its history with replay_all
+    """
+    with open(path, "r") as f:
+        metadata = json.load(f)
+    streams = list(metadata["history"]) if replay_all else []
+    streams.append(metadata["stream"])
+    return streams
+
+
+def find_test_cases(path):
+    """ Crash reports and test cases of a folder and its sub folders, such as the output folder of fuzzmon, in a
+    stable order. Bucket indexes are skipped
+    """
+    test_cases = []
+    for folder, folders, files in os.walk(path):
+        folders.sort()
+        for name in sorted(files):
+            if name.endswith(".json") and name != CrashBuckets.INDEX_FILE:
+                test_cases.append(os.path.join(folder, name))
+    return test_cases
+
+
+class ReplayWorker(object):
+    """ Runs one instance of the target under its own debugger, and replays test cases against it one at a time.
+    The debugger thread reports crash signals as soon as they are caught, so a crash is known without waiting for the
+    target to stop answering. Only test cases which do not crash the target wait for the full wait time
+    """
+
+    def __init__(self, index, program, socket_info, wait=0.5, replay_all=False, fork=False, no_stdout=True,
+                 timeout=1.0, framing=None):
+        self.index = index
+        self.socket_info = socket_info
+        self.wait = wait
+        self.replay_all = replay_all
+        self.timeout = timeout
+        self.framing = framing
+        options = argparse.Namespace(program=list(program), pid=None, fork=fork, trace_exec=False,
+                                     no_stdout=no_stdout)
+        self.debugger = PtraceDbg(options)
+        self.crashes = queue.Queue()
+        # Cleared while a crashed root process is replaced: until it is dead, it still holds its listening socket
+        self.restarted = threading.Event()
+        self.restarted.set()
+        self.is_down = False
+        self.thread = None
+        self.logger = logging.getLogger("ReplayWorker")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.debugger.watch, args=(self.on_signal, self.on_event, self.on_exit))
+        self.thread.start()
+
+    def stop(self):
+        self.debugger.stop()
+        if self.thread is not None:
+            self.thread.join()
+
+    def on_signal(self, signal_):
+        process = signal_.process
+        if signal_.signum in crash_signals:
+            self.logger.info("Process %d of instance %d received signal %d" % (process.pid, self.index,
+                                                                                signal_.signum))
+            if process.pid == self.debugger.root_pid:
+                self.restarted.clear()
+            self.crashes.put(signal_.signum)
+        try:
+            process.cont(signal_.signum)
+        except perror.PtraceError as pe:
+            self.logger.warn("Failed to propagate signal to traced process: %s" % pe)
+
+    def on_event(self, event):
+        self.logger.warn("Ignoring unhandled event: %s" % event)
+        self.debugger._ignore_ptrace_errors(event.process.cont)
+
+    def on_exit(self, event):
+        try:
+            process = self.debugger.spawn_traced_process()
+            self.logger.info("Restarted instance %d: %d" % (self.index, process.pid))
+        except IOError as ioe:
+            self.logger.fatal(ioe)
+            self.is_down = True
+        self.restarted.set()
+
+    def replay(self, test_case):
+        """ Verdict of a test case, the path of a JSON test case or a list of streams, as a dict holding at least its
+        verdict
+        """
+        streams = test_case
+        if not isinstance(test_case, list):
+            try:
+                streams = load_streams(test_case, self.replay_all)
+            except (IOError, ValueError, KeyError, TypeError) as e:
+                return {"verdict": VERDICT_FAILED, "error": "Invalid test case: %s" % e}
+        # Crashes caught after the wait time of the previous test case are not blamed on this one
+        self._next_crash(0)
+        if not self._wait_ready():
+            return {"verdict": VERDICT_FAILED, "error": "Target is not listening"}
+        for i, stream in enumerate(streams):
+            try:
+                succeeded = replay_stream(self.socket_info, stream, self.timeout, framing=self.framing)
+            except (RuntimeWarning, ValueError):
+                return {"verdict": VERDICT_FAILED, "error": "Invalid stream %d" % i}
+            # A connection reset by a crashing target is a crash, and otherwise a failure to replay
+            signum = self._next_crash(self.wait if i == len(streams) - 1 or not succeeded else 0)
+            if signum is not None:
+                return {"verdict": VERDICT_CRASHED, "signal": ptrace.signames.signalName(signum), "stream": i}
+            if not succeeded:
+                return {"verdict": VERDICT_FAILED, "error": "Replay of stream %d failed" % i}
+        return {"verdict": VERDICT_SURVIVED}
+
+    def _next_crash(self, timeout):
+        """ Signal number of the last crash caught since the previous call, or of the next one within timeout
+        """
+        signum = None
+        try:
+            while True:
+                signum = self.crashes.get_nowait()
+        except queue.Empty:
+            pass
+        if signum is None and timeout > 0:
+            try:
+                signum = self.crashes.get(timeout=timeout)
+            except queue.Empty:
+                pass
+        return signum
+
+    def _wait_ready(self):
+        deadline = time.time() + READY_TIMEOUT
+        # The listening socket of a crashed process is only gone once the debugger saw it die and restarted it
+        if not self.restarted.wait(READY_TIMEOUT):
+            return False
+        family, type_, address = self.socket_info
+        while not self.is_down and time.time() < deadline:
+            if fuzzhelp.is_listening(family, type_, address) is not False:
+                return True
+            time.sleep(READY_INTERVAL)
+        return False
+
+
+def run_worker(index, program, socket_info, jobs, results, options):
+    """ Entry point of the process of each instance of a batch replay. Replays the (key, test case) of jobs until it
+    gets None, and puts (key, verdict) to results. options are the keyword arguments of ReplayWorker
+    """
+    worker = ReplayWorker(index, program, socket_info, **options)
+    worker.start()
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            key, test_case = job
+            verdict = worker.replay(test_case)
+            verdict["instance"] = index
+            results.put((key, verdict))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+
+
+class BatchReplay(object):
+    """ Replays test cases in parallel against instances of the target, each traced by its own process. Instance i
+    listens on the upstream port plus i, or on the upstream path suffixed with i: {port}, {path} and {instance} in the
+    command line are replaced by its values
+    """
+
+    def __init__(self, program, socket_info, instances=1, **options):
+        self.program = program
+        self.socket_info = socket_info
+        self.instances = instances
+        # Keyword arguments of each ReplayWorker
+        self.options = options
+        self.processes = []
+        self.jobs = None
+        self.results = None
+        self.logger = logging.getLogger("BatchReplay")
+
+    def start(self):
+        self.jobs = process_context.Queue()
+        self.results = process_context.Queue()
+        family, type_, address = self.socket_info
+        for index in range(self.instances):
+            address_ = instance_address(family, address, index) if self.instances > 1 else address
+            program = instance_program(self.program, family, address_, index)
+            process = process_context.Process(target=run_worker,
+                                              args=(index, program, (family, type_, address_), self.jobs,
+                                                    self.results, self.options))
+            process.start()
+            self.logger.info("Started instance %d: %d" % (index, process.pid))
+            self.processes.append(process)
+
+    def run(self, paths, on_verdict=None):
+        """ Dict of the verdict of each path. on_verdict(path, verdict) is called as verdicts come in
+        """
+        self.start()
+        try:
+            return self.replay(dict((path, path) for path in paths), on_verdict)
+        finally:
+            self.close()
+
+    def replay(self, test_cases, on_verdict=None):
+        """ Dict of the verdict of each key of the test_cases dict. Test cases are paths of JSON test cases, or lists
+        of streams. Keys of test cases left when all instances died are missing
+        """
+        for key, test_case in sorted(test_cases.items()):
+            self.jobs.put((key, test_case))
+        verdicts = {}
+        while len(verdicts) < len(test_cases):
+            try:
+                key, verdict = self.results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    self.logger.error("All instances exited with %d test cases left" %
+                                      (len(test_cases) - len(verdicts)))
+                    break
+                continue
+            verdicts[key] = verdict
+            if on_verdict is not None:
+                on_verdict(key, verdict)
+        return verdicts
+
+    def close(self):
+        for _ in self.processes:
+            self.jobs.put(None)
+        for process in self.processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                self.logger.warn("Killing instance which failed to stop: %d" % process.pid)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        self.processes = []
+
+
+def ddmin(items, test):
+    """ Delta debugging: a small sublist of items, in their order, for which test still holds. test gets a list of
+    candidates and returns whether it holds for each, so that all candidates of a round are tested at once
+    """
+    granularity = 2
+    while len(items) >= 2:
+        size = len(items)
+        bounds = [size * i // granularity for i in range(granularity + 1)]
+        chunks = [items[bounds[i]:bounds[i + 1]] for i in range(granularity)]
+        candidates = list(chunks)
+        # With two chunks, complements are the chunks themselves
+        if granularity > 2:
+            candidates.extend(items[:bounds[i]] + items[bounds[i + 1]:] for i in range(granularity))
+        results = test(candidates)
+        holding = [i for i, result in enumerate(results) if result]
+        if holding and holding[0] < granularity:
+            items, granularity = candidates[holding[0]], 2
+        elif holding:
+            items, granularity = candidates[holding[0]], max(granularity - 1, 2)
+        elif granularity >= size:
+            break
+        else:
+            granularity = min(2 * granularity, size)
+    return items
+
+
+class Minimizer(object):
+    """ Shrinks the streams of a crash report to a small reproducer, by delta debugging: first the streams of its
+    history, then the packets of each stream, then the bytes of each upstream packet. A candidate is kept when it
+    crashes the target with the same signal as the original streams. The candidates of each round are replayed in
+    parallel by a started BatchReplay
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.signal = None
+        # Verdict of each candidate already replayed
+        self.crashes = {}
+        self.replays = 0
+        self.logger = logging.getLogger("Minimizer")
+
+    def minimize(self, streams):
+        """ Minimized streams, the crashing one last. Raises ValueError when the streams do not crash the target
+        """
+        verdict = self.batch.replay({0: streams}).get(0, {})
+        self.replays += 1
+        if verdict.get("verdict") != VERDICT_CRASHED:
+            raise ValueError("Streams do not crash the target: %s" % verdict.get("error", verdict.get("verdict")))
+        self.signal = verdict["signal"]
+        # Streams after the crashing one are not needed
+        streams = [list(stream) for stream in streams[:verdict["stream"] + 1]]
+        streams = ddmin(streams, self._crash)
+        self.logger.info("Minimized to %d streams" % len(streams))
+        for i in range(len(streams)):
+            streams[i] = ddmin(streams[i], lambda candidates: self._crash_packets(streams, i, candidates))
+        self.logger.info("Minimized to %d packets" % sum(len(stream) for stream in streams))
+        for i, stream in enumerate(streams):
+            for j, pkt in enumerate(stream):
+                if pkt[0] == StreamDirection.UPSTREAM:
+                    data = ddmin(bytearray(binascii.unhexlify(pkt[1])),
+                                 lambda candidates: self._crash_bytes(streams, i, j, candidates))
+                    stream[j] = self._upstream(data)
+        return streams
+
+    def _crash_packets(self, streams, i, candidates):
+        return self._crash([self._replace(streams, i, packets) for packets in candidates])
+
+    def _crash_bytes(self, streams, i, j, candidates):
+        return self._crash([self._replace(streams, i, self._replace(streams[i], j, self._upstream(data)))
+                            for data in candidates])
+
+    def _crash(self, candidates):
+        keys = [json.dumps(candidate, sort_keys=True) for candidate in candidates]
+        pending = dict((key, candidate) for key, candidate in zip(keys, candidates) if key not in self.crashes)
+        verdicts = self.batch.replay(pending)
+        self.replays += len(pending)
+        for key in pending:
+            verdict = verdicts.get(key, {})
+            self.crashes[key] = verdict.get("verdict") == VERDICT_CRASHED and verdict["signal"] == self.signal
+        return [self.crashes[key] for key in keys]
+
+    def _replace(self, items, index, item):
+        return items[:index] + [item] + items[index + 1:]
+
+    def _upstream(self, data):
+        return [StreamDirection.UPSTREAM, binascii.hexlify(bytes(data)).decode("ascii")]
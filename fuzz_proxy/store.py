@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+
+
+class Segment(object):
+    """ Append-only data file, and the index of fixed size entries which locates what it holds. Entries are only
+    written once the data they point to is synced, and an entry torn by a crash is dropped when the segment is
+    appended to again
+    """
+
+    def __init__(self, path, entry_format):
+        self.data_path = path + ".seg"
+        self.index_path = path + ".idx"
+        self.entry_format = entry_format
+        self.entry_size = struct.calcsize(entry_format)
+        self.data_file = None
+        self.index_file = None
+        self.read_file = None
+
+    def read_index(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                index = f.read()
+        except IOError:
+            return []
+        size = len(index) - len(index) % self.entry_size
+        return [struct.unpack_from(self.entry_format, index, offset) for offset in range(0, size, self.entry_size)]
+
+    def write(self, blobs):
+        """ Appends and syncs the blobs. Returns their offsets
+        """
+        if self.data_file is None:
+            self._open()
+        offsets = []
+        for blob in blobs:
+            offsets.append(self.data_file.tell())
+            self.data_file.write(blob)
+        self._sync(self.data_file)
+        return offsets
+
+    def write_index(self, entries):
+        if self.index_file is None:
+            self._open()
+        self.index_file.write(b"".join(struct.pack(self.entry_format, *entry) for entry in entries))
+        self._sync(self.index_file)
+
+    def read(self, offset, length):
+        if self.read_file is None:
+            self.read_file = open(self.data_path, "rb")
+        self.read_file.seek(offset)
+        return self.read_file.read(length)
+
+    def close(self):
+        for f in (self.data_file, self.index_file, self.read_file):
+            if f is not None:
+                f.close()
+        self.data_file = self.index_file = self.read_file = None
+
+    def _open(self):
+        self.index_file = open(self.index_path, "ab")
+        size = self.index_file.tell()
+        if size % self.entry_size:
+            self.index_file.truncate(size - size % self.entry_size)
+        # Data written after the last entry is never referenced, new data goes after it
+        self.data_file = open(self.data_path, "ab")
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class CrashStore(object):
+    """ Append-only store of crash reports. The data of each packet is stored once per content hash, raw, in a
+    packet segment, so that the history which consecutive crashes share is only written once. Reports go to a record
+    segment, as compact JSON which refers to packets by hash.
+
+    Writes are batched in memory, and flushed with an fsync once batch_size reports are pending or flush_interval
+    seconds went by. export() writes the reports back as the JSON test cases of CrashReport.to_json
+    """
+
+    FOLDER = "store"
+    # Hash, offset and length of each packet, and offset and length of each record
+    PACKET_ENTRY = "!20sQI"
+    RECORD_ENTRY = "!QI"
+
+    def __init__(self, folder, batch_size=64, flush_interval=10):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.packet_segment = Segment(os.path.join(folder, "packets"), CrashStore.PACKET_ENTRY)
+        self.record_segment = Segment(os.path.join(folder, "records"), CrashStore.RECORD_ENTRY)
+        self.packets = dict((digest, (offset, length)) for digest, offset, length in self.packet_segment.read_index())
+        self.records = self.record_segment.read_index()
+        self.pending_packets = {}
+        self.pending_records = []
+        self.last_flush = time.time()
+        self.logger = logging.getLogger("CrashStore")
+
+    def add(self, crash_report, name):
+        """ Appends the enriched crash report, to be exported as name. Returns its number
+        """
+        record = crash_report.to_dict()
+        record["stream"] = self._add_stream(crash_report.raw_stream)
+        record["history"] = [self._add_stream(stream) for stream in crash_report.raw_history]
+        record["name"] = name
+        self.pending_records.append(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+        number = len(self) - 1
+        if len(self.pending_records) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return number
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.pending_records:
+            return
+        digests = list(self.pending_packets)
+        packets = [self.pending_packets[digest] for digest in digests]
+        packet_offsets = self.packet_segment.write(packets)
+        record_offsets = self.record_segment.write(self.pending_records)
+        # Records are indexed last, so that an indexed record never refers to a missing packet
+        packet_entries = list(zip(digests, packet_offsets, [len(packet) for packet in packets]))
+        self.packet_segment.write_index(packet_entries)
+        record_entries = list(zip(record_offsets, [len(record) for record in self.pending_records]))
+        self.record_segment.write_index(record_entries)
+        for digest, offset, length in packet_entries:
+            self.packets[digest] = (offset, length)
+        self.records.extend(record_entries)
+        self.logger.info("Flushed %d reports and %d new packets" % (len(record_entries), len(packet_entries)))
+        self.pending_packets = {}
+        self.pending_records = []
+
+    def get(self, number):
+        """ Report number, in the layout of CrashReport.to_json, along with the name it is exported as
+        """
+        self.flush()
+        offset, length = self.records[number]
+        record = json.loads(self.record_segment.read(offset, length).decode("utf-8"))
+        record["stream"] = self._load_stream(record["stream"])
+        record["history"] = [self._load_stream(stream) for stream in record["history"]]
+        return record
+
+    def export(self, folder):
+        """ Writes each report as a JSON test case under folder, at the path of the file it would have been written
+        to without a store. Returns the paths
+        """
+        paths = []
+        for number in range(len(self)):
+            record = self.get(number)
+            path = os.path.join(folder, record.pop("name"))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                json.dump(record, f, indent=4)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        self.flush()
+        self.packet_segment.close()
+        self.record_segment.close()
+
+    def __len__(self):
+        return len(self.records) + len(self.pending_records)
+
+    def _add_stream(self, stream):
+        # Truncated packets carry their original length as a third element
+        references = []
+        for pkt in stream:
+            data = bytes(pkt[1])
+            digest = hashlib.sha1(data).digest()
+            if digest not in self.packets:
+                self.pending_packets[digest] = data
+            references.append([pkt[0], binascii.hexlify(digest).decode("ascii")] + list(pkt[2:]))
+        return references
+
+    def _load_stream(self, references):
+        stream = []
+        for reference in references:
+            offset, length = self.packets[binascii.unhexlify(reference[1])]
+            data = self.packet_segment.read(offset, length)
+            stream.append([reference[0], binascii.hexlify(data).decode("ascii")] + reference[2:])
+        return stream
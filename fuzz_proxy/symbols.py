@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import collections
+import logging
+import os
+import re
+import struct
+
+from ptrace.ctypes_tools import formatAddress
+
+# Matches
+# '7fb7b25ae000-7fb7b2730000 r-xp 00000000 08:01 1234 /lib/x86_64-linux-gnu/libc-2.13.so'
+# '00df5000-00e16000 rwxp 00000000 00:00 0          [heap]'
+# '7fb7b2b56000-7fb7b2b59000 rwxp 00000000 00:00 0'
+# Into start/stop address, permissions, file offset, binary
+MAPS_REGEXP = re.compile(r"([0-9a-fA-F]+)-([0-9a-fA-F]+)\s(\S{4})\s([0-9a-fA-F]+)\s\S+\s\d+\s*(.*)")
+# Symbol tables of binaries kept by a cache
+CACHE_SIZE = 64
+
+ELF_MAGIC = b"\x7fELF"
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+STT_FUNC = 2
+STT_GNU_IFUNC = 10
+# Layouts of the ELF header after e_ident, program headers, section headers and symbols, for 32 and 64 bit binaries
+ELF_LAYOUTS = {1: ("HHIIIIIHHHHHH", "IIIIIIII", "IIIIIIIIII", "IIIBBH"),
+               2: ("HHIQQQIHHHHHH", "IIQQQQQQ", "IIQQQQIIQQ", "IBBHQQ")}
+
+logger = logging.getLogger("Symbols")
+
+
+class MapsLayout(object):
+    """ Mappings of a /proc/pid/maps text, sorted by start address, so that the mapping of an address is found by
+    bisection
+    """
+
+    def __init__(self, raw_maps):
+        # (start, stop, file offset, binary) of each mapping, and the formatted mappings of crash reports
+        self.modules = []
+        self.maps = []
+        self.stack = None
+        for line in raw_maps.splitlines():
+            match = MAPS_REGEXP.match(line)
+            if match is None:
+                continue
+            start_addr, stop_addr, perms, offset, binary = match.groups()
+            start_addr, stop_addr, binary = int(start_addr, 16), int(stop_addr, 16), binary.strip()
+            self.modules.append((start_addr, stop_addr, int(offset, 16), binary))
+            self.maps.append(((formatAddress(start_addr), formatAddress(stop_addr)), binary, perms))
+            if binary == "[stack]":
+                self.stack = "%s-%s => [stack] (%s)" % (formatAddress(start_addr), formatAddress(stop_addr), perms)
+        self.modules.sort()
+        self.starts = [module[0] for module in self.modules]
+
+    def find(self, address):
+        """ (start, stop, file offset, binary) of the mapping holding address, or None
+        """
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index >= 0 and address < self.modules[index][1]:
+            return self.modules[index]
+        return None
+
+    def locate(self, address):
+        """ Binary holding address, and the offset of address within the binary file, which do not change with ASLR.
+        None for addresses in anonymous mappings, such as the heap or the stack, or in no mapping
+        """
+        module = self.find(address)
+        if module is None or module[3] == "" or module[3].startswith("["):
+            return None
+        start_addr, _, offset, binary = module
+        return binary, address - start_addr + offset
+
+    def relative_address(self, address):
+        """ Address as binary+0x1234, or as the absolute address when it is not in a binary
+        """
+        location = self.locate(address)
+        if location is None:
+            return hex(address)
+        return "%s+0x%x" % (os.path.basename(location[0]), location[1])
+
+
+class SymbolTable(object):
+    """ Functions of an ELF binary, from its symbol table, or its dynamic one once stripped, sorted by address. Its
+    loadable segments turn the file offsets of mappings into the addresses of symbols
+    """
+
+    def __init__(self, path):
+        # Parallel arrays sorted by address
+        self.addresses = []
+        self.sizes = []
+        self.names = []
+        # (file offset, file size, address) of each loadable segment
+        self.segments = []
+        with open(path, "rb") as f:
+            self._parse(f)
+
+    def lookup(self, offset):
+        """ Name of the function holding file offset, as function+0x12, or None
+        """
+        address = self._to_address(offset)
+        if address is None:
+            return None
+        index = bisect.bisect_right(self.addresses, address) - 1
+        if index < 0 or address >= self.addresses[index] + max(self.sizes[index], 1):
+            return None
+        delta = address - self.addresses[index]
+        return "%s+0x%x" % (self.names[index], delta) if delta else self.names[index]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def _to_address(self, offset):
+        for segment_offset, size, address in self.segments:
+            if segment_offset <= offset < segment_offset + size:
+                return offset - segment_offset + address
+        return None
+
+    def _parse(self, f):
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ValueError("Not an ELF binary")
+        elf_class, data = struct.unpack_from("BB", ident, 4)
+        if elf_class not in ELF_LAYOUTS or data not in (1, 2):
+            raise ValueError("Unsupported ELF class or data encoding")
+        endianness = "<" if data == 1 else ">"
+        header, program_header, section_header, symbol = [struct.Struct(endianness + layout)
+                                                          for layout in ELF_LAYOUTS[elf_class]]
+        _, _, _, _, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum, _ = header.unpack(f.read(header.size))
+        f.seek(phoff)
+        table = f.read(phentsize * phnum)
+        for index in range(phnum):
+            fields = program_header.unpack_from(table, index * phentsize)
+            if elf_class == 2:
+                p_type, p_offset, p_vaddr, p_filesz = fields[0], fields[2], fields[3], fields[5]
+            else:
+                p_type, p_offset, p_vaddr, p_filesz = fields[0], fields[1], fields[2], fields[4]
+            if p_type == PT_LOAD:
+                self.segments.append((p_offset, p_filesz, p_vaddr))
+        f.seek(shoff)
+        table = f.read(shentsize * shnum)
+        # (type, offset, size, link, entry size) of each section
+        sections = []
+        for index in range(shnum):
+            fields = section_header.unpack_from(table, index * shentsize)
+            sections.append((fields[1], fields[4], fields[5], fields[6], fields[9]))
+        functions = {}
+        # The full symbol table comes first, so that its names win over the ones of the dynamic table
+        for wanted_type in (SHT_SYMTAB, SHT_DYNSYM):
+            for section_type, offset, size, link, entry_size in sections:
+                if section_type != wanted_type or entry_size < symbol.size or link >= len(sections):
+                    continue
+                f.seek(offset)
+                symbols = f.read(size)
+                f.seek(sections[link][1])
+                strings = f.read(sections[link][2])
+                for symbol_offset in range(0, len(symbols) - symbol.size + 1, entry_size):
+                    fields = symbol.unpack_from(symbols, symbol_offset)
+                    if elf_class == 2:
+                        name, info, value, symbol_size = fields[0], fields[1], fields[4], fields[5]
+                    else:
+                        name, value, symbol_size, info = fields[0], fields[1], fields[2], fields[3]
+                    if info & 0xf not in (STT_FUNC, STT_GNU_IFUNC) or value == 0 or value in functions:
+                        continue
+                    end = strings.find(b"\0", name)
+                    functions[value] = (symbol_size, strings[name:end if end >= 0 else None].decode("utf-8", "replace"))
+        for address in sorted(functions):
+            size, name = functions[address]
+            self.addresses.append(address)
+            self.sizes.append(size)
+            self.names.append(name)
+
+
+class SymbolCache(object):
+    """ Symbol tables of binaries, kept across crashes and restarts of the target. Maps change with ASLR on each
+    restart, and are cheap to parse, but binaries stay the same: they are keyed by path, device, inode, modification
+    time and size, so that only a rebuilt binary is parsed again. Least recently used tables are dropped first
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.tables = collections.OrderedDict()
+
+    def symbols(self, path):
+        """ Symbol table of the binary at path, or None when it cannot be read
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (path, stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+        if key in self.tables:
+            # Moved to the most recently used end
+            table = self.tables.pop(key)
+            self.tables[key] = table
+            return table
+        try:
+            table = SymbolTable(path)
+        except (IOError, OSError, ValueError, struct.error) as e:
+            logger.debug("No symbols for %s: %s" % (path, e))
+            table = None
+        if len(self.tables) >= self.size:
+            self.tables.popitem(last=False)
+        self.tables[key] = table
+        return table
+
+    def resolve(self, layout, address):
+        """ Name of address which does not change with ASLR: binary!function+0x12 when the function is known,
+        binary+0x1234 otherwise, with the offset within the binary file. Anonymous mappings give the absolute address
+        """
+        location = layout.locate(address)
+        if location is not None:
+            binary, file_offset = location
+            table = self.symbols(binary)
+            function = table.lookup(file_offset) if table is not None else None
+            if function is not None:
+                return "%s!%s" % (os.path.basename(binary), function)
+        return layout.relative_address(address)
+
+
+# Shared by the crash reports of the process
+default_cache = SymbolCache()
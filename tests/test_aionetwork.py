@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+from fuzz_proxy.aionetwork import AsyncDownstream, AsyncProxyHooks
+from tests.test_network import StreamProxyTests, wait_until
+
+
+class SlowHooks(AsyncProxyHooks):
+    """ Holds packets starting with "slow" until released
+    """
+
+    def __init__(self):
+        super(SlowHooks, self).__init__()
+        self.released = None
+
+    async def pre_upstream_send(self, channel, data):
+        if data.startswith(b"slow"):
+            self.released = asyncio.Event()
+            await self.released.wait()
+        return data
+
+
+class TestAsyncDownstream(StreamProxyTests, unittest.TestCase):
+    engine = AsyncDownstream
+
+    def test_slow_hooks_only_delay_their_own_connection(self):
+        hooks = SlowHooks()
+        address = self.start_proxy(hooks)
+        slow = self.connect(address)
+        slow.sendall(b"slow")
+        slow_upstream = self.accept()
+        fast = self.connect(address)
+        fast.sendall(b"fast")
+        self.assertEqual(self.accept().recv(100), b"fast")
+        self.assertTrue(wait_until(lambda: hooks.released is not None))
+        self.proxy.loop.call_soon_threadsafe(hooks.released.set)
+        self.assertEqual(slow_upstream.recv(100), b"slow")
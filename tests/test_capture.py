@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from fuzz_proxy.capture import checksum, PcapFormat, read_segment, TrafficCapture
+from fuzz_proxy.network import StreamDirection
+
+
+class TestTrafficCapture(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def files(self):
+        return [os.path.join(self.folder, name) for name in sorted(os.listdir(self.folder))]
+
+    def test_segment_files_hold_every_packet(self):
+        capture = TrafficCapture(self.folder, "segment")
+        capture.start()
+        capture.record(0, StreamDirection.UPSTREAM, memoryview(b"hello"))
+        capture.record(1, StreamDirection.UPSTREAM, b"")
+        capture.record(0, StreamDirection.DOWNSTREAM, bytearray(b"world"))
+        capture.close()
+        packets = [packet[1:] for path in self.files() for packet in read_segment(path)]
+        self.assertEqual(packets, [(0, StreamDirection.UPSTREAM, b"hello"), (1, StreamDirection.UPSTREAM, b""),
+                                   (0, StreamDirection.DOWNSTREAM, b"world")])
+
+    def test_files_are_rotated_by_size(self):
+        capture = TrafficCapture(self.folder, "segment", max_file_size=1000)
+        capture.start()
+        for i in range(30):
+            capture.record(i, StreamDirection.UPSTREAM, b"x" * 100)
+        capture.close()
+        self.assertGreater(len(self.files()), 2)
+        self.assertTrue(all(os.path.getsize(path) < 1000 + 200 for path in self.files()))
+        self.assertEqual([packet[1] for path in self.files() for packet in read_segment(path)], list(range(30)))
+        # A new session goes on with the next file
+        TrafficCapture(self.folder, "segment").close()
+        capture = TrafficCapture(self.folder, "segment")
+        self.assertEqual(capture.file_number, len(self.files()))
+
+    def test_packets_are_dropped_when_the_writer_falls_behind(self):
+        capture = TrafficCapture(self.folder, "segment", max_pending=250)
+        for _ in range(5):
+            capture.record(0, StreamDirection.UPSTREAM, b"x" * 100)
+        self.assertEqual(capture.dropped, 3)
+        capture.start()
+        capture.close()
+        self.assertEqual(len(list(read_segment(self.files()[0]))), 2)
+
+
+class TestPcapFormat(unittest.TestCase):
+    def frames(self, data):
+        frames = []
+        offset = 0
+        while offset < len(data):
+            length = struct.unpack_from("<I", data, offset + 8)[0]
+            frames.append(data[offset + 16:offset + 16 + length])
+            offset += 16 + length
+        return frames
+
+    def test_channels_are_tcp_streams(self):
+        pcap = PcapFormat("tcp", 5555)
+        frames = self.frames(pcap.pack(1.5, 258, StreamDirection.UPSTREAM, b"abc") +
+                             pcap.pack(1.6, 258, StreamDirection.DOWNSTREAM, b"de") +
+                             pcap.pack(1.7, 258, StreamDirection.UPSTREAM, b"f"))
+        self.assertEqual(checksum(frames[0][:20]), 0)
+        self.assertEqual(frames[0][12:20], b"\x0a\x00\x01\x02\xac\x10\x00\x01")
+        sport, dport, seq, ack = struct.unpack("!HHII", frames[0][20:32])
+        self.assertEqual((dport, seq, ack), (5555, 1, 1))
+        self.assertEqual(struct.unpack("!HHII", frames[1][20:32])[1:], (sport, 1, 4))
+        self.assertEqual(struct.unpack("!II", frames[2][24:32]), (4, 3))
+        self.assertEqual(frames[2][40:], b"f")
+
+    def test_big_packets_are_split_over_frames(self):
+        frames = self.frames(PcapFormat("udp", 53).pack(0, 0, StreamDirection.UPSTREAM, b"x" * 70000))
+        self.assertEqual([len(frame) - 28 for frame in frames], [65507, 70000 - 65507])
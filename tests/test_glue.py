@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
+import signal
+import socket
+import tempfile
 import unittest
-from fuzz_proxy.glue import Dequeue
+from fuzz_proxy.glue import DebuggingHooks
+from fuzz_proxy.helpers import Dequeue, is_listening
+from fuzz_proxy.monitor import CrashReport
+from fuzz_proxy.network import StreamDirection
 
 
 class TestDequeue(unittest.TestCase):
@@ -29,3 +37,77 @@ class TestDequeue(unittest.TestCase):
         v = d.popleft()
         self.assertEqual(v, 1)
         self.assertEqual(d, Dequeue([2, 3, 4]))
+
+
+class TestIsListening(unittest.TestCase):
+    def setUp(self):
+        self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket_.bind(("127.0.0.1", 0))
+        self.address = self.socket_.getsockname()
+
+    def tearDown(self):
+        self.socket_.close()
+
+    def test_bound_stream_socket_is_not_listening(self):
+        self.assertFalse(is_listening(socket.AF_INET, socket.SOCK_STREAM, self.address))
+
+    def test_listening_stream_socket_is_found(self):
+        self.socket_.listen(1)
+        self.assertTrue(is_listening(socket.AF_INET, socket.SOCK_STREAM, self.address))
+
+    def test_bound_datagram_socket_is_found(self):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(("127.0.0.1", 0))
+        try:
+            self.assertTrue(is_listening(socket.AF_INET, socket.SOCK_DGRAM, udp_socket.getsockname()))
+        finally:
+            udp_socket.close()
+
+    def test_listening_unix_socket_is_found_by_path(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "server.sock")
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            unix_socket.bind(path)
+            unix_socket.listen(1)
+            self.assertTrue(is_listening(socket.AF_UNIX, socket.SOCK_STREAM, path))
+            self.assertTrue(is_listening(socket.AF_UNIX, socket.SOCK_STREAM, (path,)))
+        finally:
+            unix_socket.close()
+            shutil.rmtree(folder)
+
+
+class StoppedDebugger(object):
+    """ Debugger of a target which is already gone
+    """
+
+    def watch(self, on_signal, on_event, on_exit):
+        pass
+
+    def stop(self):
+        pass
+
+
+class TestDebuggingHooks(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.hooks = DebuggingHooks(StoppedDebugger(), "session", self.folder, restart_delay=-1, spill_threshold=4)
+        self.sockets = socket.socketpair()
+        self.channel = {StreamDirection.DOWNSTREAM: self.sockets[0], StreamDirection.UPSTREAM: self.sockets[1]}
+
+    def tearDown(self):
+        self.hooks.close()
+        for socket_ in self.sockets:
+            socket_.close()
+        shutil.rmtree(self.folder)
+
+    def test_streams_are_still_recorded_and_dumped_after_shutdown(self):
+        self.hooks.pre_upstream_send(self.channel, b"spilled")
+        self.hooks._shutdown()
+        self.assertTrue(self.hooks.is_done)
+        # The proxy loop only sees is_done once it handles its current events
+        self.hooks.pre_upstream_send(self.channel, b"spilled again")
+        self.hooks.crash_events.put(CrashReport("session", 1, signal.SIGSEGV, 0))
+        self.hooks.on_wakeup()
+        crash_report = self.hooks.crash_reports.get_nowait()
+        self.assertEqual(crash_report.stream, [("upstream", b"spilled"), ("upstream", b"spilled again")])
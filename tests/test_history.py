@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from fuzz_proxy.history import SpillFile, Stream, StreamHistory
+
+
+class TestStream(unittest.TestCase):
+    def test_packets_are_returned_in_order(self):
+        s = Stream(64, 4)
+        s.append("upstream", b"abc")
+        s.append("downstream", b"def")
+        self.assertEqual(list(s), [("upstream", b"abc"), ("downstream", b"def")])
+
+    def test_oldest_packet_is_dropped_when_max_pkts_is_reached(self):
+        s = Stream(64, 2)
+        for data in (b"1", b"2", b"3"):
+            s.append("upstream", data)
+        self.assertEqual(list(s), [("upstream", b"2"), ("upstream", b"3")])
+
+    def test_arena_wraps_around_and_drops_overwritten_packets(self):
+        s = Stream(10, 10)
+        for data in (b"aaaa", b"bbbb", b"cccc"):
+            s.append("upstream", data)
+        self.assertEqual(list(s), [("upstream", b"bbbb"), ("upstream", b"cccc")])
+        s.append("upstream", b"dd")
+        self.assertEqual(list(s), [("upstream", b"cccc"), ("upstream", b"dd")])
+
+    def test_wrapping_twice_drops_every_overwritten_packet(self):
+        s = Stream(100, 10)
+        for data in (b"A" * 95, b"B" * 5, b"C" * 10, b"D" * 91):
+            s.append("upstream", data)
+        self.assertEqual(list(s), [("upstream", b"D" * 91)])
+
+    def test_spilled_packets_ahead_of_an_overwritten_one_are_dropped(self):
+        s = Stream(10, 10, can_grow=False, spill=SpillFile(), spill_threshold=6)
+        for data in (b"S" * 8, b"aaaa", b"bbbb", b"cccc"):
+            s.append("upstream", data)
+        self.assertEqual(list(s), [("upstream", b"bbbb"), ("upstream", b"cccc")])
+        s.spill.close()
+
+    def test_packet_larger_than_arena_grows_it_and_keeps_previous_packets(self):
+        s = Stream(4, 10)
+        s.append("upstream", b"ab")
+        s.append("downstream", b"0123456789")
+        self.assertEqual(list(s), [("upstream", b"ab"), ("downstream", b"0123456789")])
+
+    def test_data_is_copied(self):
+        s = Stream(16, 4)
+        buf = bytearray(b"abcd")
+        s.append("upstream", memoryview(buf))
+        buf[:] = b"wxyz"
+        self.assertEqual(list(s), [("upstream", b"abcd")])
+
+
+class TestStreamHistory(unittest.TestCase):
+    def test_non_positive_sizes_raise_value_error(self):
+        with self.assertRaises(ValueError):
+            StreamHistory(max_streams=0)
+
+    def test_packets_of_a_channel_go_to_the_same_stream(self):
+        h = StreamHistory(2, 4)
+        first = h.record("a", "upstream", b"1")
+        second = h.record("a", "downstream", b"2")
+        self.assertIs(first, second)
+        self.assertEqual(len(h), 1)
+        self.assertEqual(first.stream_id, 0)
+
+    def test_least_recently_used_stream_is_recycled(self):
+        h = StreamHistory(2, 4)
+        h.record("a", "upstream", b"1")
+        h.record("b", "upstream", b"2")
+        h.record("a", "upstream", b"3")
+        h.record("c", "upstream", b"4")
+        self.assertIsNone(h.get("b"))
+        self.assertEqual([s.channel for s in h], ["a", "c"])
+        self.assertEqual(list(h.get("c")), [("upstream", b"4")])
+        self.assertEqual(h.stream_counter, 2)
+
+
+class TestStreamHistoryBudget(unittest.TestCase):
+    def test_budget_is_shared_between_streams_and_truncates_oversized_packets(self):
+        h = StreamHistory(2, 4, memory_budget=16)
+        stream = h.record("a", "upstream", b"0123456789")
+        self.assertEqual(len(stream.arena), 8)
+        self.assertEqual(list(stream), [("upstream", b"01234567", 10)])
+
+    def test_packets_above_spill_threshold_are_read_back_from_disk(self):
+        h = StreamHistory(2, 4, memory_budget=16, spill_threshold=4)
+        h.record("a", "upstream", b"ab")
+        stream = h.record("a", "downstream", b"0123456789")
+        h.record("a", "upstream", b"cd")
+        self.assertEqual(list(stream), [("upstream", b"ab"), ("downstream", b"0123456789"), ("upstream", b"cd")])
+        h.close()
+
+    def test_max_pkt_size_truncates_and_records_original_length(self):
+        h = StreamHistory(2, 4, max_pkt_size=3, spill_threshold=2)
+        stream = h.record("a", "upstream", b"0123456789")
+        self.assertEqual(list(stream), [("upstream", b"012", 10)])
+        h.close()
+
+    def test_spill_file_compaction_keeps_live_packets(self):
+        h = StreamHistory(1, 2, spill_threshold=0)
+        h.spill.max_size = 8
+        for data in (b"aaaa", b"bbbb", b"cccc"):
+            stream = h.record("a", "upstream", data)
+        self.assertEqual(h.spill.size, 8)
+        self.assertEqual(list(stream), [("upstream", b"bbbb"), ("upstream", b"cccc")])
+        h.close()
+
+    def test_spill_file_is_only_compacted_once_it_doubled(self):
+        h = StreamHistory(1, 2, spill_threshold=0)
+        h.spill.max_size = 4
+        spills = set()
+        for data in (b"aaaa", b"bbbb", b"cccc", b"dddd", b"eeee", b"ffff"):
+            h.record("a", "upstream", data)
+            spills.add(h.spill)
+        # Compacted once over max_size, at 8 bytes of which all are live, and then only once past 16 bytes
+        self.assertEqual(len(spills), 3)
+        self.assertEqual((h.spill.size, h.spill.live_size), (12, 8))
+        h.close()
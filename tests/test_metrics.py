@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from fuzz_proxy.metrics import Histogram, Metrics, MetricsReporter
+
+
+class TestHistogram(unittest.TestCase):
+    def test_quantiles_are_bucket_upper_bounds(self):
+        histogram = Histogram(bounds=(1, 2, 4, 8))
+        for value in (0.5, 1.5, 1.5, 3, 7):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 2)
+        self.assertEqual(histogram.quantile(0.99), 8)
+        self.assertEqual(histogram.to_dict()["buckets"], {"1": 1, "2": 2, "4": 1, "8": 1})
+
+    def test_overflow_quantile_is_the_largest_value(self):
+        histogram = Histogram(bounds=(1,))
+        histogram.observe(42)
+        self.assertEqual(histogram.quantile(0.5), 42)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_rates_are_computed_since_previous_snapshot(self):
+        metrics = Metrics()
+        metrics.inc("proxy.connections", 10)
+        previous = metrics.snapshot()
+        previous["time"] -= 2
+        metrics.inc("proxy.connections", 4)
+        snapshot = metrics.snapshot(previous)
+        self.assertEqual(snapshot["counters"]["proxy.connections"], 14)
+        self.assertAlmostEqual(snapshot["rates"]["proxy.connections"], 2, places=1)
+
+
+class TestMetricsReporter(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.metrics = Metrics()
+        self.metrics.inc("crashes")
+        self.metrics.observe("crash.report", 0.001)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def query(self, reporter, request):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(5)
+        client.connect(reporter.address[2][0])
+        client.sendall(request)
+        response = b""
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+        client.close()
+        return response
+
+    def test_metrics_are_served_and_written(self):
+        path = os.path.join(self.folder, "stats.json")
+        address = (socket.AF_UNIX, socket.SOCK_STREAM, (os.path.join(self.folder, "stats.sock"),))
+        reporter = MetricsReporter(self.metrics, address, path, interval=60)
+        reporter.start()
+        try:
+            snapshot = json.loads(self.query(reporter, b"\n").decode("utf-8"))
+            self.assertEqual(snapshot["counters"], {"crashes": 1})
+            self.assertEqual(snapshot["histograms"]["crash.report"]["count"], 1)
+            header, body = self.query(reporter, b"GET / HTTP/1.0\r\n\r\n").split(b"\r\n\r\n", 1)
+            self.assertTrue(header.startswith(b"HTTP/1.0 200 OK"))
+            self.assertEqual(json.loads(body.decode("utf-8"))["counters"], {"crashes": 1})
+        finally:
+            reporter.stop()
+        with open(path) as f:
+            self.assertEqual(json.load(f)["counters"], {"crashes": 1})
+        self.assertFalse(os.path.exists(address[2][0]))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from fuzz_proxy.monitor import CrashBuckets, CrashReport, ExitMonitor, WORD_FORMAT, get_pids, get_process_tree, \
+    get_root_pids, is_running, scan_processes
+
+
+def make_report(pid=1234, base=0x400000, ip_offset=0x10, signum=signal.SIGSEGV):
+    """ Report of a crash at base + ip_offset, called from base + 0x234
+    """
+    report = CrashReport("session", pid, signum, 0)
+    report.raw_registers = [("rip", base + ip_offset), ("rsp", 0x7ffc0028)]
+    report.raw_maps = ("%08x-%08x r-xp 00001000 08:01 1234 /bin/target\n"
+                       "7ffc0000-7ffc1000 rw-p 00000000 00:00 0          [stack]\n"
+                       "7ffd0000-7ffd1000 rw-p 00000000 00:00 0\n" % (base, base + 0x1000))
+    # Two frames: fp -> saved fp 0x7ffc0050 and return address, then the end of the chain
+    words = [0] * 16
+    words[5] = 0xdeadbeef
+    words[6], words[7] = 0x7ffc0050, base + 0x234
+    report.stack_address = 0x7ffc0000
+    report.stack_bytes = b"".join(struct.pack(WORD_FORMAT, w) for w in words)
+    report.ip, report.sp, report.fp = base + ip_offset, 0x7ffc0028, 0x7ffc0030
+    report.stream = [("upstream", b"AB"), ("upstream", b"C", 10)]
+    return report
+
+
+class TestCrashReportEnrich(unittest.TestCase):
+    def setUp(self):
+        self.report = make_report(ip_offset=0x1000)
+
+    def test_maps_are_parsed_from_raw_proc_text(self):
+        self.report.enrich()
+        self.assertEqual(self.report.maps[0], (("0x0000000000400000", "0x0000000000401000"), "/bin/target", "r-xp"))
+        self.assertEqual(self.report.maps[2][1], "")
+        self.assertEqual(self.report.stack["STACK"], "0x000000007ffc0000-0x000000007ffc1000 => [stack] (rw-p)")
+
+    def test_registers_and_stack_words_are_formatted(self):
+        self.report.enrich()
+        self.assertEqual(self.report.registers["rip"], "0x0000000000401000")
+        self.assertEqual(self.report.stack["STACK +0"], "0x00000000deadbeef")
+        self.assertEqual(self.report.stack["STACK-40"], "0x0000000000000000")
+
+    def test_backtrace_walks_captured_frame_pointers(self):
+        self.report.enrich()
+        self.assertEqual(list(self.report.backtrace), ["0x401000", "0x400234"])
+
+    def test_stream_is_hex_encoded(self):
+        self.report.enrich()
+        self.assertEqual(self.report.stream, [("upstream", "4142"), ("upstream", "43", 10)])
+
+
+class TestCrashBuckets(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _add(self, buckets, **kwargs):
+        report = make_report(**kwargs)
+        report.enrich()
+        return buckets.add(report)
+
+    def test_signature_is_relative_to_the_mapping(self):
+        first, second = make_report(base=0x400000), make_report(base=0x7f0000)
+        for report in (first, second):
+            report.enrich()
+        self.assertEqual(first.signature(), "SIGSEGV|target+0x1010|target+0x1234")
+        self.assertEqual(first.signature(), second.signature())
+        self.assertEqual(first.signature(1), "SIGSEGV|target+0x1010")
+
+    def test_only_first_reports_of_a_bucket_are_written(self):
+        buckets = CrashBuckets(self.folder, max_reports=2)
+        files = [self._add(buckets, pid=1)[1], self._add(buckets, pid=1, base=0x7f0000)[1],
+                 self._add(buckets, pid=2)[1]]
+        self.assertEqual(len(buckets), 1)
+        self.assertEqual([os.path.basename(f) for f in files[:2]], ["1-1.json", "1-2.json"])
+        self.assertIsNone(files[2])
+        buckets.flush()
+        with open(os.path.join(self.folder, CrashBuckets.INDEX_FILE)) as f:
+            index = json.load(f)
+        self.assertEqual([b["count"] for b in index.values()], [3])
+
+    def test_different_faulting_pc_gets_a_new_bucket(self):
+        buckets = CrashBuckets(self.folder)
+        first = self._add(buckets)[0]
+        second = self._add(buckets, ip_offset=0x20)[0]
+        self.assertNotEqual(first, second)
+
+    def test_crashes_without_pc_are_told_apart_by_their_last_packet(self):
+        buckets = CrashBuckets(self.folder, max_reports=1)
+        reports = [CrashReport("session", 1, signal.SIGSEGV, 0) for _ in range(3)]
+        reports[0].stream = [("upstream", b"A"), ("downstream", b"hi")]
+        reports[1].stream = [("upstream", b"B")]
+        reports[2].stream = [("upstream", b"B"), ("upstream", b"A")]
+        results = []
+        for report in reports:
+            report.enrich()
+            results.append(buckets.add(report))
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(results[0][0], results[2][0])
+        self.assertIsNotNone(results[1][1])
+
+    def test_index_is_reloaded(self):
+        self._add(CrashBuckets(self.folder, max_reports=1))
+        buckets = CrashBuckets(self.folder, max_reports=1)
+        self.assertIsNone(self._add(buckets)[1])
+        self.assertEqual(list(buckets.buckets.values())[0]["count"], 2)
+
+
+class Options(object):
+    def __init__(self, program):
+        self.program = program
+        self.no_stdout = True
+
+
+class TestExitMonitor(unittest.TestCase):
+    def watch(self, code):
+        monitor = ExitMonitor(Options([sys.executable, "-c", code]))
+        events = []
+
+        def on_exit(event):
+            events.append(event)
+            monitor.stop()
+
+        monitor.watch(None, None, on_exit)
+        return events
+
+    def test_crash_is_reported_with_its_signal(self):
+        events = self.watch("import os, signal; os.kill(os.getpid(), signal.SIGSEGV)")
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].signum, signal.SIGSEGV)
+
+    def test_exit_is_reported_with_its_code(self):
+        events = self.watch("import sys; sys.exit(3)")
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0].exitcode, events[0].signum), (3, None))
+
+
+class TestProcessScan(unittest.TestCase):
+    # pid: (ppid, name). A prefork server, 10, with two workers, and another process of the same name elsewhere
+    TABLE = {1: (0, "init"), 10: (1, "server"), 11: (10, "server"), 12: (10, "server"), 13: (11, "helper"),
+             20: (1, "shell"), 21: (20, "server")}
+
+    def test_current_process_is_found(self):
+        table = scan_processes()
+        self.assertEqual(table[os.getpid()][0], os.getppid())
+
+    def test_processes_are_found_by_name(self):
+        self.assertEqual(get_pids("server", self.TABLE), [10, 11, 12, 21])
+
+    def test_workers_are_not_roots(self):
+        self.assertEqual(get_root_pids("server", self.TABLE), [10, 21])
+
+    def test_tree_holds_all_descendants(self):
+        self.assertEqual(get_process_tree(10, self.TABLE), [10, 11, 12, 13])
+
+    def test_zombies_and_reaped_processes_are_not_running(self):
+        self.assertTrue(is_running(os.getpid()))
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        # A zombie until reaped by wait()
+        while is_running(process.pid):
+            time.sleep(0.01)
+        self.assertIn(process.pid, scan_processes())
+        self.assertFalse(is_running(process.pid))
+        process.wait()
+        self.assertFalse(is_running(process.pid))
+        self.assertFalse(is_running(None))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import struct
+import unittest
+import fuzz_proxy.mutator as fuzzmut
+from fuzz_proxy.mutator import LengthField, Mutator, length_field
+
+
+class TestLengthField(unittest.TestCase):
+    def test_defaults_to_big_endian_without_delta(self):
+        self.assertEqual(length_field("4:2"), LengthField(4, 2, ">", 0))
+
+    def test_byte_order_and_delta_are_parsed(self):
+        self.assertEqual(length_field("0x10:4:little:-2"), LengthField(16, 4, "<", -2))
+
+    def test_unsupported_size_raises_argument_error(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            length_field("0:3")
+
+
+class TestMutator(unittest.TestCase):
+    SEED = [b"\x00\x00" + b"A" * 30, b"second packet"]
+
+    def generate(self, has_numpy):
+        has_numpy, fuzzmut.HAS_NUMPY = fuzzmut.HAS_NUMPY, has_numpy and fuzzmut.HAS_NUMPY
+        try:
+            mutator = Mutator(self.SEED, length_fields=[LengthField(0, 2, ">", 0)], random_seed=1)
+            return mutator.generate(200)
+        finally:
+            fuzzmut.HAS_NUMPY = has_numpy
+
+    def check_streams(self, streams):
+        self.assertEqual(len(streams), 200)
+        self.assertTrue(all(len(stream) == len(self.SEED) for stream in streams))
+        self.assertGreater(len(set(stream[1] for stream in streams)), 100)
+        for stream in streams:
+            if len(stream[0]) >= 2:
+                self.assertEqual(struct.unpack(">H", stream[0][:2])[0], len(stream[0]) - 2)
+
+    def test_python_mutations(self):
+        self.check_streams(self.generate(False))
+
+    @unittest.skipUnless(fuzzmut.HAS_NUMPY, "numpy is not installed")
+    def test_numpy_mutations(self):
+        self.check_streams(self.generate(True))
+
+    def test_first_connection_is_captured_as_seed(self):
+        mutator = Mutator(random_seed=1)
+        self.assertEqual(mutator.mutate("first", b"hello world"), b"hello world")
+        self.assertEqual(mutator.mutate("first", b"bye"), b"bye")
+        self.assertEqual(mutator.seed, None)
+        mutated = mutator.mutate("second", b"hello world")
+        self.assertEqual(mutator.seed, [b"hello world", b"bye"])
+        self.assertEqual(mutator.streams["second"][0][0], mutated)
+        # Packets past the end of the seed are not mutated
+        mutator.mutate("second", b"bye")
+        self.assertEqual(mutator.mutate("second", b"extra"), b"extra")
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import struct
+import threading
+import time
+import unittest
+from fuzz_proxy.metrics import Metrics
+from fuzz_proxy.network import DatagramDownstream, Downstream, HAS_SPLICE, ProxyHooks, StreamDirection
+from fuzz_proxy.pool import ConnectionReceiver
+from fuzz_proxy.recorder import FlightRecorder
+
+
+class RecordingHooks(ProxyHooks):
+    def __init__(self):
+        super(RecordingHooks, self).__init__()
+        self.upstream = []
+
+    def pre_upstream_send(self, channel, data):
+        self.upstream.append((channel[StreamDirection.DOWNSTREAM], bytes(data)))
+        return data
+
+
+class ClosingHooks(ProxyHooks):
+    """ Reports the upstream server as dead after the first upstream packet, and stops the proxy
+    """
+
+    def post_upstream_send(self, channel, data):
+        self.is_done = True
+        return False
+
+
+class HoldingHooks(ProxyHooks):
+    """ Reports the upstream server as ready once told to, through a wakeup pipe
+    """
+
+    def __init__(self):
+        super(HoldingHooks, self).__init__()
+        self.is_ready = False
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+
+    def set_ready(self):
+        self.is_ready = True
+        os.write(self.wakeup_write_fd, b"\0")
+
+    def fileno(self):
+        return self.wakeup_read_fd
+
+    def on_wakeup(self):
+        os.read(self.wakeup_read_fd, 1)
+        return []
+
+    def is_upstream_ready(self):
+        return self.is_ready
+
+    def close(self):
+        os.close(self.wakeup_read_fd)
+        os.close(self.wakeup_write_fd)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def recv_all(socket_):
+    data = bytearray()
+    while True:
+        chunk = socket_.recv(65536)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+
+
+def recv_exactly(socket_, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = socket_.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+class StreamProxyTests(object):
+    """ Behaviour shared by the stream proxy engines, run against a server the test drives by hand. Subclasses set
+    engine
+    """
+
+    engine = None
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(64)
+        self.server.settimeout(5)
+        self.sockets = []
+        self.proxy = None
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.stop_proxy()
+        for socket_ in self.sockets + [self.server]:
+            socket_.close()
+
+    def start_proxy(self, hooks=None, upstream_address=None, listener=None, **kwargs):
+        if listener is None:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(64)
+        upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream_socket.settimeout(5)
+        self.sockets.append(upstream_socket)
+        self.proxy = self.engine(listener, upstream_socket, upstream_address or self.server.getsockname(), hooks,
+                                 **kwargs)
+        self.thread = threading.Thread(target=self.proxy.serve, kwargs={"timeout": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return listener.getsockname() if isinstance(listener, socket.socket) else None
+
+    def stop_proxy(self):
+        self.proxy.is_running = False
+        self.thread.join()
+        self.proxy.stop()
+
+    def connect(self, address):
+        client = socket.create_connection(address, 5)
+        self.sockets.append(client)
+        return client
+
+    def accept(self):
+        upstream = self.server.accept()[0]
+        upstream.settimeout(5)
+        self.sockets.append(upstream)
+        return upstream
+
+    def test_data_is_relayed_both_ways(self):
+        hooks = RecordingHooks()
+        client = self.connect(self.start_proxy(hooks))
+        client.sendall(b"ping")
+        upstream = self.accept()
+        self.assertEqual(upstream.recv(100), b"ping")
+        upstream.sendall(b"pong")
+        self.assertEqual(client.recv(100), b"pong")
+        self.assertEqual([data for _, data in hooks.upstream], [b"ping"])
+
+    def test_concurrent_connections_keep_their_own_peer(self):
+        address = self.start_proxy()
+        clients = [self.connect(address) for _ in range(20)]
+        for i, client in enumerate(clients):
+            client.sendall(b"client %d" % i)
+        for _ in clients:
+            upstream = self.accept()
+            upstream.sendall(upstream.recv(100).upper())
+        for i, client in enumerate(clients):
+            self.assertEqual(client.recv(100), b"CLIENT %d" % i)
+
+    def test_connections_and_packets_are_counted_and_recorded(self):
+        metrics, recorder = Metrics(), FlightRecorder()
+        client = self.connect(self.start_proxy(RecordingHooks(), metrics=metrics, recorder=recorder))
+        client.sendall(b"ping")
+        upstream = self.accept()
+        self.assertEqual(upstream.recv(100), b"ping")
+        upstream.sendall(b"pong!")
+        self.assertEqual(client.recv(100), b"pong!")
+        # Packets are counted once sent
+        self.assertTrue(wait_until(lambda: "proxy.downstream.bytes" in metrics.counters))
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual((counters["proxy.connections"], counters["proxy.upstream.bytes"],
+                          counters["proxy.downstream.bytes"]), (1, 4, 5))
+        self.assertIn("hook.pre_upstream_send", metrics.histograms)
+        events = [event["event"] for event in FlightRecorder.describe(recorder.snapshot())]
+        self.assertEqual(events[:2], ["accept", "connect"])
+        self.assertEqual(events.count("read"), 2)
+        self.assertEqual(events.count("send"), 2)
+
+    def test_connections_handed_over_by_another_process_are_relayed(self):
+        pool_channel, channel = socket.socketpair()
+        self.sockets.append(pool_channel)
+        self.start_proxy(listener=ConnectionReceiver(channel))
+        client, connection = socket.socketpair()
+        self.sockets.append(client)
+        pool_channel.sendmsg([b"\0"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack("i", connection.fileno()))])
+        connection.close()
+        client.sendall(b"ping")
+        upstream = self.accept()
+        self.assertEqual(upstream.recv(100), b"ping")
+        upstream.sendall(b"pong")
+        self.assertEqual(client.recv(100), b"pong")
+
+    def test_end_of_stream_is_forwarded_as_a_half_close(self):
+        client = self.connect(self.start_proxy())
+        client.sendall(b"request")
+        client.shutdown(socket.SHUT_WR)
+        upstream = self.accept()
+        self.assertEqual(recv_all(upstream), b"request")
+        # The other direction keeps flowing until the server is done too
+        upstream.sendall(b"response")
+        upstream.close()
+        self.assertEqual(recv_all(client), b"response")
+
+    def test_big_transfers_are_not_truncated(self):
+        payload = os.urandom(1 << 22)
+        client = self.connect(self.start_proxy(RecordingHooks(), max_pending=4096))
+        sender = threading.Thread(target=lambda: (client.sendall(payload), client.shutdown(socket.SHUT_WR)))
+        sender.start()
+        upstream = self.accept()
+        # The server only reads once the proxy had to queue data and stop reading from the client
+        time.sleep(0.2)
+        self.assertEqual(recv_all(upstream), payload)
+        sender.join()
+
+    def test_writes_are_not_held_back_by_nagle(self):
+        client = self.connect(self.start_proxy(RecordingHooks()))
+        payload = os.urandom(16 * 1024)
+        client.sendall(b"hello")
+        upstream = self.accept()
+        self.assertEqual(upstream.recv(100), b"hello")
+        start = time.time()
+        # Each round trip would wait for a delayed ACK, of 40ms on Linux, with Nagle's algorithm on
+        for _ in range(20):
+            client.sendall(payload)
+            upstream.sendall(recv_exactly(upstream, len(payload)))
+            self.assertEqual(recv_exactly(client, len(payload)), payload)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_refused_upstream_connection_closes_the_client(self):
+        unused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        unused.bind(("127.0.0.1", 0))
+        self.sockets.append(unused)
+        client = self.connect(self.start_proxy(upstream_address=unused.getsockname()))
+        try:
+            self.assertEqual(client.recv(100), b"")
+        except socket.error:
+            pass
+
+    def test_connections_are_held_until_the_upstream_server_is_ready(self):
+        hooks = HoldingHooks()
+        try:
+            client = self.connect(self.start_proxy(hooks))
+            client.sendall(b"early")
+            self.server.settimeout(0.3)
+            self.assertRaises(socket.timeout, self.server.accept)
+            self.server.settimeout(5)
+            hooks.set_ready()
+            self.assertEqual(self.accept().recv(100), b"early")
+        finally:
+            self.stop_proxy()
+            self.thread = None
+            hooks.close()
+
+    def test_pooled_connections_keep_what_the_server_sent_first(self):
+        address = self.start_proxy(pool_size=1)
+        pooled = self.accept()
+        pooled.sendall(b"banner")
+        time.sleep(0.1)
+        client = self.connect(address)
+        self.assertEqual(client.recv(100), b"banner")
+        client.sendall(b"hello")
+        self.assertEqual(pooled.recv(100), b"hello")
+        # The pool is refilled for the next client
+        self.accept()
+
+
+class RoutingHooks(ProxyHooks):
+    """ Sends each new connection to the next address of a list
+    """
+
+    def __init__(self, addresses):
+        super(RoutingHooks, self).__init__()
+        self.addresses = list(addresses)
+
+    def select_upstream(self, upstream_address):
+        return self.addresses.pop(0)
+
+
+class TestDownstream(StreamProxyTests, unittest.TestCase):
+    engine = Downstream
+
+    def test_queued_data_pauses_reads_from_the_peer(self):
+        client = self.connect(self.start_proxy(RecordingHooks(), max_pending=4096))
+        upstream = self.accept()
+        self.assertFalse(self.proxy.use_splice)
+        sender = threading.Thread(target=lambda: (client.sendall(b"x" * (1 << 22)), client.shutdown(socket.SHUT_WR)))
+        sender.start()
+        self.assertTrue(wait_until(lambda: any(self.proxy.directions.get(socket_) == StreamDirection.DOWNSTREAM
+                                               for socket_ in list(self.proxy.paused))))
+        self.assertEqual(len(recv_all(upstream)), 1 << 22)
+        sender.join()
+
+    @unittest.skipUnless(HAS_SPLICE, "splice() is not available")
+    def test_data_is_spliced_when_no_hook_looks_at_it(self):
+        payload = os.urandom(1 << 22)
+        client = self.connect(self.start_proxy(max_pending=4096))
+        self.assertTrue(self.proxy.use_splice)
+        sender = threading.Thread(target=lambda: (client.sendall(payload), client.shutdown(socket.SHUT_WR)))
+        sender.start()
+        upstream = self.accept()
+        time.sleep(0.2)
+        self.assertEqual(recv_all(upstream), payload)
+        sender.join()
+
+    def test_pending_upstream_connects_do_not_block_other_clients(self):
+        # A server with a full accept queue drops connection requests, which leaves the first connect pending
+        full_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        full_server.bind(("127.0.0.1", 0))
+        full_server.listen(0)
+        self.sockets.append(full_server)
+        self.connect(full_server.getsockname())
+        address = self.start_proxy(RoutingHooks([full_server.getsockname(), self.server.getsockname()]))
+        self.proxy.connect_timeout = 0.5
+        pending = self.connect(address)
+        self.assertTrue(wait_until(lambda: len(self.proxy.connecting) == 1))
+        client = self.connect(address)
+        client.sendall(b"served")
+        self.assertEqual(self.accept().recv(100), b"served")
+        self.assertEqual(len(self.proxy.connecting), 1)
+        # The pending connect times out, and its client is closed
+        self.assertEqual(pending.recv(100), b"")
+
+
+class TestDownstreamBatch(unittest.TestCase):
+    def test_sockets_closed_earlier_in_a_batch_are_skipped(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        downstream, client = socket.socketpair()
+        upstream, server = socket.socketpair()
+        proxy = Downstream(listener, socket.socket(socket.AF_INET, socket.SOCK_STREAM), listener.getsockname(),
+                           ClosingHooks())
+        try:
+            proxy._add_channel({StreamDirection.DOWNSTREAM: downstream, StreamDirection.UPSTREAM: upstream})
+            # Data still queued for the upstream socket makes it writable in the same batch as the downstream read
+            proxy.outbound[upstream].append(memoryview(b"queued"))
+            proxy.outbound_sizes[upstream] = 6
+            proxy._update_events(upstream)
+            client.send(b"data")
+            select = proxy.selector.select
+            # The downstream read closes the channel before the upstream write is handled
+            proxy.selector.select = lambda timeout=None: sorted(select(timeout),
+                                                                key=lambda event: event[0].fileobj is not downstream)
+            proxy.serve(timeout=1)
+            self.assertEqual(proxy.peers, {})
+            self.assertEqual(server.recv(100), b"")
+        finally:
+            proxy.stop()
+            for socket_ in (client, server):
+                socket_.close()
+
+
+class TestDatagramDownstream(unittest.TestCase):
+    def setUp(self):
+        self.server = self.udp_socket()
+        self.server.settimeout(5)
+        self.proxy_socket = self.udp_socket()
+        self.hooks = RecordingHooks()
+        self.metrics, self.recorder = Metrics(), FlightRecorder()
+        self.proxy = DatagramDownstream(self.proxy_socket, socket.socket(socket.AF_INET, socket.SOCK_DGRAM),
+                                        self.server.getsockname(), self.hooks, idle_timeout=0.2, metrics=self.metrics,
+                                        recorder=self.recorder)
+        self.clients = []
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.proxy.is_running = False
+            self.thread.join()
+        self.proxy.stop()
+        self.server.close()
+        for client in self.clients:
+            client.close()
+
+    def udp_socket(self):
+        socket_ = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        socket_.bind(("127.0.0.1", 0))
+        return socket_
+
+    def client(self):
+        client = self.udp_socket()
+        client.settimeout(5)
+        self.clients.append(client)
+        return client
+
+    def serve(self):
+        self.thread = threading.Thread(target=self.proxy.serve, kwargs={"timeout": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def echo(self, count):
+        peers = []
+        for _ in range(count):
+            data, address = self.server.recvfrom(100)
+            self.server.sendto(data[::-1], address)
+            peers.append(address)
+        return peers
+
+    def test_each_client_gets_its_own_upstream_socket(self):
+        self.serve()
+        first, second = self.client(), self.client()
+        first.sendto(b"abc", self.proxy_socket.getsockname())
+        second.sendto(b"xyz", self.proxy_socket.getsockname())
+        peers = self.echo(2)
+        self.assertEqual(first.recv(100), b"cba")
+        self.assertEqual(second.recv(100), b"zyx")
+        self.assertNotEqual(peers[0], peers[1])
+        self.assertEqual(sorted(self.hooks.upstream), sorted([(first.getsockname(), b"abc"),
+                                                              (second.getsockname(), b"xyz")]))
+
+    def test_clients_and_datagrams_are_counted_and_recorded(self):
+        self.serve()
+        client = self.client()
+        client.sendto(b"ping", self.proxy_socket.getsockname())
+        self.echo(1)
+        self.assertEqual(client.recv(100), b"gnip")
+        self.assertTrue(wait_until(lambda: "proxy.downstream.bytes" in self.metrics.counters))
+        counters = self.metrics.snapshot()["counters"]
+        self.assertEqual((counters["proxy.connections"], counters["proxy.upstream.bytes"],
+                          counters["proxy.downstream.bytes"]), (1, 4, 4))
+        self.assertIn("hook.pre_upstream_send", self.metrics.histograms)
+        events = [event["event"] for event in FlightRecorder.describe(self.recorder.snapshot())]
+        self.assertEqual(events[:6], ["read", "accept", "connect", "send", "read", "send"])
+
+    def test_idle_upstream_sockets_are_closed(self):
+        self.serve()
+        client = self.client()
+        client.sendto(b"abc", self.proxy_socket.getsockname())
+        self.echo(1)
+        self.assertEqual(client.recv(100), b"cba")
+        self.thread.join(0.5)
+        self.assertEqual(len(self.proxy.upstreams), 0)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import struct
+import unittest
+from fuzz_proxy.pool import ConnectionReceiver, InstancePool, instance_address, instance_program, STATUS_DONE, \
+    STATUS_FORMAT, STATUS_READY
+
+
+class TestInstanceParameters(unittest.TestCase):
+    def test_instance_port_is_offset_by_index(self):
+        self.assertEqual(instance_address(socket.AF_INET, ("127.0.0.1", 7000), 3), ("127.0.0.1", 7003))
+
+    def test_instance_path_is_suffixed_by_index(self):
+        self.assertEqual(instance_address(socket.AF_UNIX, ("/tmp/target",), 2), ("/tmp/target.2",))
+
+    def test_placeholders_are_replaced_in_program(self):
+        program = instance_program(["server", "--port={port}", "-i", "{instance}"], socket.AF_INET,
+                                   ("127.0.0.1", 7001), 1)
+        self.assertEqual(program, ["server", "--port=7001", "-i", "1"])
+
+
+def report_listener(index, channel, status_fd, fileno):
+    """ Instance telling the pool whether it still holds the listening socket
+    """
+    try:
+        os.fstat(fileno)
+        channel.sendall(b"open")
+    except OSError:
+        channel.sendall(b"closed")
+
+
+class TestInstancePool(unittest.TestCase):
+    def setUp(self):
+        self.pool = InstancePool(3, max_waiting=1)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(4)
+        self.sockets = [self.server]
+
+    def tearDown(self):
+        self.pool.stop()
+        self.pool.close()
+        for _, instance_channel in self.pool.channels:
+            instance_channel.close()
+        os.close(self.pool.status_read_fd)
+        os.close(self.pool.status_write_fd)
+        for socket_ in self.sockets:
+            socket_.close()
+
+    def report(self, index, status):
+        os.write(self.pool.status_write_fd, struct.pack(STATUS_FORMAT, index, status))
+        self.pool.on_status()
+
+    def connect(self):
+        """ Client socket, and the connection accepted for it
+        """
+        client = socket.create_connection(self.server.getsockname(), 5)
+        connection = self.server.accept()[0]
+        self.sockets.extend((client, connection))
+        return client, connection
+
+    def test_pool_is_not_ready_until_an_instance_is(self):
+        self.assertFalse(self.pool.is_ready())
+        self.report(1, STATUS_READY)
+        self.assertTrue(self.pool.is_ready())
+
+    def test_connections_go_to_ready_instances_in_turn(self):
+        self.report(0, STATUS_READY)
+        self.report(2, STATUS_READY)
+        selected = [self.pool.select_instance() for _ in range(4)]
+        self.assertEqual(selected, [0, 2, 0, 2])
+
+    def test_pool_is_done_when_all_instances_are(self):
+        self.report(0, STATUS_DONE)
+        self.report(1, STATUS_DONE)
+        self.assertFalse(self.pool.is_done)
+        self.report(2, STATUS_DONE)
+        self.assertTrue(self.pool.is_done)
+
+    def test_instances_close_the_listening_socket(self):
+        self.pool.start(self.server, report_listener, self.server.fileno())
+        for channel, _ in self.pool.channels:
+            channel.settimeout(5)
+            self.assertEqual(channel.recv(100), b"closed")
+
+    def test_connections_are_handed_over_to_instances(self):
+        self.report(1, STATUS_READY)
+        client, connection = self.connect()
+        self.pool.dispatch(connection)
+        # The pool does not keep the connection open
+        self.assertEqual(connection.fileno(), -1)
+        handed_over, address = ConnectionReceiver(self.pool.channels[1][1]).accept()
+        self.sockets.append(handed_over)
+        self.assertEqual(address, client.getsockname())
+        client.sendall(b"hello")
+        self.assertEqual(handed_over.recv(100), b"hello")
+
+    def test_connections_are_held_until_an_instance_is_ready(self):
+        first = self.connect()[1]
+        self.pool.dispatch(first)
+        second = self.connect()[1]
+        self.pool.dispatch(second)
+        # Beyond max_waiting, connections are closed
+        self.assertEqual(list(self.pool.waiting), [first])
+        self.assertEqual(second.fileno(), -1)
+        self.report(0, STATUS_READY)
+        self.assertEqual(len(self.pool.waiting), 0)
+        self.assertEqual(first.fileno(), -1)
+        ConnectionReceiver(self.pool.channels[0][1]).accept()[0].close()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+import fuzz_proxy.recorder as fuzzrec
+from fuzz_proxy.recorder import FlightRecorder
+from tests.test_monitor import make_report
+
+
+class TestFlightRecorder(unittest.TestCase):
+    def test_last_events_are_kept_in_order(self):
+        recorder = FlightRecorder(4)
+        for size in range(10):
+            recorder.record(fuzzrec.READ, 5, size)
+        events = FlightRecorder.describe(recorder.snapshot())
+        self.assertEqual([event["size"] for event in events], [6, 7, 8, 9])
+        self.assertEqual(set(events[0]), {"time", "event", "fd", "size"})
+
+    def test_events_are_described_by_name(self):
+        recorder = FlightRecorder()
+        recorder.record(fuzzrec.ACCEPT, 7)
+        recorder.record(fuzzrec.SIGNAL, 1234, 11)
+        recorder.record(fuzzrec.READY)
+        events = FlightRecorder.describe(recorder.snapshot())
+        for event in events:
+            del event["time"]
+        self.assertEqual(events, [{"event": "accept", "downstream_fd": 7},
+                                  {"event": "signal", "pid": 1234, "signum": 11},
+                                  {"event": "ready"}])
+
+    def test_crash_reports_hold_the_events(self):
+        recorder = FlightRecorder()
+        recorder.record(fuzzrec.CONNECT, 7, 8)
+        report = make_report()
+        report.events = recorder.snapshot()
+        report.enrich()
+        events = json.loads(json.dumps(report.to_dict()))["events"]
+        self.assertEqual([(event["event"], event["upstream_fd"]) for event in events], [("connect", 8)])
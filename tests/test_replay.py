@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from fuzz_proxy.mutator import LengthField
+from fuzz_proxy.replay import ddmin, delimiter, Delimiter, find_test_cases, LengthPrefix, load_streams, \
+    RecordedLength, replay_stream, ReplayWorker, VERDICT_FAILED
+
+
+def to_hex(data):
+    return binascii.hexlify(data).decode("ascii")
+
+
+class TestTestCases(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, content):
+        path = os.path.join(self.folder, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            json.dump(content, f)
+        return path
+
+    def test_reports_of_bucket_folders_are_found_in_order(self):
+        second = self.write(os.path.join("b", "1-1.json"), {})
+        first = self.write(os.path.join("a", "2-1.json"), {})
+        self.write("buckets.json", {})
+        self.write("notes.txt", {})
+        self.assertEqual(find_test_cases(self.folder), [first, second])
+
+    def test_history_is_replayed_before_stream(self):
+        path = self.write("1-1.json", {"history": [[["upstream", "00"]]], "stream": [["upstream", "01"]]})
+        self.assertEqual(load_streams(path), [[["upstream", "01"]]])
+        self.assertEqual(load_streams(path, True), [[["upstream", "00"]], [["upstream", "01"]]])
+
+
+class TestFraming(unittest.TestCase):
+    def test_recorded_length(self):
+        self.assertFalse(RecordedLength().is_complete(b"ab", 3))
+        self.assertTrue(RecordedLength().is_complete(b"abc", 3))
+
+    def test_delimiter_escapes_are_decoded(self):
+        framing = Delimiter(delimiter("\\r\\n"))
+        self.assertFalse(framing.is_complete(b"HTTP/1.1 200 OK\r", 100))
+        self.assertTrue(framing.is_complete(b"HTTP/1.1 200 OK\r\nServer", 100))
+
+    def test_length_prefix_counts_following_bytes(self):
+        framing = LengthPrefix(LengthField(1, 2, "<", 1))
+        self.assertFalse(framing.is_complete(b"\x00\x04", 0))
+        self.assertFalse(framing.is_complete(b"\x00\x04\x00ab", 0))
+        self.assertTrue(framing.is_complete(b"\x00\x04\x00abc", 0))
+
+
+class TestReplayStream(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.received = []
+        self.thread = threading.Thread(target=self.serve_once)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join()
+        self.server.close()
+
+    def serve_once(self):
+        client, _ = self.server.accept()
+        data = client.recv(100)
+        self.received.append(data)
+        client.sendall(data[::-1])
+        if data.startswith(b"hold"):
+            # The connection stays open until the client closes it
+            client.recv(100)
+        client.close()
+
+    def test_response_ends_when_peer_closes(self):
+        socket_info = (socket.AF_INET, socket.SOCK_STREAM, self.server.getsockname())
+        stream = [["upstream", to_hex(b"abc")], ["downstream", to_hex(b"cba")]]
+        self.assertTrue(replay_stream(socket_info, stream, timeout=5))
+        self.assertEqual(self.received, [b"abc"])
+
+    def test_response_ends_at_recorded_length(self):
+        socket_info = (socket.AF_INET, socket.SOCK_STREAM, self.server.getsockname())
+        stream = [["upstream", to_hex(b"hold")], ["downstream", to_hex(b"dloh")]]
+        start = time.time()
+        self.assertTrue(replay_stream(socket_info, stream, timeout=5))
+        self.assertLess(time.time() - start, 2)
+
+
+class TestReplayWorker(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        # The target is not started: replays go to the server of the test
+        self.worker = ReplayWorker(0, ["true"], (socket.AF_INET, socket.SOCK_STREAM, self.server.getsockname()),
+                                   wait=0.1)
+
+    def tearDown(self):
+        self.server.close()
+
+    def reset_once(self):
+        client, _ = self.server.accept()
+        client.recv(100)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        client.close()
+
+    def test_reset_connections_are_failures(self):
+        thread = threading.Thread(target=self.reset_once)
+        thread.start()
+        verdict = self.worker.replay([[["upstream", to_hex(b"abc")], ["downstream", to_hex(b"cba")]]])
+        thread.join()
+        self.assertEqual(verdict["verdict"], VERDICT_FAILED)
+
+    def test_replays_wait_for_the_restart_of_a_crashed_target(self):
+        self.worker.restarted.clear()
+        threading.Timer(0.2, self.worker.restarted.set).start()
+        start = time.time()
+        self.assertTrue(self.worker._wait_ready())
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+
+class TestDeltaDebugging(unittest.TestCase):
+    def test_items_are_reduced_to_the_needed_ones(self):
+        batches = []
+
+        def test(candidates):
+            batches.append(len(candidates))
+            return [3 in candidate and 7 in candidate for candidate in candidates]
+        self.assertEqual(ddmin(list(range(10)), test), [3, 7])
+        # Candidates of a round are tested together
+        self.assertTrue(any(size > 2 for size in batches))
+
+    def test_bytes_keep_their_order(self):
+        self.assertEqual(ddmin(bytearray(b"xxAxxBxx"), lambda candidates: [b"AB" in bytes(c).replace(b"x", b"")
+                                                                            for c in candidates]), bytearray(b"AB"))
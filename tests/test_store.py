@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from fuzz_proxy.monitor import CrashBuckets
+from fuzz_proxy.store import CrashStore
+from tests.test_monitor import make_report
+
+
+class TestCrashStore(unittest.TestCase):
+    HISTORY = [[("upstream", b"hello" * 100), ("downstream", b"world")]]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store_folder = os.path.join(self.folder, CrashStore.FOLDER)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def report(self, pid):
+        report = make_report(pid=pid)
+        report.history = self.HISTORY
+        report.enrich()
+        return report
+
+    def test_shared_packets_are_stored_once(self):
+        store = CrashStore(self.store_folder)
+        for pid in range(10):
+            store.add(self.report(pid), "%d.json" % pid)
+        store.close()
+        self.assertEqual(len(store.packets), 4)
+        self.assertLess(os.path.getsize(os.path.join(self.store_folder, "packets.seg")), 600)
+
+    def test_writes_are_batched(self):
+        store = CrashStore(self.store_folder, batch_size=3)
+        for pid in range(2):
+            store.add(self.report(pid), "%d.json" % pid)
+        self.assertFalse(os.path.exists(os.path.join(self.store_folder, "records.idx")))
+        store.add(self.report(2), "2.json")
+        self.assertEqual(len(CrashStore(self.store_folder)), 3)
+        store.close()
+
+    def test_export_gives_the_json_of_the_report(self):
+        report = self.report(1234)
+        store = CrashStore(self.store_folder)
+        store.add(report, os.path.join("bucket", "1234-1.json"))
+        store.close()
+        paths = CrashStore(self.store_folder).export(self.folder)
+        self.assertEqual(paths, [os.path.join(self.folder, "bucket", "1234-1.json")])
+        with open(paths[0]) as f:
+            exported = json.load(f)
+        expected = json.loads(json.dumps(report.to_dict()))
+        self.assertEqual(exported, expected)
+
+    def test_torn_index_entry_is_dropped(self):
+        store = CrashStore(self.store_folder)
+        store.add(self.report(1), "1.json")
+        store.close()
+        with open(os.path.join(self.store_folder, "records.idx"), "ab") as f:
+            f.write(b"\x00" * 5)
+        store = CrashStore(self.store_folder)
+        self.assertEqual(len(store), 1)
+        store.add(self.report(2), "2.json")
+        store.close()
+        self.assertEqual([CrashStore(self.store_folder).get(i)["pid"] for i in range(2)], [1, 2])
+
+    def test_buckets_append_reports_to_the_store(self):
+        store = CrashStore(self.store_folder)
+        buckets = CrashBuckets(self.folder, store=store)
+        bucket_id, crash_file_name = buckets.add(self.report(1))
+        buckets.close()
+        self.assertFalse(os.path.exists(crash_file_name))
+        self.assertEqual(CrashStore(self.store_folder).export(self.folder), [crash_file_name])
+        with open(os.path.join(self.folder, CrashBuckets.INDEX_FILE)) as f:
+            self.assertEqual(json.load(f)[bucket_id]["reports"], [os.path.join(bucket_id, "1-1.json")])
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from fuzz_proxy.symbols import MapsLayout, SymbolCache
+
+
+class TestMapsLayout(unittest.TestCase):
+    def test_mapping_of_an_address_is_found(self):
+        layout = MapsLayout("00402000-00403000 rw-p 00002000 08:01 1234 /bin/target\n"
+                            "00400000-00401000 r-xp 00001000 08:01 1234 /bin/target\n"
+                            "7ffc0000-7ffc1000 rw-p 00000000 00:00 0          [stack]\n")
+        self.assertEqual(layout.find(0x400010), (0x400000, 0x401000, 0x1000, "/bin/target"))
+        self.assertEqual(layout.find(0x402fff)[0], 0x402000)
+        self.assertIsNone(layout.find(0x401000))
+        self.assertIsNone(layout.find(0x3fffff))
+        self.assertEqual(layout.stack, "0x000000007ffc0000-0x000000007ffc1000 => [stack] (rw-p)")
+
+    def test_addresses_are_relative_to_their_binary_file(self):
+        layout = MapsLayout("00400000-00401000 r-xp 00001000 08:01 1234 /bin/target\n"
+                            "7ffc0000-7ffc1000 rw-p 00000000 00:00 0          [stack]\n")
+        self.assertEqual(layout.locate(0x400010), ("/bin/target", 0x1010))
+        self.assertEqual(layout.relative_address(0x400010), "target+0x1010")
+        self.assertIsNone(layout.locate(0x7ffc0010))
+        self.assertEqual(layout.relative_address(0x7ffc0010), "0x7ffc0010")
+
+
+class TestSymbolCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = SymbolCache(size=2)
+
+    def test_symbol_tables_are_parsed_once_per_binary(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, "target")
+            shutil.copy(sys.executable, path)
+            table = self.cache.symbols(path)
+            self.assertIs(self.cache.symbols(path), table)
+            # A rebuilt binary is parsed again
+            os.utime(path, (0, 0))
+            self.assertIsNot(self.cache.symbols(path), table)
+            self.assertEqual(len(self.cache.tables), 2)
+            self.cache.symbols(sys.executable)
+            self.assertEqual(len(self.cache.tables), 2)
+        finally:
+            shutil.rmtree(folder)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "Reads /proc/self/maps")
+    def test_functions_of_loaded_binaries_are_named(self):
+        with open("/proc/self/maps") as f:
+            layout = MapsLayout(f.read())
+        address = ctypes.cast(ctypes.CDLL(None).getpid, ctypes.c_void_p).value
+        binary = os.path.basename(layout.find(address)[3])
+        name = self.cache.resolve(layout, address + 1)
+        self.assertTrue(name.startswith(binary + "!"), name)
+        self.assertTrue(name.endswith("getpid+0x1"), name)
+
+    def test_unreadable_binaries_fall_back_to_file_offsets(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, "target")
+            with open(path, "wb") as f:
+                f.write(b"not an elf")
+            layout = MapsLayout("00400000-00401000 r-xp 00001000 08:01 1234 %s\n" % path)
+            self.assertEqual(self.cache.resolve(layout, 0x400234), "target+0x1234")
+            self.assertIsNone(self.cache.tables[list(self.cache.tables)[0]])
+        finally:
+            shutil.rmtree(folder)